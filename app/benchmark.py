@@ -0,0 +1,436 @@
+import asyncio
+import datetime as dt
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import numpy as np
+from pydantic import BaseModel
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
+
+from app import executor
+from app.db import Model, engine_options
+from app.engine_cache import matrix_engine_cache
+from app.interning import item_interner, user_interner
+from app.lsh import (LSH_SIMILAR_USERS, MinHashLSH, exact_similar,
+                     lsh_index_cache)
+from app.models import UserPurchase
+from app.orm_query import RecommendRepository
+from app.recommender import RecommendationEngine
+from app.schemas import RecommendationAdd, RecommendationMode
+from app.synthetic import generate_dataset
+from app.utils import get_purchases_dataframe, load_interactions
+
+# Точки масштаба: пользователи, товары, покупки.
+SCALES = {
+    'small': (1_000, 500, 20_000),
+    'medium': (10_000, 5_000, 500_000),
+    'large': (100_000, 50_000, 10_000_000),
+}
+BENCHMARK_SAMPLE = 20
+# На какую долю метрика может вырасти, прежде чем считаться регрессией.
+REGRESSION_THRESHOLD = 0.2
+COMPARED_METRICS = ('latency_p50_ms', 'latency_p95_ms', 'peak_memory_mb',
+                    'queries', 'rows_read', 'ids_memory_mb')
+# Настройки индекса LSH (полосы, строки), которые сравниваются
+# с точным поиском похожих пользователей.
+LSH_SETTINGS = ((16, 1), (32, 2), (64, 2), (32, 4))
+
+
+class BenchmarkResult(BaseModel):
+    '''Замеры одного способа расчета на одной точке масштаба.'''
+    scale: str
+    users: int
+    items: int
+    purchases: int
+    mode: RecommendationMode
+    sample: int
+    errors: int
+    latency_p50_ms: float
+    latency_p95_ms: float
+    latency_max_ms: float
+    peak_memory_mb: float
+    queries: int
+    rows_read: Optional[int] = None
+    # Покупки в памяти: UUID строками в DataFrame и кодами int32
+    # со словарями UUID.
+    str_ids_memory_mb: Optional[float] = None
+    ids_memory_mb: Optional[float] = None
+
+
+class Regression(BaseModel):
+    '''Метрика, которая ухудшилась сильнее порога.'''
+    scale: str
+    mode: RecommendationMode
+    metric: str
+    base: float
+    new: float
+    change: float
+
+
+class LSHResult(BaseModel):
+    '''Полнота и скорость поиска похожих пользователей через LSH.'''
+    scale: str
+    users: int
+    items: int
+    purchases: int
+    bands: int
+    rows: int
+    similar_users: int
+    sample: int
+    build_seconds: float
+    recall: float
+    candidates_mean: float
+    latency_p50_ms: float
+    latency_p95_ms: float
+    exact_latency_p50_ms: float
+    exact_latency_p95_ms: float
+
+
+def parse_scale(scale: str) -> tuple[str, tuple[int, int, int]]:
+    '''Точка масштаба по имени или в виде users:items:purchases.'''
+    if scale in SCALES:
+        return scale, SCALES[scale]
+    try:
+        users, items, purchases = (int(part) for part in scale.split(':'))
+    except ValueError:
+        raise ValueError(f'Неизвестная точка масштаба: {scale}.')
+    return scale, (users, items, purchases)
+
+
+class QueryCounter:
+    '''Считает запросы к базе и строки, прочитанные базой.'''
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.queries = 0
+
+    def _count(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.queries += 1
+
+    async def rows_read(self) -> Optional[int]:
+        '''
+        Строки, прочитанные Postgres из таблиц с момента запуска.
+
+        SQLite таких счетчиков не ведет, для неё возвращается None.
+        '''
+        if self.engine.dialect.name != 'postgresql':
+            return None
+        async with self.engine.connect() as conn:
+            # Статистика отправляется процессами сервера с задержкой.
+            await asyncio.sleep(0.6)
+            await conn.execute(text('SELECT pg_stat_clear_snapshot()'))
+            return int(await conn.scalar(text(
+                'SELECT coalesce(sum(seq_tup_read + '
+                'coalesce(idx_tup_fetch, 0)), 0) FROM pg_stat_user_tables')))
+
+    def __enter__(self) -> 'QueryCounter':
+        event.listen(self.engine.sync_engine, 'before_cursor_execute',
+                     self._count)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        event.remove(self.engine.sync_engine, 'before_cursor_execute',
+                     self._count)
+
+
+async def generate(session_factory: async_sessionmaker,
+                   user_id, mode: RecommendationMode) -> bool:
+    '''Генерирует рекомендацию, возвращает False при ошибке.'''
+    async with session_factory() as session:
+        try:
+            await RecommendRepository.add_recommendation(
+                RecommendationAdd(user_id=user_id, mode=mode), session)
+        except Exception:
+            return False
+    return True
+
+
+async def measure_mode(session_factory: async_sessionmaker,
+                       engine: AsyncEngine, user_ids: list,
+                       mode: RecommendationMode) -> dict:
+    '''
+    Время, пиковая память и запросы генерации рекомендаций.
+
+    tracemalloc сильно замедляет расчет, поэтому память замеряется
+    отдельным проходом для первого пользователя.
+    '''
+    latencies = []
+    errors = 0
+    counter = QueryCounter(engine)
+    rows_before = await counter.rows_read()
+    with counter:
+        for user_id in user_ids:
+            started = time.perf_counter()
+            errors += not await generate(session_factory, user_id, mode)
+            latencies.append(time.perf_counter() - started)
+    rows_after = await counter.rows_read()
+
+    tracemalloc.start()
+    await generate(session_factory, user_ids[0], mode)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'sample': len(user_ids),
+        'errors': errors,
+        'latency_p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'latency_p95_ms': round(float(np.percentile(latencies_ms, 95)), 3),
+        'latency_max_ms': round(float(latencies_ms.max()), 3),
+        'peak_memory_mb': round(peak / 2 ** 20, 3),
+        'queries': counter.queries,
+        'rows_read': (None if rows_before is None
+                      else rows_after - rows_before),
+    }
+
+
+def reset_interners() -> None:
+    '''Забывает коды прошлой базы: каждая точка масштаба - новая база.'''
+    user_interner.clear()
+    item_interner.clear()
+    lsh_index_cache.clear()
+    matrix_engine_cache.clear()
+
+
+async def measure_id_memory(session: AsyncSession) -> dict:
+    '''
+    Память всех покупок в виде строк UUID и в виде кодов int32.
+
+    Строки - столбцы user_id и item_id типа str, как их держал
+    бы DataFrame; коды - массивы кодов вместе со словарями UUID.
+    '''
+    df = (await get_purchases_dataframe(session)).astype(str)
+    str_bytes = int(df.memory_usage(deep=True, index=False).sum())
+    del df
+    ids_bytes = (await load_interactions(session)).memory_bytes()
+    return {'str_ids_memory_mb': round(str_bytes / 2 ** 20, 3),
+            'ids_memory_mb': round(ids_bytes / 2 ** 20, 3)}
+
+
+async def benchmark_scale(url: str, scale: str, users: int, items: int,
+                          purchases: int, modes: list[RecommendationMode],
+                          sample: int, seed: int,
+                          progress: Callable[[str], None]
+                          ) -> list[BenchmarkResult]:
+    '''Заполняет базу заново и замеряет все способы расчета.'''
+    engine = create_async_engine(url, **engine_options(url))
+    reset_interners()
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Model.metadata.drop_all)
+            await conn.run_sync(Model.metadata.create_all)
+        session_factory = async_sessionmaker(engine,
+                                             expire_on_commit=False)
+        async with session_factory() as session:
+            stats = await generate_dataset(
+                session, users, items, purchases, seed=seed,
+                progress=lambda done: progress(
+                    f'{scale}: загружено покупок {done}/{purchases}'))
+            progress(f'{scale}: данные созданы за {stats.seconds} с')
+            memory = await measure_id_memory(session)
+            progress(f'{scale}: покупки в памяти - '
+                     f'{memory["str_ids_memory_mb"]} МБ строками, '
+                     f'{memory["ids_memory_mb"]} МБ кодами')
+            # Пользователи с покупками, как в реальных запросах
+            user_ids = (await session.scalars(
+                select(UserPurchase.user_id).distinct()
+                .order_by(UserPurchase.user_id).limit(sample))).all()
+
+        results = []
+        for mode in modes:
+            metrics = await measure_mode(session_factory, engine,
+                                         user_ids, mode)
+            results.append(BenchmarkResult(
+                scale=scale, users=users, items=items,
+                purchases=purchases, mode=mode, **metrics, **memory))
+            progress(f'{scale}/{mode.value}: '
+                     f'p50 {metrics["latency_p50_ms"]} мс, '
+                     f'p95 {metrics["latency_p95_ms"]} мс, '
+                     f'память {metrics["peak_memory_mb"]} МБ')
+        return results
+    finally:
+        await engine.dispose()
+
+
+async def run_benchmark(scales: list[str],
+                        modes: Optional[list[RecommendationMode]] = None,
+                        url: Optional[str] = None,
+                        sample: int = BENCHMARK_SAMPLE, seed: int = 0,
+                        progress: Callable[[str], None] = lambda line: None
+                        ) -> dict:
+    '''
+    Замеряет генерацию рекомендаций на синтетических данных.
+
+    Для каждой точки масштаба база создается заново: по умолчанию
+    временный файл SQLite, либо база url (все таблицы в ней будут
+    удалены). Расчет выполняется в текущем процессе, чтобы
+    tracemalloc учитывал его память.
+    '''
+    modes = modes or list(RecommendationMode)
+    executor.RECOMMENDATION_EXECUTOR = 'inline'
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            name, (users, items, purchases) = parse_scale(scale)
+            scale_url = url or (f'sqlite+aiosqlite:///'
+                                f'{os.path.join(directory, "bench.db")}')
+            results.extend(await benchmark_scale(
+                scale_url, name, users, items, purchases, modes, sample,
+                seed, progress))
+            if url is None:
+                os.remove(os.path.join(directory, 'bench.db'))
+    return {
+        'meta': {
+            'created_at': dt.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'dialect': (url or 'sqlite').split(':')[0],
+            'seed': seed,
+        },
+        'results': [result.model_dump(mode='json') for result in results],
+    }
+
+
+def percentiles_ms(latencies: list[float]) -> tuple[float, float]:
+    latencies_ms = np.array(latencies) * 1000
+    return (round(float(np.percentile(latencies_ms, 50)), 3),
+            round(float(np.percentile(latencies_ms, 95)), 3))
+
+
+def measure_lsh(engine: RecommendationEngine, codes: np.ndarray,
+                bands: int, rows: int, m: int) -> dict:
+    '''
+    Сравнивает m похожих пользователей из LSH с точным перебором.
+
+    Полнота - доля точных m лучших по Жаккару, найденных через LSH,
+    усредненная по пользователям, у которых есть похожие.
+    '''
+    started = time.perf_counter()
+    lsh = MinHashLSH(bands, rows).fit(engine.binary)
+    build_seconds = time.perf_counter() - started
+
+    latencies, exact_latencies, recalls, candidates = [], [], [], []
+    for code in codes:
+        started = time.perf_counter()
+        found = lsh.similar(code, m)
+        latencies.append(time.perf_counter() - started)
+        candidates.append(lsh.candidates(code).size)
+
+        started = time.perf_counter()
+        exact = exact_similar(engine.binary, code, m)
+        exact_latencies.append(time.perf_counter() - started)
+        if exact.size:
+            recalls.append(np.intersect1d(found, exact).size / exact.size)
+
+    p50, p95 = percentiles_ms(latencies)
+    exact_p50, exact_p95 = percentiles_ms(exact_latencies)
+    return {
+        'bands': bands,
+        'rows': rows,
+        'similar_users': m,
+        'sample': len(codes),
+        'build_seconds': round(build_seconds, 3),
+        'recall': round(float(np.mean(recalls)) if recalls else 0.0, 4),
+        'candidates_mean': round(float(np.mean(candidates)), 1),
+        'latency_p50_ms': p50,
+        'latency_p95_ms': p95,
+        'exact_latency_p50_ms': exact_p50,
+        'exact_latency_p95_ms': exact_p95,
+    }
+
+
+async def run_lsh_benchmark(scales: list[str],
+                            settings: tuple = LSH_SETTINGS,
+                            m: int = LSH_SIMILAR_USERS,
+                            sample: int = BENCHMARK_SAMPLE, seed: int = 0,
+                            progress: Callable[[str], None] = lambda line: None
+                            ) -> list[LSHResult]:
+    '''
+    Замеряет поиск похожих пользователей через LSH и полным перебором.
+
+    Данные создаются во временной базе SQLite, расчет идет в памяти
+    над той же матрицей покупок, что и в режимах matrix и lsh.
+    '''
+    results = []
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            name, (users, items, purchases) = parse_scale(scale)
+            url = f'sqlite+aiosqlite:///{os.path.join(directory, "lsh.db")}'
+            engine = create_async_engine(url, **engine_options(url))
+            reset_interners()
+            try:
+                async with engine.begin() as conn:
+                    await conn.run_sync(Model.metadata.create_all)
+                session_factory = async_sessionmaker(
+                    engine, expire_on_commit=False)
+                async with session_factory() as session:
+                    await generate_dataset(session, users, items,
+                                           purchases, seed=seed)
+                    interactions = await load_interactions(session)
+            finally:
+                await engine.dispose()
+                os.remove(os.path.join(directory, 'lsh.db'))
+
+            matrix = RecommendationEngine.from_interactions(interactions)
+            active = np.flatnonzero(np.diff(matrix.binary.indptr))
+            codes = rng.choice(active, size=min(sample, active.size),
+                               replace=False)
+            for bands, rows in settings:
+                metrics = measure_lsh(matrix, codes, bands, rows, m)
+                results.append(LSHResult(
+                    scale=name, users=users, items=items,
+                    purchases=purchases, **metrics))
+                progress(f'{name} bands={bands} rows={rows}: '
+                         f'полнота {metrics["recall"]}, '
+                         f'кандидатов {metrics["candidates_mean"]}, '
+                         f'p50 {metrics["latency_p50_ms"]} мс против '
+                         f'{metrics["exact_latency_p50_ms"]} мс')
+    return results
+
+
+def save_results(results: dict, path: str) -> None:
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, ensure_ascii=False)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare_results(base: dict, new: dict,
+                    threshold: float = REGRESSION_THRESHOLD
+                    ) -> list[Regression]:
+    '''
+    Метрики нового запуска, выросшие больше чем на threshold.
+
+    Сравниваются только пары (точка масштаба, способ расчета),
+    которые есть в обоих запусках.
+    '''
+    base_results = {(result['scale'], result['mode']): result
+                    for result in base['results']}
+    regressions = []
+    for result in new['results']:
+        old = base_results.get((result['scale'], result['mode']))
+        if old is None:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = old.get(metric), result.get(metric)
+            if before is None or after is None or after <= before:
+                continue
+            change = (after - before) / before if before else float('inf')
+            if change > threshold:
+                regressions.append(Regression(
+                    scale=result['scale'], mode=result['mode'],
+                    metric=metric, base=before, new=after,
+                    change=round(change, 4)))
+    return regressions
@@ -0,0 +1,93 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+RECOMMENDATION_CACHE_SIZE = int(os.getenv('RECOMMENDATION_CACHE_SIZE',
+                                          '100000'))
+RECOMMENDATION_CACHE_TTL = float(os.getenv('RECOMMENDATION_CACHE_TTL',
+                                           '300'))
+
+
+class CacheBackend(ABC):
+    '''
+    Интерфейс кэша.
+
+    Методы асинхронные, чтобы тот же интерфейс мог реализовать
+    внешний кэш, например Redis.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def get(self, key: Hashable) -> Optional[Any]:
+        '''Возвращает значение или None, если его нет в кэше.'''
+
+    @abstractmethod
+    async def set(self, key: Hashable, value: Any) -> None:
+        '''Сохраняет значение.'''
+
+    @abstractmethod
+    async def delete(self, *keys: Hashable) -> None:
+        '''Удаляет значения.'''
+
+    @abstractmethod
+    async def clear(self) -> None:
+        '''Очищает кэш.'''
+
+    def stats(self) -> dict:
+        '''Счетчики попаданий и промахов.'''
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0}
+
+
+class LRUCache(CacheBackend):
+    '''Кэш в памяти процесса с вытеснением LRU и временем жизни записей.'''
+
+    def __init__(self, maxsize: int = RECOMMENDATION_CACHE_SIZE,
+                 ttl: float = RECOMMENDATION_CACHE_TTL):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, *keys: Hashable) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {**super().stats(),
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl}
+
+
+recommendation_cache: CacheBackend = LRUCache()
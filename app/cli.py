@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import datetime as dt
+import os
+import sys
+import uuid
+from typing import Optional
+
+from app.benchmark import (BENCHMARK_SAMPLE, LSH_SETTINGS,
+                           REGRESSION_THRESHOLD, compare_results, load_results,
+                           parse_scale, run_benchmark, run_lsh_benchmark,
+                           save_results)
+from app.db import create_table, db_session
+from app.importer import IMPORT_BATCH_SIZE, ImportStats, import_purchases
+from app.loadtest import DEFAULT_MIX, parse_mix, run_load_test
+from app.lsh import LSH_SIMILAR_USERS
+from app.orm_query import (ITEM_NEIGHBOURS, ITEM_SIMILARITY, POPULARITY_TOP_N,
+                           RecommendRepository)
+from app.partitions import (PURCHASE_HOT_MONTHS, PURCHASE_MONTHS_AHEAD,
+                            archive_purchases, ensure_partitions,
+                            list_partitions)
+from app.recommender import SIMILARITY_METRICS
+from app.schemas import RecommendationMode
+from app.synthetic import generate_dataset
+from app.utils import (rebuild_cooccurrence, rebuild_item_neighbours,
+                       rebuild_popularity)
+
+
+async def generate_recommendations(user_ids: list[uuid.UUID]) -> None:
+    '''Пакетная генерация рекомендаций из командной строки.'''
+    await create_table()
+    async with db_session() as session:
+        result = await RecommendRepository.add_recommendations_batch(
+            session, user_ids or None)
+    print(f'Пользователей: {result.users}, '
+          f'рекомендаций: {result.generated}, '
+          f'пропущено: {result.skipped}, '
+          f'время: {result.seconds} с, '
+          f'скорость: {result.users_per_sec} польз./с')
+
+
+async def rebuild_cooccurrence_table() -> None:
+    '''Пересчет таблицы совместных покупок по всей истории.'''
+    await create_table()
+    async with db_session() as session:
+        await rebuild_cooccurrence(session)
+    print('Таблица совместных покупок пересчитана.')
+
+
+async def rebuild_item_neighbours_table(n: int, metric: str) -> None:
+    '''Пересчет таблицы похожих товаров по всей истории.'''
+    await create_table()
+    async with db_session() as session:
+        pairs = await rebuild_item_neighbours(session, n, metric)
+    print(f'Таблица похожих товаров пересчитана, пар: {pairs}.')
+
+
+async def rebuild_popularity_table(n: int) -> None:
+    '''Пересчет таблицы популярных товаров по всей истории.'''
+    await create_table()
+    async with db_session() as session:
+        await rebuild_popularity(session, n)
+    print('Таблица популярных товаров пересчитана.')
+
+
+async def maintain_partitions(hot_months: int, months_ahead: int,
+                              first_month: Optional[dt.datetime],
+                              archive: bool) -> None:
+    '''Создание секций покупок и перенос старых покупок в архив.'''
+    await create_table()
+    async with db_session() as session:
+        created = await ensure_partitions(session, first_month,
+                                          months_ahead)
+        if created:
+            print(f'Созданы секции: {", ".join(created)}')
+        if archive:
+            archived = await archive_purchases(session, hot_months)
+            if archived:
+                print(f'Покупки перенесены в архив: {", ".join(archived)}')
+                await rebuild_cooccurrence(session)
+                await rebuild_item_neighbours(session, ITEM_NEIGHBOURS,
+                                              ITEM_SIMILARITY)
+                await rebuild_popularity(session, POPULARITY_TOP_N)
+                print('Таблицы совместных, похожих и популярных товаров '
+                      'пересчитаны.')
+        for info in await list_partitions(session):
+            period = f'{info.period:%Y-%m}' if info.period else 'default'
+            kind = 'архив' if info.archived else 'рабочая'
+            print(f'{info.name} {period}: {kind}, строк {info.rows}')
+
+
+def print_import_progress(stats: ImportStats) -> None:
+    print(f'Строк: {stats.rows}, загружено: {stats.imported}, '
+          f'отклонено: {stats.rejected}, '
+          f'скорость: {stats.rows_per_sec} строк/с', flush=True)
+
+
+async def import_purchases_file(path: str, batch_size: int,
+                                restart: bool) -> None:
+    '''Импорт истории покупок из файла.'''
+    state_path = f'{path}.state.json'
+    if restart and os.path.exists(state_path):
+        os.remove(state_path)
+    await create_table()
+    async with db_session() as session:
+        stats = await import_purchases(path, session, batch_size,
+                                       state_path, print_import_progress)
+        if stats.skipped:
+            print(f'Пропущено строк, загруженных ранее: {stats.skipped}')
+        print(f'Импорт завершен за {stats.seconds} с.')
+        await rebuild_cooccurrence(session)
+        await rebuild_item_neighbours(session, ITEM_NEIGHBOURS,
+                                      ITEM_SIMILARITY)
+        await rebuild_popularity(session, POPULARITY_TOP_N)
+    print('Таблицы совместных покупок, похожих и популярных товаров '
+          'пересчитаны.')
+
+
+async def seed_database(users: int, items: int, purchases: int,
+                        seed: int) -> None:
+    '''Заполнение базы синтетическими данными.'''
+    await create_table()
+    async with db_session() as session:
+        stats = await generate_dataset(
+            session, users, items, purchases, seed=seed,
+            progress=lambda done: print(f'Покупок: {done}/{purchases}',
+                                        flush=True))
+    print(f'Пользователей: {stats.users}, товаров: {stats.items}, '
+          f'покупок: {stats.purchases}, время: {stats.seconds} с')
+
+
+async def benchmark(scales: list[str], modes: list[RecommendationMode],
+                    url: Optional[str], sample: int, seed: int,
+                    output: str) -> None:
+    '''Замер генерации рекомендаций на нескольких точках масштаба.'''
+    results = await run_benchmark(scales, modes, url, sample, seed,
+                                  lambda line: print(line, flush=True))
+    save_results(results, output)
+    print(f'Результаты сохранены в {output}.')
+
+
+def parse_lsh_setting(setting: str) -> tuple[int, int]:
+    '''Настройка индекса LSH в виде bands:rows.'''
+    try:
+        bands, rows = (int(part) for part in setting.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'Ожидается bands:rows, получено: {setting}.')
+    return bands, rows
+
+
+async def benchmark_lsh(scales: list[str], settings: list[tuple[int, int]],
+                        m: int, sample: int, seed: int,
+                        output: str) -> None:
+    '''Сравнение поиска похожих пользователей через LSH и перебором.'''
+    results = await run_lsh_benchmark(scales, settings, m, sample, seed,
+                                      lambda line: print(line, flush=True))
+    save_results({'results': [result.model_dump() for result in results]},
+                 output)
+    print(f'Результаты сохранены в {output}.')
+
+
+def compare_benchmarks(base: str, new: str, threshold: float) -> None:
+    '''Сравнение двух запусков, код выхода 1 при регрессии.'''
+    regressions = compare_results(load_results(base), load_results(new),
+                                  threshold)
+    for regression in regressions:
+        print(f'{regression.scale}/{regression.mode.value} '
+              f'{regression.metric}: {regression.base} -> '
+              f'{regression.new} (+{regression.change:.0%})')
+    if regressions:
+        sys.exit(1)
+    print('Регрессий нет.')
+
+
+async def load_test(clients: int, requests: int, duration: Optional[float],
+                    mix: dict[str, int], url: Optional[str],
+                    dataset: str, seed: int,
+                    output: Optional[str]) -> None:
+    '''Нагрузочный тест приложения без запуска сервера.'''
+    _, scale = parse_scale(dataset)
+    report = await run_load_test(clients, requests, duration, mix, url,
+                                 scale, seed,
+                                 lambda line: print(line, flush=True))
+    for route in report.routes:
+        print(f'{route.route}: {route.requests} запросов, '
+              f'p50 {route.latency_p50_ms} мс, '
+              f'p90 {route.latency_p90_ms} мс, '
+              f'p99 {route.latency_p99_ms} мс, '
+              f'ошибок {route.errors}, ответов 4xx {route.client_errors}')
+        print('  ' + ', '.join(f'{bound}: {count}' for bound, count
+                               in route.histogram.items() if count))
+    print(f'Всего {report.requests} запросов за {report.seconds} с, '
+          f'{report.requests_per_sec} запросов/с, ошибок {report.errors}.')
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(report.model_dump_json(indent=2))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    '''
+    Разбор аргументов командной строки.
+
+    Каждая команда запоминает свой обработчик в func.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Служебные команды сервиса рекомендаций.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser(
+        'generate', help='Сгенерировать рекомендации пакетно.')
+    generate.add_argument('user_ids', nargs='*', type=uuid.UUID,
+                          help='Пользователи, по умолчанию все.')
+    generate.set_defaults(func=lambda args: asyncio.run(
+        generate_recommendations(args.user_ids)))
+
+    commands.add_parser(
+        'rebuild-cooccurrence',
+        help='Пересчитать таблицу совместных покупок.'
+    ).set_defaults(func=lambda args: asyncio.run(
+        rebuild_cooccurrence_table()))
+
+    neighbours_parser = commands.add_parser(
+        'rebuild-item-neighbours',
+        help='Пересчитать таблицу похожих товаров для режима item.')
+    neighbours_parser.add_argument('--neighbours', type=int,
+                                   default=ITEM_NEIGHBOURS,
+                                   help='Соседей на товар.')
+    neighbours_parser.add_argument('--metric', choices=SIMILARITY_METRICS,
+                                   default=ITEM_SIMILARITY)
+    neighbours_parser.set_defaults(func=lambda args: asyncio.run(
+        rebuild_item_neighbours_table(args.neighbours, args.metric)))
+
+    popularity_parser = commands.add_parser(
+        'rebuild-popularity',
+        help='Пересчитать популярные товары для новых пользователей.')
+    popularity_parser.add_argument('--top', type=int,
+                                   default=POPULARITY_TOP_N,
+                                   help='Товаров в каждом списке.')
+    popularity_parser.set_defaults(func=lambda args: asyncio.run(
+        rebuild_popularity_table(args.top)))
+
+    partitions_parser = commands.add_parser(
+        'partitions',
+        help='Создать секции покупок по месяцам и перенести старые '
+             'покупки в архив.')
+    partitions_parser.add_argument(
+        '--hot-months', type=int, default=PURCHASE_HOT_MONTHS,
+        help='Сколько последних месяцев остается в рабочей таблице.')
+    partitions_parser.add_argument(
+        '--months-ahead', type=int, default=PURCHASE_MONTHS_AHEAD,
+        help='На сколько месяцев вперед создать секции.')
+    partitions_parser.add_argument(
+        '--from', dest='first_month',
+        type=lambda value: dt.datetime.strptime(value, '%Y-%m'),
+        help='Создать секции начиная с месяца ГГГГ-ММ, например перед '
+             'импортом истории.')
+    partitions_parser.add_argument(
+        '--no-archive', dest='archive', action='store_false',
+        help='Только создать секции.')
+    partitions_parser.set_defaults(func=lambda args: asyncio.run(
+        maintain_partitions(args.hot_months, args.months_ahead,
+                            args.first_month, args.archive)))
+
+    import_parser = commands.add_parser(
+        'import-purchases',
+        help='Импортировать историю покупок из CSV или Parquet.')
+    import_parser.add_argument(
+        'path', help='Файл со столбцами user, item, category, '
+                     'purchase_date.')
+    import_parser.add_argument('--batch-size', type=int,
+                               default=IMPORT_BATCH_SIZE)
+    import_parser.add_argument(
+        '--restart', action='store_true',
+        help='Начать сначала, а не с места прошлой остановки.')
+    import_parser.set_defaults(func=lambda args: asyncio.run(
+        import_purchases_file(args.path, args.batch_size, args.restart)))
+
+    seed_parser = commands.add_parser(
+        'seed', help='Заполнить базу синтетическими данными.')
+    seed_parser.add_argument('--users', type=int, default=1_000)
+    seed_parser.add_argument('--items', type=int, default=500)
+    seed_parser.add_argument('--purchases', type=int, default=20_000)
+    seed_parser.add_argument('--seed', type=int, default=0)
+    seed_parser.set_defaults(func=lambda args: asyncio.run(
+        seed_database(args.users, args.items, args.purchases, args.seed)))
+
+    benchmark_parser = commands.add_parser(
+        'benchmark',
+        help='Замерить генерацию рекомендаций на синтетических данных.')
+    benchmark_parser.add_argument(
+        '--scale', action='append',
+        help='small, medium, large или users:items:purchases; '
+             'можно указать несколько раз. По умолчанию small и medium.')
+    benchmark_parser.add_argument(
+        '--mode', action='append', type=RecommendationMode,
+        help='Способ расчета, по умолчанию все.')
+    benchmark_parser.add_argument(
+        '--database-url',
+        help='База для замеров, все таблицы в ней будут удалены. '
+             'По умолчанию временный файл SQLite.')
+    benchmark_parser.add_argument('--sample', type=int,
+                                  default=BENCHMARK_SAMPLE,
+                                  help='Пользователей на точку масштаба.')
+    benchmark_parser.add_argument('--seed', type=int, default=0)
+    benchmark_parser.add_argument('--output', default='benchmark.json')
+    benchmark_parser.set_defaults(func=lambda args: asyncio.run(
+        benchmark(args.scale or ['small', 'medium'], args.mode,
+                  args.database_url, args.sample, args.seed, args.output)))
+
+    compare_parser = commands.add_parser(
+        'benchmark-compare',
+        help='Сравнить два запуска benchmark и найти регрессии.')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float,
+                                default=REGRESSION_THRESHOLD)
+    compare_parser.set_defaults(func=lambda args: compare_benchmarks(
+        args.base, args.new, args.threshold))
+
+    lsh_parser = commands.add_parser(
+        'benchmark-lsh',
+        help='Сравнить поиск похожих пользователей через LSH '
+             'с точным перебором.')
+    lsh_parser.add_argument(
+        '--scale', action='append',
+        help='small, medium, large или users:items:purchases; '
+             'по умолчанию small.')
+    lsh_parser.add_argument(
+        '--setting', action='append', type=parse_lsh_setting,
+        help='Полосы и строки индекса в виде bands:rows; можно указать '
+             'несколько раз.')
+    lsh_parser.add_argument('--similar-users', type=int,
+                            default=LSH_SIMILAR_USERS)
+    lsh_parser.add_argument('--sample', type=int, default=100,
+                            help='Пользователей на точку масштаба.')
+    lsh_parser.add_argument('--seed', type=int, default=0)
+    lsh_parser.add_argument('--output', default='benchmark-lsh.json')
+    lsh_parser.set_defaults(func=lambda args: asyncio.run(
+        benchmark_lsh(args.scale or ['small'], args.setting or LSH_SETTINGS,
+                      args.similar_users, args.sample, args.seed,
+                      args.output)))
+
+    load_parser = commands.add_parser(
+        'loadtest',
+        help='Нагрузочный тест приложения без сервера и сети.')
+    load_parser.add_argument('--clients', type=int, default=10,
+                             help='Одновременных клиентов.')
+    load_parser.add_argument('--requests', type=int, default=1_000,
+                             help='Всего запросов.')
+    load_parser.add_argument('--duration', type=float,
+                             help='Ограничение по времени, с.')
+    load_parser.add_argument(
+        '--mix', type=parse_mix, default=DEFAULT_MIX,
+        help='Доли операций purchase, generate и recommendations, '
+             'например purchase=3,generate=1,recommendations=6.')
+    load_parser.add_argument(
+        '--database-url',
+        help='База для теста, все таблицы в ней будут удалены. '
+             'По умолчанию временный файл SQLite.')
+    load_parser.add_argument(
+        '--dataset', default='small',
+        help='Объем данных: small, medium, large или '
+             'users:items:purchases.')
+    load_parser.add_argument('--seed', type=int, default=0)
+    load_parser.add_argument('--output', help='Файл для отчета в JSON.')
+    load_parser.set_defaults(func=lambda args: asyncio.run(
+        load_test(args.clients, args.requests, args.duration, args.mix,
+                  args.database_url, args.dataset, args.seed, args.output)))
+
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
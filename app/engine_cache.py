@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.interning import item_interner, user_interner
+from app.recommender import RecommendationEngine
+from app.utils import load_interactions
+
+load_dotenv()
+# Через сколько секунд матрица покупок режима matrix строится заново.
+# Покупки, добавленные через API этого процесса, попадают в неё сразу,
+# покупки других процессов и импорта - при следующем построении.
+MATRIX_ENGINE_TTL = float(os.getenv('MATRIX_ENGINE_TTL', '300'))
+
+
+class MatrixEngineCache:
+    '''
+    Матрица покупок пользователь x товар в памяти процесса.
+
+    Матрица строится по всей истории покупок и живет ttl секунд,
+    новые покупки дописываются в неё через add_purchases. Строит её
+    только один запрос, остальные ждут готовую матрицу.
+    '''
+
+    def __init__(self, ttl: float = MATRIX_ENGINE_TTL):
+        self.ttl = ttl
+        self._engine: Optional[RecommendationEngine] = None
+        self._expires = 0.0
+        # Покупки, добавленные во время каждого построения: загрузка
+        # могла их не увидеть, поэтому они дописываются после неё.
+        self._pending: list[list[tuple[uuid.UUID, uuid.UUID]]] = []
+        self._locks: dict = {}
+
+    def _expired(self) -> bool:
+        return self._engine is None or self._expires < time.monotonic()
+
+    def _get_lock(self) -> asyncio.Lock:
+        # Блокировка привязана к циклу событий, поэтому своя для
+        # каждого цикла.
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            self._locks.clear()
+            lock = self._locks[loop] = asyncio.Lock()
+        return lock
+
+    async def get(self, session: AsyncSession) -> RecommendationEngine:
+        '''
+        Текущая матрица, при необходимости строит её заново.
+
+        Матрица строится в потоке без ограничения RECOMMENDATION_TIMEOUT:
+        копировать её из процесса пула дорого, а прерванное по таймауту
+        построение пришлось бы начинать заново при следующем запросе.
+        '''
+        if not self._expired():
+            return self._engine
+        async with self._get_lock():
+            if not self._expired():
+                return self._engine
+            pending = []
+            self._pending.append(pending)
+            try:
+                interactions = await load_interactions(session)
+                engine = await asyncio.to_thread(
+                    RecommendationEngine, interactions.user_codes,
+                    interactions.item_codes, interactions.shape)
+            finally:
+                self._pending = [other for other in self._pending
+                                 if other is not pending]
+            self._engine = engine
+            self._expires = time.monotonic() + self.ttl
+            self._apply(pending)
+            return self._engine
+
+    def add_purchases(self,
+                      purchases: list[tuple[uuid.UUID, uuid.UUID]]) -> None:
+        '''Дописывает покупки (пользователь, товар) в матрицу.'''
+        for pending in self._pending:
+            pending.extend(purchases)
+        self._apply(purchases)
+
+    def _apply(self, purchases: list[tuple[uuid.UUID, uuid.UUID]]) -> None:
+        if self._engine is None or not purchases:
+            return
+        self._engine.add_purchases(
+            user_interner.add_all([user_id for user_id, _ in purchases]),
+            item_interner.add_all([item_id for _, item_id in purchases]))
+
+    def clear(self) -> None:
+        self._engine = None
+        self._pending = []
+
+
+matrix_engine_cache = MatrixEngineCache()
@@ -0,0 +1,85 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from functools import partial
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+load_dotenv()
+# Где считать рекомендации: process - пул процессов, thread - пул
+# потоков (если расчет отпускает GIL), inline - прямо в цикле событий.
+RECOMMENDATION_EXECUTOR = os.getenv('RECOMMENDATION_EXECUTOR', 'process')
+RECOMMENDATION_WORKERS = int(os.getenv('RECOMMENDATION_WORKERS',
+                                       str(min(os.cpu_count() or 1, 4))))
+# Сколько расчетов одновременно может ждать один процесс приложения.
+RECOMMENDATION_CONCURRENCY = int(os.getenv('RECOMMENDATION_CONCURRENCY',
+                                           str(RECOMMENDATION_WORKERS * 2)))
+# Сколько секунд ждать результат расчета.
+RECOMMENDATION_TIMEOUT = float(os.getenv('RECOMMENDATION_TIMEOUT', '30'))
+
+_executor: Optional[Executor] = None
+_semaphores: dict = {}
+
+
+def get_executor() -> Optional[Executor]:
+    '''Пул для расчетов, создается при первом обращении.'''
+    global _executor
+    if _executor is None and RECOMMENDATION_EXECUTOR == 'process':
+        # spawn, а не fork: процесс приложения многопоточный
+        # (aiosqlite, uvicorn), а fork копирует захваченные блокировки.
+        _executor = ProcessPoolExecutor(
+            max_workers=RECOMMENDATION_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    elif _executor is None and RECOMMENDATION_EXECUTOR == 'thread':
+        _executor = ThreadPoolExecutor(max_workers=RECOMMENDATION_WORKERS)
+    return _executor
+
+
+def shutdown_executor() -> None:
+    '''Останавливает пул, вызывается при остановке приложения.'''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Семафор привязан к циклу событий, поэтому свой для каждого цикла.
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        _semaphores.clear()
+        semaphore = _semaphores[loop] = asyncio.Semaphore(
+            RECOMMENDATION_CONCURRENCY)
+    return semaphore
+
+
+async def run_cpu_bound(func: Callable, *args: Any,
+                        timeout: Optional[float] = None) -> Any:
+    '''
+    Выполняет тяжелый расчет вне цикла событий.
+
+    Одновременно выполняется не больше RECOMMENDATION_CONCURRENCY
+    расчетов. Если результат не готов за timeout секунд, возвращается
+    ошибка 503; уже запущенный в процессе расчет при этом
+    доводится до конца, но его результат не используется.
+    '''
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    timeout = RECOMMENDATION_TIMEOUT if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    async with _get_semaphore():
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor, partial(func, *args)),
+                timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail='Не удалось рассчитать рекомендацию '
+                       'за отведенное время.')
@@ -0,0 +1,187 @@
+import json
+import os
+import time
+import uuid
+from itertools import count
+from typing import Callable, Iterator, Optional
+
+import pandas as pd
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import UserPurchase
+from app.orm_query import ItemRepository, UserRepository
+
+IMPORT_BATCH_SIZE = 10_000
+COLUMNS = ['user', 'item', 'category', 'purchase_date']
+# Пространство имен для id импортированных покупок: id зависит только
+# от файла и номера строки, поэтому повторный импорт строки ничего
+# не дублирует.
+IMPORT_NAMESPACE = uuid.UUID('3f0c2a52-8f64-4c1e-9a4e-6a0d1c7b9e21')
+STAGING_TABLE = 'userpurchase_import'
+
+
+class ImportStats(BaseModel):
+    '''Итоги импорта покупок.'''
+    rows: int = 0
+    imported: int = 0
+    rejected: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+    rows_per_sec: float = 0.0
+
+
+def read_batches(path: str, batch_size: int,
+                 offset: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Читает файл CSV или Parquet порциями, пропуская первые offset строк.
+
+    Для Parquet нужен пакет pyarrow.
+    '''
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError('Для импорта Parquet установите pyarrow.')
+        batches = (batch.to_pandas()
+                   for batch in pq.ParquetFile(path).iter_batches(
+                       batch_size=batch_size))
+    else:
+        batches = pd.read_csv(path, chunksize=batch_size, dtype=str)
+
+    for batch in batches:
+        if offset >= len(batch):
+            offset -= len(batch)
+            continue
+        yield batch.iloc[offset:].reset_index(drop=True)
+        offset = 0
+
+
+def load_state(state_path: str) -> int:
+    '''Сколько строк файла уже обработано прошлыми запусками.'''
+    if not os.path.exists(state_path):
+        return 0
+    with open(state_path) as state_file:
+        return json.load(state_file)['offset']
+
+
+def save_state(state_path: str, offset: int) -> None:
+    '''Запоминает, сколько строк файла обработано.'''
+    with open(state_path, 'w') as state_file:
+        json.dump({'offset': offset}, state_file)
+
+
+async def validate_batch(batch: pd.DataFrame, source: str, offset: int,
+                         session: AsyncSession) -> list[dict]:
+    '''
+    Проверяет порцию строк и возвращает покупки для вставки.
+
+    Пользователи и товары проверяются двумя запросами на всю порцию;
+    строки с неизвестными id, неверной категорией или без даты
+    покупки отбрасываются.
+    '''
+    batch = batch.reindex(columns=COLUMNS)
+    # Даты разбираются разом для всей порции. Формат не угадывается
+    # по первой строке, иначе даты в другом виде ISO 8601 пропадут.
+    dates = pd.to_datetime(batch['purchase_date'], errors='coerce',
+                           utc=True, format='ISO8601').dt.tz_localize(None)
+    rows = []
+    for number, record, purchase_date in zip(
+            count(offset), batch.itertuples(index=False), dates):
+        if pd.isna(purchase_date):
+            continue
+        try:
+            user_id = uuid.UUID(str(record.user))
+            item_id = uuid.UUID(str(record.item))
+        except ValueError:
+            continue
+        rows.append({
+            'id': uuid.uuid5(IMPORT_NAMESPACE, f'{source}:{number}'),
+            'user_id': user_id,
+            'item_id': item_id,
+            'category': str(record.category),
+            'purchase_date': purchase_date.to_pydatetime(),
+        })
+
+    users = await UserRepository.get_existing(
+        [row['user_id'] for row in rows], session)
+    categories = await ItemRepository.get_categories(
+        [row['item_id'] for row in rows], session)
+    rows = [row for row in rows if row['user_id'] in users]
+    return [row for row in rows
+            if categories.get(row['item_id']) == row['category']]
+
+
+async def copy_rows(rows: list[dict], session: AsyncSession) -> None:
+    '''
+    Загружает покупки в Postgres через COPY.
+
+    COPY идет во временную таблицу, откуда строки переносятся
+    с пропуском уже загруженных. Таблица покупок секционирована
+    по дате, уникален только ключ (id, purchase_date): по нему
+    ON CONFLICT пропускает загруженные строки, и каждая строка
+    проверяется только в секции своего месяца.
+    '''
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    await session.execute(text(
+        f'CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} '
+        '(LIKE userpurchase INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'))
+    columns = ['id', 'user_id', 'item_id', 'category', 'purchase_date']
+    await driver_connection.copy_records_to_table(
+        STAGING_TABLE, columns=columns,
+        records=[tuple(row[column] for column in columns) for row in rows])
+    await session.execute(text(
+        f'INSERT INTO userpurchase ({", ".join(columns)}) '
+        f'SELECT {", ".join(columns)} FROM {STAGING_TABLE} '
+        'ON CONFLICT (id, purchase_date) DO NOTHING'))
+
+
+async def insert_rows(rows: list[dict], session: AsyncSession) -> None:
+    '''Загружает покупки через executemany с пропуском уже загруженных id.'''
+    query = sqlite.insert(UserPurchase).on_conflict_do_nothing(
+        index_elements=['id'])
+    await session.execute(query, rows)
+
+
+async def import_purchases(
+    path: str, session: AsyncSession,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    state_path: Optional[str] = None,
+    progress: Callable[[ImportStats], None] = lambda stats: None
+) -> ImportStats:
+    '''
+    Импорт истории покупок из CSV или Parquet.
+
+    Файл содержит столбцы user, item, category, purchase_date.
+    Каждая порция загружается отдельной транзакцией, после чего
+    число обработанных строк записывается в state_path: прерванный
+    импорт продолжается с этого места.
+    '''
+    state_path = state_path or f'{path}.state.json'
+    source = os.path.abspath(path)
+    offset = load_state(state_path)
+    load = copy_rows if session.bind.dialect.name == 'postgresql' \
+        else insert_rows
+
+    stats = ImportStats(skipped=offset)
+    started = time.perf_counter()
+    for batch in read_batches(path, batch_size, offset):
+        rows = await validate_batch(batch, source, offset, session)
+        if rows:
+            await load(rows, session)
+        await session.commit()
+
+        offset += len(batch)
+        save_state(state_path, offset)
+        stats.rows += len(batch)
+        stats.imported += len(rows)
+        stats.rejected += len(batch) - len(rows)
+        stats.seconds = round(time.perf_counter() - started, 3)
+        stats.rows_per_sec = (round(stats.rows / stats.seconds, 1)
+                              if stats.seconds else 0.0)
+        progress(stats)
+    return stats
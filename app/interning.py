@@ -0,0 +1,117 @@
+import sys
+import uuid
+from typing import Iterable, Optional
+
+import numpy as np
+
+# UUID в массивах NumPy - 16 байт без преобразования в строку.
+UUID_DTYPE = np.dtype('V16')
+CODE_DTYPE = np.int32
+
+
+class IdInterner:
+    '''
+    Двусторонний словарь UUID <-> плотный код int32 одной сущности.
+
+    Коды выдаются по порядку появления UUID и не меняются, пока
+    словарь не очищен, поэтому массивы покупок, загруженные
+    в разное время, используют одни и те же коды. UUID хранятся
+    16-байтовыми значениями, строки не создаются.
+    '''
+
+    def __init__(self):
+        self._codes: dict[bytes, int] = {}
+        # Буфер UUID по кодам, растет удвоением.
+        self._ids = np.empty(0, dtype=UUID_DTYPE)
+        self._ranks: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def _append(self, values: list[bytes]) -> None:
+        size = len(self._codes)
+        start = size - len(values)
+        if size > self._ids.size:
+            grown = np.empty(max(size, 2 * self._ids.size, 1024),
+                             dtype=UUID_DTYPE)
+            grown[:start] = self._ids[:start]
+            self._ids = grown
+        self._ids[start:size] = np.frombuffer(b''.join(values),
+                                              dtype=UUID_DTYPE)
+
+    def intern(self, raw: np.ndarray) -> np.ndarray:
+        '''
+        Коды для массива 16-байтовых UUID.
+
+        Неизвестные UUID получают следующие свободные коды. Словарь
+        проверяется только для уникальных значений массива.
+        '''
+        if raw.size == 0:
+            return np.empty(0, dtype=CODE_DTYPE)
+        uniques, inverse = np.unique(raw, return_inverse=True)
+        codes = np.empty(uniques.size, dtype=CODE_DTYPE)
+        new = []
+        for position, value in enumerate(uniques.tolist()):
+            code = self._codes.get(value)
+            if code is None:
+                code = self._codes[value] = len(self._codes)
+                new.append(value)
+            codes[position] = code
+        if new:
+            self._append(new)
+        return codes[inverse.reshape(-1)]
+
+    def add(self, value: uuid.UUID) -> int:
+        '''Код UUID, при необходимости выдает новый.'''
+        return int(self.add_all([value])[0])
+
+    def add_all(self, values: list[uuid.UUID]) -> np.ndarray:
+        '''Коды списка UUID, новым UUID выдаются новые коды.'''
+        return self.intern(np.frombuffer(
+            b''.join(value.bytes for value in values), dtype=UUID_DTYPE))
+
+    def code(self, value: uuid.UUID) -> Optional[int]:
+        return self._codes.get(value.bytes)
+
+    def codes(self, values: Iterable[uuid.UUID]) -> np.ndarray:
+        '''Коды списка UUID, -1 для неизвестных.'''
+        return np.array([self._codes.get(value.bytes, -1)
+                         for value in values], dtype=CODE_DTYPE)
+
+    def uuid_of(self, code: int) -> uuid.UUID:
+        return uuid.UUID(bytes=self._ids[code].tobytes())
+
+    def uuids_of(self, codes: np.ndarray) -> list[uuid.UUID]:
+        codes = np.asarray(codes, dtype=np.int64)
+        return [uuid.UUID(bytes=value) for value in self._ids[codes].tolist()]
+
+    def ranks(self) -> np.ndarray:
+        '''
+        Место каждого кода среди UUID, упорядоченных по байтам.
+
+        Так же UUID упорядочивает ORDER BY id в базе, поэтому
+        по этим местам расчет в памяти разрешает ничьи, как SQL.
+        '''
+        size = len(self._codes)
+        if self._ranks is None or self._ranks.size != size:
+            ranks = np.empty(size, dtype=CODE_DTYPE)
+            ranks[np.argsort(self._ids[:size], kind='stable')] = (
+                np.arange(size, dtype=CODE_DTYPE))
+            self._ranks = ranks
+        return self._ranks
+
+    def memory_bytes(self) -> int:
+        '''Память словаря: буфер UUID, хеш-таблица и её ключи.'''
+        keys = sum(sys.getsizeof(value) for value in self._codes)
+        return self._ids.nbytes + sys.getsizeof(self._codes) + keys
+
+    def clear(self) -> None:
+        self._codes = {}
+        self._ids = np.empty(0, dtype=UUID_DTYPE)
+        self._ranks = None
+
+
+# Словари процесса: пополняются при создании пользователей и товаров
+# и при загрузке покупок.
+user_interner = IdInterner()
+item_interner = IdInterner()
@@ -0,0 +1,175 @@
+import asyncio
+import datetime as dt
+import os
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.orm_query import RecommendRepository
+from app.schemas import JobStatus, RecommendationAdd, RecommendationJobRead
+
+load_dotenv()
+# Сколько задач генерации рекомендаций выполняется одновременно.
+RECOMMENDATION_JOB_WORKERS = int(os.getenv('RECOMMENDATION_JOB_WORKERS',
+                                           '2'))
+# Сколько задач может ждать в очереди, сверх этого - ошибка 503.
+RECOMMENDATION_JOB_QUEUE_SIZE = int(os.getenv('RECOMMENDATION_JOB_QUEUE_SIZE',
+                                              '10000'))
+# Сколько завершенных задач хранится для запроса статуса.
+RECOMMENDATION_JOB_HISTORY = int(os.getenv('RECOMMENDATION_JOB_HISTORY',
+                                           '10000'))
+
+
+class JobBroker(ABC):
+    '''
+    Интерфейс очереди задач.
+
+    Методы асинхронные, чтобы тот же интерфейс мог реализовать
+    внешний брокер сообщений.
+    '''
+
+    @abstractmethod
+    async def put(self, job_id: uuid.UUID) -> None:
+        '''Ставит задачу в очередь, если очередь полна - asyncio.QueueFull.'''
+
+    @abstractmethod
+    async def get(self) -> uuid.UUID:
+        '''Ждет и возвращает следующую задачу.'''
+
+    @abstractmethod
+    def qsize(self) -> int:
+        '''Число задач в очереди.'''
+
+
+class LocalBroker(JobBroker):
+    '''Очередь задач в памяти процесса на asyncio.Queue.'''
+
+    def __init__(self, maxsize: int = RECOMMENDATION_JOB_QUEUE_SIZE):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    async def put(self, job_id: uuid.UUID) -> None:
+        self._queue.put_nowait(job_id)
+
+    async def get(self) -> uuid.UUID:
+        return await self._queue.get()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+class JobManager:
+    '''
+    Задачи генерации рекомендаций и обработчики очереди.
+
+    Повторный запрос для пользователя, задача которого еще ждет
+    в очереди, возвращает ту же задачу.
+    '''
+
+    def __init__(self, history: int = RECOMMENDATION_JOB_HISTORY):
+        self.history = history
+        self.broker: Optional[JobBroker] = None
+        self._session_factory: Optional[Callable[[], AsyncSession]] = None
+        self._workers: list[asyncio.Task] = []
+        self._jobs: dict[uuid.UUID, RecommendationJobRead] = {}
+        self._pending: dict[tuple, uuid.UUID] = {}
+        self._finished: OrderedDict = OrderedDict()
+        self.coalesced = 0
+
+    def start(self, session_factory: Callable[[], AsyncSession],
+              workers: int = RECOMMENDATION_JOB_WORKERS,
+              broker: Optional[JobBroker] = None) -> None:
+        '''Запускает обработчики в текущем цикле событий.'''
+        self._session_factory = session_factory
+        self.broker = broker or LocalBroker()
+        self._workers = [asyncio.create_task(self._work())
+                         for _ in range(workers)]
+
+    async def stop(self) -> None:
+        '''Останавливает обработчики и забывает все задачи.'''
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self.broker = None
+        self._jobs.clear()
+        self._pending.clear()
+        self._finished.clear()
+
+    async def submit(self, request: RecommendationAdd
+                     ) -> RecommendationJobRead:
+        '''Ставит задачу в очередь или возвращает уже ожидающую.'''
+        if self.broker is None:
+            raise HTTPException(status_code=503,
+                                detail='Очередь задач не запущена.')
+        key = (request.user_id, request.mode)
+        job_id = self._pending.get(key)
+        if job_id is not None:
+            self.coalesced += 1
+            return self._jobs[job_id]
+
+        job = RecommendationJobRead(id=uuid.uuid4(),
+                                    user_id=request.user_id,
+                                    mode=request.mode,
+                                    created_at=dt.datetime.now())
+        try:
+            await self.broker.put(job.id)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503,
+                                detail='Очередь задач переполнена.')
+        self._jobs[job.id] = job
+        self._pending[key] = job.id
+        return job
+
+    def get(self, job_id: uuid.UUID) -> Optional[RecommendationJobRead]:
+        return self._jobs.get(job_id)
+
+    async def _work(self) -> None:
+        while True:
+            job = self._jobs.get(await self.broker.get())
+            if job is None:
+                continue
+            # Задача уже выполняется: новый запрос пользователя
+            # получит новую задачу с учетом свежих покупок.
+            self._pending.pop((job.user_id, job.mode), None)
+            job.status = JobStatus.running
+            try:
+                async with self._session_factory() as session:
+                    job.detail = await RecommendRepository.add_recommendation(
+                        RecommendationAdd(user_id=job.user_id,
+                                          mode=job.mode),
+                        session)
+                job.status = JobStatus.done
+            except HTTPException as error:
+                job.status = JobStatus.failed
+                job.detail = str(error.detail)
+                job.status_code = error.status_code
+            except Exception as error:
+                job.status = JobStatus.failed
+                job.detail = repr(error)
+                job.status_code = 500
+            job.finished_at = dt.datetime.now()
+            self._remember(job.id)
+
+    def _remember(self, job_id: uuid.UUID) -> None:
+        self._finished[job_id] = None
+        while len(self._finished) > self.history:
+            old_id, _ = self._finished.popitem(last=False)
+            self._jobs.pop(old_id, None)
+
+    def stats(self) -> dict:
+        '''Число задач по состояниям и объединенных запросов.'''
+        counts = {job_status.value: 0 for job_status in JobStatus}
+        for job in self._jobs.values():
+            counts[job.status.value] += 1
+        return {**counts,
+                'queued': self.broker.qsize() if self.broker else 0,
+                'workers': len(self._workers),
+                'coalesced': self.coalesced}
+
+
+recommendation_jobs = JobManager()
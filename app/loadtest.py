@@ -0,0 +1,216 @@
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import AsyncGenerator, Callable, Optional
+
+import numpy as np
+from httpx import ASGITransport, AsyncClient
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
+                                    create_async_engine)
+
+from app.db import Model, engine_options, get_db
+from app.main import app
+from app.models import Item, User
+from app.synthetic import generate_dataset
+
+# Доли операций в нагрузке по умолчанию.
+DEFAULT_MIX = {'purchase': 3, 'generate': 1, 'recommendations': 6}
+ROUTES = {
+    'purchase': 'POST /purchases',
+    'generate': 'POST /generate_recommendations',
+    'recommendations': 'GET /recommendations',
+}
+# Верхние границы интервалов гистограммы задержек, мс.
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 2_000,
+                       5_000, float('inf'))
+
+
+class RouteReport(BaseModel):
+    '''Задержки и ошибки одного маршрута.'''
+    route: str
+    requests: int
+    errors: int
+    client_errors: int
+    statuses: dict[str, int]
+    latency_p50_ms: float
+    latency_p90_ms: float
+    latency_p99_ms: float
+    latency_max_ms: float
+    histogram: dict[str, int]
+
+
+class LoadReport(BaseModel):
+    '''Итоги нагрузочного теста.'''
+    clients: int
+    requests: int
+    errors: int
+    seconds: float
+    requests_per_sec: float
+    routes: list[RouteReport]
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    '''Доли операций из строки вида purchase=3,recommendations=6.'''
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ROUTES or not weight.isdigit():
+            raise ValueError(f'Неверная доля операции: {part}.')
+        weights[name] = int(weight)
+    return weights
+
+
+def histogram(latencies_ms: np.ndarray) -> dict[str, int]:
+    '''Число запросов в каждом интервале задержек.'''
+    edges = np.searchsorted(HISTOGRAM_BOUNDS_MS, latencies_ms)
+    counts = np.bincount(edges, minlength=len(HISTOGRAM_BOUNDS_MS))
+    return {f'<={bound:g}ms' if bound != float('inf') else '>5000ms':
+            int(count)
+            for bound, count in zip(HISTOGRAM_BOUNDS_MS, counts)}
+
+
+def route_report(route: str, latencies: list[float],
+                 statuses: Counter) -> RouteReport:
+    latencies_ms = np.array(latencies) * 1000
+    return RouteReport(
+        route=route,
+        requests=len(latencies),
+        errors=sum(count for code, count in statuses.items()
+                   if not code.isdigit() or int(code) >= 500),
+        client_errors=sum(count for code, count in statuses.items()
+                          if code.isdigit() and 400 <= int(code) < 500),
+        statuses=dict(statuses),
+        latency_p50_ms=round(float(np.percentile(latencies_ms, 50)), 3),
+        latency_p90_ms=round(float(np.percentile(latencies_ms, 90)), 3),
+        latency_p99_ms=round(float(np.percentile(latencies_ms, 99)), 3),
+        latency_max_ms=round(float(latencies_ms.max()), 3),
+        histogram=histogram(latencies_ms))
+
+
+class LoadTest:
+    '''
+    Нагрузка на приложение без сервера и сети.
+
+    Запросы идут в приложение через httpx.ASGITransport, как в
+    тестах; каждый из clients клиентов отправляет следующий запрос
+    сразу после ответа на предыдущий.
+    '''
+
+    def __init__(self, client: AsyncClient, users: list, items: list,
+                 mix: dict[str, int], seed: int = 0):
+        self.client = client
+        self.users = users
+        self.items = items
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.random = random.Random(seed)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, Counter] = defaultdict(Counter)
+
+    async def request(self, operation: str):
+        user_id = str(self.random.choice(self.users))
+        if operation == 'purchase':
+            cart = self.random.sample(self.items,
+                                      min(self.random.randint(1, 3),
+                                          len(self.items)))
+            return await self.client.post('/purchases', json={
+                'user_id': user_id,
+                'cart': [{'id': str(item_id), 'category': category}
+                         for item_id, category in cart]})
+        if operation == 'generate':
+            return await self.client.post('/generate_recommendations',
+                                          json={'user_id': user_id})
+        return await self.client.get('/recommendations',
+                                     params={'user_id': user_id})
+
+    async def worker(self, deadline: float, budget: list[int]) -> None:
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            operation = self.random.choices(self.operations,
+                                            self.weights)[0]
+            started = time.perf_counter()
+            try:
+                response = await self.request(operation)
+                status = str(response.status_code)
+            except Exception:
+                status = 'error'
+            route = ROUTES[operation]
+            self.latencies[route].append(time.perf_counter() - started)
+            self.statuses[route][status] += 1
+
+    async def run(self, clients: int, requests: int,
+                  duration: Optional[float] = None) -> LoadReport:
+        '''
+        Запускает нагрузку до requests запросов или duration секунд.
+        '''
+        started = time.perf_counter()
+        deadline = started + duration if duration else float('inf')
+        budget = [requests]
+        await asyncio.gather(*(self.worker(deadline, budget)
+                               for _ in range(clients)))
+        seconds = time.perf_counter() - started
+
+        routes = [route_report(route, self.latencies[route],
+                               self.statuses[route])
+                  for route in ROUTES.values() if self.latencies[route]]
+        total = sum(route.requests for route in routes)
+        return LoadReport(
+            clients=clients, requests=total,
+            errors=sum(route.errors for route in routes),
+            seconds=round(seconds, 3),
+            requests_per_sec=round(total / seconds, 1) if seconds else 0.0,
+            routes=routes)
+
+
+async def run_load_test(clients: int, requests: int,
+                        duration: Optional[float] = None,
+                        mix: Optional[dict[str, int]] = None,
+                        url: Optional[str] = None,
+                        dataset: tuple[int, int, int] = (1_000, 500, 20_000),
+                        seed: int = 0,
+                        progress: Callable[[str], None] = lambda line: None
+                        ) -> LoadReport:
+    '''
+    Нагрузочный тест приложения на заполненной синтетической базе.
+
+    По умолчанию база - временный файл SQLite, либо база url
+    (все таблицы в ней будут удалены).
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        url = url or (f'sqlite+aiosqlite:///'
+                      f'{os.path.join(directory, "loadtest.db")}')
+        engine = create_async_engine(url, **engine_options(url))
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+        async def override_get_db() -> AsyncGenerator[AsyncSession, None]:
+            async with session_factory() as session:
+                yield session
+
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Model.metadata.drop_all)
+                await conn.run_sync(Model.metadata.create_all)
+            users, items, purchases = dataset
+            async with session_factory() as session:
+                stats = await generate_dataset(session, users, items,
+                                               purchases, seed=seed)
+                progress(f'Данные созданы за {stats.seconds} с')
+                user_ids = (await session.scalars(select(User.id))).all()
+                item_rows = (await session.execute(
+                    select(Item.id, Item.category))).all()
+
+            app.dependency_overrides[get_db] = override_get_db
+            async with AsyncClient(transport=ASGITransport(app=app),
+                                   base_url='http://loadtest') as client:
+                load_test = LoadTest(client, user_ids,
+                                     [tuple(row) for row in item_rows],
+                                     mix or DEFAULT_MIX, seed)
+                return await load_test.run(clients, requests, duration)
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            await engine.dispose()
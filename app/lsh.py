@@ -0,0 +1,229 @@
+import asyncio
+import os
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from scipy import sparse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.recommender import Interactions, RecommendationEngine
+from app.utils import load_interactions
+
+load_dotenv()
+# Число полос и строк в полосе индекса LSH. Пользователи со сходством
+# Жаккара s попадают в одну корзину хотя бы одной полосы
+# с вероятностью 1 - (1 - s ** rows) ** bands: больше полос - выше
+# полнота, больше строк - меньше кандидатов.
+LSH_BANDS = int(os.getenv('LSH_BANDS', '32'))
+LSH_ROWS = int(os.getenv('LSH_ROWS', '2'))
+# Сколько самых похожих пользователей учитывается в режиме lsh.
+LSH_SIMILAR_USERS = int(os.getenv('LSH_SIMILAR_USERS', '100'))
+# Сколько пользователей берется из одной корзины: корзины
+# покупателей самых популярных товаров бывают огромными.
+LSH_MAX_BUCKET = int(os.getenv('LSH_MAX_BUCKET', '1000'))
+# Через сколько секунд индекс строится заново по новым покупкам.
+LSH_INDEX_TTL = float(os.getenv('LSH_INDEX_TTL', '300'))
+# Сколько пользователей обрабатывается за раз при расчете сигнатур.
+SIGNATURE_CHUNK_SIZE = 10_000
+# Простое число Мерсенна для хеш-функций вида (a * x + b) mod p.
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class MinHashLSH:
+    '''
+    Индекс LSH по MinHash-сигнатурам множеств купленных товаров.
+
+    Сигнатура пользователя - минимумы bands * rows хеш-функций
+    по его товарам. Сигнатура режется на полосы, пользователи
+    с совпадающей полосой попадают в одну корзину; кандидаты
+    в похожие - объединение корзин пользователя, поэтому поиск
+    не перебирает всех пользователей.
+    '''
+
+    def __init__(self, bands: int = LSH_BANDS, rows: int = LSH_ROWS,
+                 seed: int = 0, max_bucket: int = LSH_MAX_BUCKET):
+        self.bands = bands
+        self.rows = rows
+        self.max_bucket = max_bucket
+        rng = np.random.default_rng(seed)
+        size = bands * rows
+        self._a = rng.integers(1, MERSENNE_PRIME, size=size, dtype=np.int64)
+        self._b = rng.integers(0, MERSENNE_PRIME, size=size, dtype=np.int64)
+        self.binary: Optional[sparse.csr_matrix] = None
+        # Для каждой полосы: корзина пользователя, пользователи,
+        # упорядоченные по корзине, и начала корзин в этом порядке.
+        self._buckets: list[np.ndarray] = []
+        self._order: list[np.ndarray] = []
+        self._offsets: list[np.ndarray] = []
+
+    def signatures_for(self, binary: sparse.csr_matrix,
+                       hashes: slice = slice(None)) -> np.ndarray:
+        '''
+        MinHash-сигнатуры строк матрицы по хеш-функциям из среза
+        hashes; у пустых строк - p.
+
+        Хеши считаются по порциям пользователей и только для их
+        покупок, таблица хешей всех товаров не строится.
+        '''
+        a, b = self._a[hashes], self._b[hashes]
+        signatures = np.full((binary.shape[0], a.size), MERSENNE_PRIME,
+                             dtype=np.int64)
+        for start in range(0, binary.shape[0], SIGNATURE_CHUNK_SIZE):
+            chunk = binary[start:start + SIGNATURE_CHUNK_SIZE]
+            filled = np.flatnonzero(np.diff(chunk.indptr))
+            if filled.size:
+                items = chunk.indices.astype(np.int64)[:, None]
+                values = (items * a + b) % MERSENNE_PRIME
+                signatures[start + filled] = np.minimum.reduceat(
+                    values, chunk.indptr[filled], axis=0)
+        return signatures
+
+    def fit(self, binary: sparse.csr_matrix) -> 'MinHashLSH':
+        '''
+        Строит индекс по матрице покупок пользователь x товар (0/1).
+
+        Сигнатуры считаются по одной полосе и после разбиения
+        на корзины не хранятся; матрица binary нужна similar для
+        точного сходства.
+        '''
+        self.binary = binary
+        empty = np.diff(binary.indptr) == 0
+        self._buckets, self._order, self._offsets = [], [], []
+        for band in range(self.bands):
+            keys = self.signatures_for(
+                binary, slice(band * self.rows, (band + 1) * self.rows))
+            _, buckets = np.unique(keys, axis=0, return_inverse=True)
+            buckets = buckets.ravel()
+            # Пользователи без покупок не попадают ни в одну корзину
+            buckets[empty] = -1
+            order = np.argsort(buckets, kind='stable')
+            offsets = np.searchsorted(buckets[order],
+                                      np.arange(buckets.max() + 2))
+            self._buckets.append(buckets)
+            self._order.append(order)
+            self._offsets.append(offsets)
+        return self
+
+    def candidates(self, code: int) -> np.ndarray:
+        '''Пользователи, совпавшие с code хотя бы в одной полосе.'''
+        found = []
+        for buckets, order, offsets in zip(self._buckets, self._order,
+                                           self._offsets):
+            bucket = buckets[code]
+            if bucket < 0:
+                continue
+            start = offsets[bucket]
+            end = min(offsets[bucket + 1], start + self.max_bucket)
+            found.append(order[start:end])
+        if not found:
+            return np.array([], dtype=np.int64)
+        candidates = np.unique(np.concatenate(found))
+        return candidates[candidates != code]
+
+    def similar(self, code: int, m: int = LSH_SIMILAR_USERS) -> np.ndarray:
+        '''
+        До m самых похожих на code пользователей среди кандидатов.
+
+        Кандидаты упорядочиваются по точному сходству Жаккара,
+        пользователи без общих покупок отбрасываются.
+        '''
+        candidates = self.candidates(code)
+        if candidates.size == 0:
+            return candidates
+        shared = np.asarray(
+            (self.binary[candidates] @ self.binary[code].T).todense()
+        ).ravel()
+        sizes = np.diff(self.binary.indptr)
+        jaccard = shared / (sizes[candidates] + sizes[code] - shared)
+        keep = shared > 0
+        candidates, jaccard = candidates[keep], jaccard[keep]
+        order = np.lexsort((candidates, -jaccard))[:m]
+        return candidates[order]
+
+
+def exact_similar(binary: sparse.csr_matrix, code: int,
+                  m: int = LSH_SIMILAR_USERS) -> np.ndarray:
+    '''До m самых похожих по Жаккару пользователей полным перебором.'''
+    shared = np.asarray((binary @ binary[code].T).todense()).ravel()
+    sizes = np.diff(binary.indptr)
+    shared[code] = 0
+    candidates = np.flatnonzero(shared)
+    union = sizes[candidates] + sizes[code] - shared[candidates]
+    jaccard = shared[candidates] / union
+    order = np.lexsort((candidates, -jaccard))[:m]
+    return candidates[order]
+
+
+def build_user_index(user_codes: np.ndarray, item_codes: np.ndarray,
+                     shape: tuple[int, int], bands: int = LSH_BANDS,
+                     rows: int = LSH_ROWS
+                     ) -> tuple[RecommendationEngine, MinHashLSH]:
+    '''Матрица покупок и индекс LSH по ней, см. score_user.'''
+    engine = RecommendationEngine(user_codes, item_codes, shape)
+    lsh = MinHashLSH(bands, rows).fit(engine.binary)
+    return engine, lsh
+
+
+class UserIndex(NamedTuple):
+    '''Построенный индекс LSH вместе с матрицей и кодами пользователей.'''
+    interactions: Interactions
+    engine: RecommendationEngine
+    lsh: MinHashLSH
+    expires: float
+
+
+class LSHIndexCache:
+    '''
+    Индекс LSH в памяти процесса.
+
+    Индекс строится по всей истории покупок и живет ttl секунд;
+    покупки, сделанные после построения, учитываются при следующем.
+    Строит его только один запрос, остальные ждут готовый индекс.
+    '''
+
+    def __init__(self, ttl: float = LSH_INDEX_TTL):
+        self.ttl = ttl
+        self._index: Optional[UserIndex] = None
+        self._locks: dict = {}
+
+    def _expired(self) -> bool:
+        return self._index is None or self._index.expires < time.monotonic()
+
+    def _get_lock(self) -> asyncio.Lock:
+        # Блокировка привязана к циклу событий, поэтому своя для
+        # каждого цикла.
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            self._locks.clear()
+            lock = self._locks[loop] = asyncio.Lock()
+        return lock
+
+    async def get(self, session: AsyncSession) -> UserIndex:
+        '''
+        Текущий индекс, при необходимости строит его заново.
+
+        Как и матрица режима matrix, индекс строится в потоке,
+        без ограничения RECOMMENDATION_TIMEOUT и копирования из пула.
+        '''
+        if not self._expired():
+            return self._index
+        async with self._get_lock():
+            if not self._expired():
+                return self._index
+            interactions = await load_interactions(session)
+            engine, lsh = await asyncio.to_thread(
+                build_user_index, interactions.user_codes,
+                interactions.item_codes, interactions.shape,
+                LSH_BANDS, LSH_ROWS)
+            self._index = UserIndex(interactions, engine, lsh,
+                                    time.monotonic() + self.ttl)
+            return self._index
+
+    def clear(self) -> None:
+        self._index = None
+
+
+lsh_index_cache = LSHIndexCache()
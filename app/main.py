@@ -2,17 +2,27 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from app.db import create_table, delete_tables
-from app.routers import (gen_recommendation_router, item_router,
+from app.db import create_table, db_session, delete_tables
+from app.executor import shutdown_executor
+from app.jobs import recommendation_jobs
+from app.metrics import MetricsMiddleware
+from app.partitions import ensure_partitions
+from app.routers import (admin_router, gen_recommendation_router,
+                         internal_router, item_router, metrics_router,
                          purchase_router, recommendation_router, user_router)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_table()
+    async with db_session() as session:
+        await ensure_partitions(session)
+    recommendation_jobs.start(db_session)
     print('start')
     yield
     # await delete_tables()
+    await recommendation_jobs.stop()
+    shutdown_executor()
     print('end')
 
 app = FastAPI(lifespan=lifespan)
@@ -23,3 +33,7 @@ app.include_router(item_router)
 app.include_router(purchase_router)
 app.include_router(recommendation_router)
 app.include_router(gen_recommendation_router)
+app.include_router(admin_router)
+app.include_router(internal_router)
+app.include_router(metrics_router)
+app.add_middleware(MetricsMiddleware)
@@ -0,0 +1,269 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.query_budget import (QUERY_BUDGET_LOG_STATEMENTS, check_query_budget,
+                              get_query_budget)
+
+# Границы интервалов гистограмм по умолчанию, секунды.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    '''Метрика с набором меток в текстовом формате Prometheus.'''
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield (f'{self.name}{_format_labels(self.labelnames, key)} '
+                   f'{value}')
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}',
+                          f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    '''Счетчик, который только растет.'''
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''Текущее значение.'''
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    '''Распределение значений по интервалам, сумма и число наблюдений.'''
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key,
+                                        f'le="{bound:g}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f'{self.name}_bucket{labels} {count}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+REGISTRY: list[Metric] = []
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Время обработки запроса.',
+    ('method', 'route', 'status'))
+HTTP_REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Число запросов к базе за один запрос.',
+    ('method', 'route'), QUERY_COUNT_BUCKETS)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Время запросов к базе за один запрос.',
+    ('method', 'route'))
+DB_QUERY_SECONDS = Histogram(
+    'db_query_duration_seconds', 'Время выполнения запроса к базе.')
+DB_POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds', 'Время ожидания соединения из пула.')
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total', 'Соединение не получено за отведенное время.')
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Соединения пула по состояниям.', ('state',))
+QUERY_BUDGET_EXCEEDED = Counter(
+    'query_budget_exceeded_total',
+    'Запросы к API, превысившие бюджет запросов к базе.', ('route',))
+RECOMMENDATION_PHASE_SECONDS = Histogram(
+    'recommendation_phase_seconds', 'Время этапов генерации рекомендации.',
+    ('mode', 'phase'))
+
+
+class RequestStats:
+    '''Запросы к базе в рамках одного HTTP-запроса или блока кода.'''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        # Первые запросы, для сообщения о превышении бюджета.
+        self.statements: list[str] = []
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    'request_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    DB_QUERY_SECONDS.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+        if len(stats.statements) < QUERY_BUDGET_LOG_STATEMENTS:
+            stats.statements.append(statement)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    '''Подключает замер запросов к базе через события движка.'''
+    sync_engine = engine.sync_engine
+    if not event.contains(sync_engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(sync_engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(sync_engine, 'after_cursor_execute',
+                     _after_cursor_execute)
+
+
+@contextmanager
+def track_queries() -> Iterator[RequestStats]:
+    '''
+    Считает запросы к базе внутри блока, например в фоновой задаче.
+
+    Учитываются только движки, подключенные через instrument_engine.
+    '''
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+@contextmanager
+def phase_timer(mode: str, phase: str) -> Iterator[None]:
+    '''Замеряет этап генерации рекомендации.'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        RECOMMENDATION_PHASE_SECONDS.observe(time.perf_counter() - started,
+                                             mode=mode, phase=phase)
+
+
+class MetricsMiddleware:
+    '''
+    ASGI-промежуточный слой: время обработки запросов и запросы к базе.
+
+    Маршрут берется из шаблона пути (/items/{item_id}), чтобы
+    число рядов метрики не зависело от значений id. Число запросов
+    к базе сверяется с бюджетом маршрута до начала ответа, поэтому
+    в режиме raise клиент получает ошибку, а не 200. Запросы,
+    выполненные при потоковой отдаче тела, проверяются после ответа
+    и только записываются в лог.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = ['500']
+        # Число запросов на момент проверки бюджета, None - проверки
+        # еще не было.
+        checked = [None]
+
+        def check_budget(can_raise: bool) -> None:
+            route = getattr(scope.get('route'), 'path', 'other')
+            checked[0] = stats.queries
+            if not check_query_budget(
+                    f'{scope["method"]} {route}', get_query_budget(scope),
+                    stats.queries, stats.statements, can_raise):
+                QUERY_BUDGET_EXCEEDED.inc(route=route)
+                # Превышение уже учтено, повторно не проверяем.
+                checked[0] = float('inf')
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                check_budget(can_raise=True)
+                status[0] = str(message['status'])
+            await send(message)
+
+        started = time.perf_counter()
+        with track_queries() as stats:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                elapsed = time.perf_counter() - started
+                route = getattr(scope.get('route'), 'path', 'other')
+                method = scope['method']
+                HTTP_REQUEST_SECONDS.observe(elapsed, method=method,
+                                             route=route, status=status[0])
+                HTTP_REQUEST_QUERIES.observe(stats.queries, method=method,
+                                             route=route)
+                HTTP_REQUEST_DB_SECONDS.observe(stats.seconds, method=method,
+                                                route=route)
+        if checked[0] is not None and stats.queries > checked[0]:
+            check_budget(can_raise=False)
+
+
+def render() -> str:
+    '''Все метрики в текстовом формате Prometheus.'''
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
@@ -1,10 +1,14 @@
 import uuid
 
-from sqlalchemy import DateTime, ForeignKey, String, func
+from sqlalchemy import (DateTime, Float, ForeignKey, Index, Integer, String,
+                        UniqueConstraint, func)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
+# Связи не загружаются неявно: обращение к незагруженной связи
+# вызывает ошибку, а каждый запрос сам указывает, что ему нужно
+# (selectinload, joinedload или выборка отдельных столбцов).
 class Model(DeclarativeBase):
     pass
 
@@ -25,10 +29,12 @@ class User(UUIDModelBase):
                                           nullable=False)
 
     recommendations: Mapped[list['Recommendation']] = relationship(
-        lazy='selectin', back_populates='user', cascade='all, delete-orphan'
+        lazy='raise', back_populates='user', cascade='all, delete-orphan',
+        passive_deletes=True
     )
     purchases: Mapped[list['UserPurchase']] = relationship(
-        lazy='selectin', back_populates='user', cascade='all, delete-orphan'
+        lazy='raise', back_populates='user', cascade='all, delete-orphan',
+        passive_deletes=True
     )
 
     def __repr__(self) -> str:
@@ -43,10 +49,12 @@ class Item(UUIDModelBase):
     category: Mapped[str] = mapped_column(String(40), nullable=False)
 
     purchases: Mapped[list['UserPurchase']] = relationship(
-        lazy='selectin', back_populates='item', cascade='all, delete-orphan'
+        lazy='raise', back_populates='item', cascade='all, delete-orphan',
+        passive_deletes=True
     )
     recommendations: Mapped[list['Recommendation']] = relationship(
-        lazy='selectin', back_populates='item', cascade='all, delete-orphan'
+        lazy='raise', back_populates='item', cascade='all, delete-orphan',
+        passive_deletes=True
     )
 
     def __repr__(self) -> str:
@@ -56,38 +64,124 @@ class Item(UUIDModelBase):
 class Recommendation(UUIDModelBase):
     '''Модель для рекомендаций.'''
     __tablename__ = 'recommendation'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'rank',
+                         name='uq_recommendation_user_rank'),
+        Index('ix_recommendation_item_id', 'item_id'),
+    )
 
     user_id: Mapped[UUID] = mapped_column(ForeignKey('user.id',
                                                      ondelete='CASCADE'))
     item_id: Mapped[UUID] = mapped_column(ForeignKey('item.id',
                                                      ondelete='CASCADE'))
+    score: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    rank: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    # Откуда рекомендация: personal, category или popular.
+    source: Mapped[str] = mapped_column(String(20), nullable=False,
+                                        default='personal')
 
-    user: Mapped['User'] = relationship(lazy='selectin',
+    user: Mapped['User'] = relationship(lazy='raise',
                                         back_populates='recommendations')
-    item: Mapped['Item'] = relationship(lazy='selectin',
+    item: Mapped['Item'] = relationship(lazy='raise',
                                         back_populates='recommendations')
 
     def __repr__(self) -> str:
-        return (f'Пользователю {self.user_id} '
-                f'можно порекомендовать {self.item_id}.')
+        return (f'Пользователю {self.user_id} можно порекомендовать '
+                f'{self.item_id} (место {self.rank}).')
 
 
 class UserPurchase(UUIDModelBase):
-    '''Модель для покупки пользователя.'''
+    '''
+    Модель для покупки пользователя.
+
+    На Postgres таблица секционирована по месяцам purchase_date
+    (см. app/partitions.py), поэтому дата входит в первичный ключ:
+    уникальность в секционированной таблице проверяется только
+    вместе с ключом секционирования.
+    '''
     __tablename__ = 'userpurchase'
+    __table_args__ = (
+        Index('ix_userpurchase_user_item', 'user_id', 'item_id'),
+        Index('ix_userpurchase_item_user', 'item_id', 'user_id'),
+        Index('ix_userpurchase_user_date', 'user_id', 'purchase_date'),
+        # Покупки за период читаются только из индекса.
+        Index('ix_userpurchase_date', 'purchase_date', 'user_id',
+              'item_id'),
+        # SQLite не секционирует таблицы, там id остается уникальным.
+        Index('ux_userpurchase_id', 'id', unique=True).ddl_if(
+            dialect='sqlite'),
+        {'postgresql_partition_by': 'RANGE (purchase_date)'},
+    )
 
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id: Mapped[UUID] = mapped_column(ForeignKey('user.id',
                                                      ondelete='CASCADE'))
     item_id: Mapped[UUID] = mapped_column(ForeignKey('item.id',
                                                      ondelete='CASCADE'))
     category: Mapped[str] = mapped_column(String(40), nullable=False)
-    purchase_date: Mapped[DateTime] = mapped_column(DateTime,
-                                                    default=func.now())
+    purchase_date: Mapped[DateTime] = mapped_column(
+        DateTime, primary_key=True, default=func.now())
 
-    user: Mapped['User'] = relationship(lazy='selectin',
+    user: Mapped['User'] = relationship(lazy='raise',
                                         back_populates='purchases')
-    item: Mapped['Item'] = relationship(lazy='selectin',
+    item: Mapped['Item'] = relationship(lazy='raise',
                                         back_populates='purchases')
 
     def __repr__(self) -> str:
         return f'{self.user_id} купил {self.item_id}'
+
+
+class ItemCooccurrence(Model):
+    '''
+    Модель для числа пользователей, купивших оба товара пары.
+
+    Для пары товара с самим собой хранится число его покупателей.
+    '''
+    __tablename__ = 'itemcooccurrence'
+
+    item_id: Mapped[UUID] = mapped_column(
+        ForeignKey('item.id', ondelete='CASCADE'), primary_key=True)
+    other_item_id: Mapped[UUID] = mapped_column(
+        ForeignKey('item.id', ondelete='CASCADE'), primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return (f'{self.item_id} и {self.other_item_id} '
+                f'купили {self.count} пользователей')
+
+
+class ItemNeighbour(Model):
+    '''
+    Модель для похожих товаров: для каждого товара хранятся его
+    ближайшие соседи по покупателям и мера сходства.
+    '''
+    __tablename__ = 'itemneighbour'
+
+    item_id: Mapped[UUID] = mapped_column(
+        ForeignKey('item.id', ondelete='CASCADE'), primary_key=True)
+    neighbour_id: Mapped[UUID] = mapped_column(
+        ForeignKey('item.id', ondelete='CASCADE'), primary_key=True)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+
+    def __repr__(self) -> str:
+        return (f'{self.neighbour_id} похож на {self.item_id} '
+                f'со сходством {self.score}')
+
+
+class ItemPopularity(Model):
+    '''
+    Модель для самых популярных товаров: по всем покупкам
+    (пустая категория) и внутри каждой категории.
+    '''
+    __tablename__ = 'itempopularity'
+
+    category: Mapped[str] = mapped_column(String(40), primary_key=True)
+    rank: Mapped[int] = mapped_column(Integer, primary_key=True)
+    item_id: Mapped[UUID] = mapped_column(
+        ForeignKey('item.id', ondelete='CASCADE'))
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return (f'{self.item_id} на {self.rank} месте в категории '
+                f'{self.category or "все товары"}')
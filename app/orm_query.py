@@ -1,16 +1,64 @@
+import datetime as dt
+import os
+import time
 import uuid
-from collections import Counter
+from functools import partial
+from typing import AsyncIterable, AsyncIterator, Callable, Optional, Union
 
+import numpy as np
 from fastapi import HTTPException
-from sqlalchemy import select
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import bindparam, delete, insert, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.cache import recommendation_cache
+from app.engine_cache import matrix_engine_cache
+from app.executor import run_cpu_bound
+from app.interning import item_interner, user_interner
+from app.lsh import LSH_SIMILAR_USERS, lsh_index_cache
+from app.metrics import RECOMMENDATION_PHASE_SECONDS, phase_timer
 from app.models import Item, Recommendation, User, UserPurchase
-from app.schemas import (ItemAdd, ItemRead, PurchaseAdd, PurchaseRead,
-                         RecommendationAdd, RecommendationRead, UserAdd,
+from app.recommender import (NO_NEW_ITEMS, NO_SIMILAR_USERS,
+                             NotEnoughDataError, decay_weights, score_rows,
+                             score_user, score_users)
+from app.schemas import (ItemAdd, ItemRead, PurchaseAdd, PurchaseBulkError,
+                         PurchaseBulkRead, PurchaseRead, RecommendationAdd,
+                         RecommendationBatchRead, RecommendationMode,
+                         RecommendationRead, RecommendationSource, UserAdd,
                          UserRead)
-from app.utils import get_purchases_dataframe
+from app.utils import (GLOBAL_CATEGORY, bump_cooccurrence,
+                       find_cooccurrence_items, find_neighbour_items,
+                       find_popular_items, find_recommended_items,
+                       has_cooccurring_users, has_similar_users, keyset_page,
+                       load_interactions, recent_purchases_query, stream_rows)
+
+RECOMMENDATION_MODE = RecommendationMode(
+    os.getenv('RECOMMENDATION_MODE', RecommendationMode.matrix.value))
+# Сколько лучших товаров сохраняется в рекомендациях пользователя.
+RECOMMENDATION_TOP_K = int(os.getenv('RECOMMENDATION_TOP_K', '10'))
+# Сколько похожих товаров хранится для каждого товара и мера сходства
+# (cosine или jaccard) для режима item.
+ITEM_NEIGHBOURS = int(os.getenv('ITEM_NEIGHBOURS', '50'))
+ITEM_SIMILARITY = os.getenv('ITEM_SIMILARITY', 'cosine')
+# Режим recent: за сколько последних дней учитываются покупки других
+# пользователей и за сколько дней вес покупки уменьшается вдвое.
+RECENT_WINDOW_DAYS = float(os.getenv('RECENT_WINDOW_DAYS', '90'))
+RECENT_HALF_LIFE_DAYS = float(os.getenv('RECENT_HALF_LIFE_DAYS', '30'))
+# Сколько популярных товаров хранится среди всех покупок и в каждой
+# категории для пользователей, которым нечего порекомендовать.
+POPULARITY_TOP_N = int(os.getenv('POPULARITY_TOP_N', '100'))
+# Сколько покупок добавляется в одной транзакции при пакетной загрузке.
+BULK_CHUNK_SIZE = int(os.getenv('PURCHASES_BULK_CHUNK_SIZE', '500'))
+
+
+def empty_result_error(has_similar: bool) -> HTTPException:
+    '''
+    Ошибка пустых рекомендаций: если схожие пользователи есть,
+    у них нет новых для пользователя товаров.
+    '''
+    return HTTPException(
+        status_code=400,
+        detail=NO_NEW_ITEMS if has_similar else NO_SIMILAR_USERS)
 
 
 class UserRepository:
@@ -29,6 +77,7 @@ class UserRepository:
             raise HTTPException(
                 status_code=400,
                 detail='Пользователь с таким именем уже существует.')
+        user_interner.add(new_user.id)
         return new_user.id
 
     @classmethod
@@ -45,9 +94,24 @@ class UserRepository:
         return UserRead.model_validate(user_model)
 
     @classmethod
-    async def get_all(cls, session: AsyncSession) -> list[UserRead]:
-        '''Возвращвет список всех пользователей.'''
-        query = select(User)
+    async def get_existing(cls, user_ids: list[uuid.UUID],
+                           session: AsyncSession) -> set[uuid.UUID]:
+        '''Возвращает id существующих пользователей одним запросом.'''
+        if not user_ids:
+            return set()
+        query = select(User.id).where(User.id.in_(set(user_ids)))
+        result = await session.execute(query)
+        return set(result.scalars().all())
+
+    @classmethod
+    async def get_all(cls, session: AsyncSession,
+                      limit: Optional[int] = None,
+                      after: Optional[uuid.UUID] = None) -> list[UserRead]:
+        '''
+        Возвращвет список пользователей: не больше limit
+        пользователей с id после after.
+        '''
+        query = keyset_page(select(User), User.id, after, limit)
         result = await session.execute(query)
         user_models = result.scalars().all()
         users = [UserRead.model_validate(
@@ -55,6 +119,16 @@ class UserRepository:
         ) for user_model in user_models]
         return users
 
+    @classmethod
+    def stream_all(cls, session: AsyncSession,
+                   limit: Optional[int] = None,
+                   after: Optional[uuid.UUID] = None
+                   ) -> AsyncIterator[UserRead]:
+        '''Отдает пользователей по одному, читая их порциями.'''
+        query = keyset_page(select(User.id, User.username), User.id,
+                            after, limit)
+        return stream_rows(session, query, UserRead)
+
 
 class ItemRepository:
     '''Методы для работы с товарами.'''
@@ -66,12 +140,18 @@ class ItemRepository:
         new_item = Item(**data)
         session.add(new_item)
         await session.commit()
+        item_interner.add(new_item.id)
         return new_item.id
 
     @classmethod
-    async def get_all(cls, session: AsyncSession) -> list[ItemRead]:
-        '''Возвращает список всех товаров.'''
-        query = select(Item)
+    async def get_all(cls, session: AsyncSession,
+                      limit: Optional[int] = None,
+                      after: Optional[uuid.UUID] = None) -> list[ItemRead]:
+        '''
+        Возвращает список товаров: не больше limit
+        товаров с id после after.
+        '''
+        query = keyset_page(select(Item), Item.id, after, limit)
         result = await session.execute(query)
         item_models = result.scalars().all()
         items = [ItemRead.model_validate(
@@ -79,6 +159,16 @@ class ItemRepository:
         ) for item_model in item_models]
         return items
 
+    @classmethod
+    def stream_all(cls, session: AsyncSession,
+                   limit: Optional[int] = None,
+                   after: Optional[uuid.UUID] = None
+                   ) -> AsyncIterator[ItemRead]:
+        '''Отдает товары по одному, читая их порциями.'''
+        query = keyset_page(select(Item.id, Item.name, Item.category),
+                            Item.id, after, limit)
+        return stream_rows(session, query, ItemRead)
+
     @classmethod
     async def get_item(cls, item_id: uuid.UUID,
                        session: AsyncSession) -> ItemRead:
@@ -92,38 +182,169 @@ class ItemRepository:
                                 detail=f'Товар {item_id} не найден.')
         return ItemRead.model_validate(item_model)
 
+    @classmethod
+    async def get_categories(cls, item_ids: list[uuid.UUID],
+                             session: AsyncSession) -> dict[uuid.UUID, str]:
+        '''Возвращает категории товаров одним запросом.'''
+        if not item_ids:
+            return {}
+        query = select(Item.id, Item.category).where(
+            Item.id.in_(set(item_ids)))
+        result = await session.execute(query)
+        return dict(result.all())
+
 
 class PurchaseRepository:
     '''Методы для работы с покупками.'''
 
     @classmethod
-    async def add_purchase(cls, purchase: PurchaseAdd,
-                           session: AsyncSession) -> str:
-        '''Создание новой покупки.'''
+    def check_cart(cls, purchase: PurchaseAdd,
+                   categories: dict[uuid.UUID, str]) -> None:
+        '''Проверяет, что товары покупки существуют и их категории верны.'''
         for item in purchase.cart:
-            exist_item = await ItemRepository.get_item(item.id, session)
-            if exist_item.category != item.category:
+            category = categories.get(item.id)
+            if category is None:
+                raise HTTPException(status_code=404,
+                                    detail=f'Товар {item.id} не найден.')
+            if category != item.category:
                 raise HTTPException(
                     status_code=400,
                     detail=(f'Категория не соответствует товару. '
                             f'Категория товара {item.id} - '
-                            f'{exist_item.category}'))
+                            f'{category}'))
 
-            new_purchase = UserPurchase(
-                user_id=purchase.user_id,
-                item_id=item.id,
-                category=item.category
-            )
-            session.add(new_purchase)
+    @classmethod
+    async def insert_purchases(cls, purchases: list[PurchaseAdd],
+                               session: AsyncSession) -> None:
+        '''
+        Добавляет проверенные покупки одним многострочным INSERT
+        и обновляет совместные покупки. Транзакцию не завершает.
+        '''
+        rows = [{'id': uuid.uuid4(), 'user_id': purchase.user_id,
+                 'item_id': item.id, 'category': item.category}
+                for purchase in purchases for item in purchase.cart]
+        if not rows:
+            return
+        await bump_cooccurrence(
+            [(purchase.user_id, [item.id for item in purchase.cart])
+             for purchase in purchases], session)
+        await session.execute(insert(UserPurchase).values(rows))
 
+    @classmethod
+    def purchases_committed(cls, purchases: list[PurchaseAdd]) -> None:
+        '''Дописывает сохраненные покупки в матрицу покупок процесса.'''
+        matrix_engine_cache.add_purchases(
+            [(purchase.user_id, item.id)
+             for purchase in purchases for item in purchase.cart])
+
+    @classmethod
+    async def add_purchase(cls, purchase: PurchaseAdd,
+                           session: AsyncSession) -> str:
+        '''Создание новой покупки.'''
+        categories = await ItemRepository.get_categories(
+            [item.id for item in purchase.cart], session)
+        cls.check_cart(purchase, categories)
+
+        await cls.insert_purchases([purchase], session)
         await session.commit()
+        cls.purchases_committed([purchase])
+        await recommendation_cache.delete(purchase.user_id)
         return (f'Покупка для пользователя '
                 f'{purchase.user_id} успешно добавлена.')
 
     @classmethod
-    async def get_all(cls, session: AsyncSession) -> list[PurchaseRead]:
-        '''Возвращает список всех покупок.'''
-        query = select(UserPurchase)
+    async def add_purchases_bulk(
+        cls, purchases: AsyncIterable[Union[PurchaseAdd, PurchaseBulkError]],
+        session: AsyncSession, chunk_size: int = BULK_CHUNK_SIZE
+    ) -> PurchaseBulkRead:
+        '''
+        Пакетное добавление покупок.
+
+        Покупки читаются из потока порциями по chunk_size, каждая
+        порция - отдельная транзакция с одним запросом проверки
+        товаров. Ошибочные покупки не добавляются и попадают в отчет
+        вместе с номером строки; ошибки разбора тела передаются
+        сюда уже готовыми.
+        '''
+        errors = []
+        accepted = 0
+        chunk = []
+        index = 0
+        async for purchase in purchases:
+            chunk.append((index, purchase))
+            index += 1
+            if len(chunk) == chunk_size:
+                accepted += await cls.add_purchases_chunk(chunk, errors,
+                                                          session)
+                chunk = []
+        if chunk:
+            accepted += await cls.add_purchases_chunk(chunk, errors, session)
+
+        errors.sort(key=lambda error: error.index)
+        return PurchaseBulkRead(accepted=accepted, rejected=len(errors),
+                                errors=errors)
+
+    @classmethod
+    async def add_purchases_chunk(
+        cls, chunk: list[tuple[int, Union[PurchaseAdd, PurchaseBulkError]]],
+        errors: list[PurchaseBulkError], session: AsyncSession
+    ) -> int:
+        '''
+        Добавляет одну порцию пакетной загрузки.
+
+        Ошибки порции дописываются в errors, возвращается число
+        добавленных покупок.
+        '''
+        errors.extend(row for _, row in chunk
+                      if isinstance(row, PurchaseBulkError))
+        chunk = [(index, row) for index, row in chunk
+                 if isinstance(row, PurchaseAdd)]
+        categories = await ItemRepository.get_categories(
+            [item.id for _, purchase in chunk for item in purchase.cart],
+            session)
+        users = await UserRepository.get_existing(
+            [purchase.user_id for _, purchase in chunk], session)
+
+        valid = []
+        for index, purchase in chunk:
+            try:
+                if purchase.user_id not in users:
+                    raise HTTPException(
+                        status_code=404,
+                        detail='Пользователь не существует.')
+                cls.check_cart(purchase, categories)
+            except HTTPException as error:
+                errors.append(PurchaseBulkError(index=index,
+                                                detail=error.detail))
+            else:
+                valid.append((index, purchase))
+
+        try:
+            await cls.insert_purchases(
+                [purchase for _, purchase in valid], session)
+            await session.commit()
+        except SQLAlchemyError as error:
+            await session.rollback()
+            detail = str(getattr(error, 'orig', None) or error)
+            errors.extend(PurchaseBulkError(index=index, detail=detail)
+                          for index, _ in valid)
+            return 0
+        cls.purchases_committed([purchase for _, purchase in valid])
+        await recommendation_cache.delete(
+            *{purchase.user_id for _, purchase in valid})
+        return len(valid)
+
+    @classmethod
+    async def get_all(
+        cls, session: AsyncSession, limit: Optional[int] = None,
+        after: Optional[uuid.UUID] = None
+    ) -> list[PurchaseRead]:
+        '''
+        Возвращает список покупок: не больше limit
+        покупок с id после after.
+        '''
+        query = keyset_page(select(UserPurchase), UserPurchase.id, after,
+                            limit)
         result = await session.execute(query)
         purchase_models = result.scalars().all()
         purchases = [PurchaseRead.model_validate(
@@ -131,6 +352,19 @@ class PurchaseRepository:
         ) for purchase_model in purchase_models]
         return purchases
 
+    @classmethod
+    def stream_all(cls, session: AsyncSession,
+                   limit: Optional[int] = None,
+                   after: Optional[uuid.UUID] = None
+                   ) -> AsyncIterator[PurchaseRead]:
+        '''Отдает покупки по одной, читая их порциями.'''
+        query = keyset_page(
+            select(UserPurchase.id, UserPurchase.user_id,
+                   UserPurchase.item_id, UserPurchase.category,
+                   UserPurchase.purchase_date),
+            UserPurchase.id, after, limit)
+        return stream_rows(session, query, PurchaseRead)
+
     @classmethod
     async def get_user_purchases(cls, user_id: uuid.UUID,
                                  session: AsyncSession) -> list[PurchaseRead]:
@@ -153,74 +387,294 @@ class RecommendRepository:
     '''Класс для работы с рекомендациями.'''
 
     @classmethod
-    async def get_recommendation(cls, user_id: uuid.UUID,
-                                 session: AsyncSession) -> RecommendationRead:
-        '''Возвращает рекомендацию.'''
-        query = select(Recommendation).where(Recommendation.user_id == user_id)
-        result = await session.execute(query)
-        recom_model = result.scalar_one_or_none()
+    async def get_recommendation(
+        cls, user_id: uuid.UUID, session: AsyncSession,
+        limit: Optional[int] = None, offset: int = 0
+    ) -> list[RecommendationRead]:
+        '''
+        Возвращает список рекомендаций по порядку, сначала из кэша.
+
+        Кэшируется весь список пользователя, он не длиннее
+        RECOMMENDATION_TOP_K и читается из базы одним диапазоном индекса.
+        '''
+        recommendations = await recommendation_cache.get(user_id)
+        if recommendations is None:
+            query = select(Recommendation).where(
+                Recommendation.user_id == user_id
+            ).order_by(Recommendation.rank)
+            result = await session.execute(query)
+            recommendations = [RecommendationRead.model_validate(recom_model)
+                               for recom_model in result.scalars().all()]
+            if not recommendations:
+                raise HTTPException(status_code=404,
+                                    detail='Нет рекомендаций.')
+            await recommendation_cache.set(user_id, recommendations)
+
+        if limit is None:
+            return recommendations[offset:]
+        return recommendations[offset:offset + limit]
+
+    @classmethod
+    async def rank_items(cls, user_id: uuid.UUID, mode: RecommendationMode,
+                         session: AsyncSession,
+                         k: int = 1) -> list[tuple[uuid.UUID, float]]:
+        '''Возвращает k самых популярных товаров для пользователя.'''
+        rankers = {
+            RecommendationMode.sql: partial(
+                cls.rank_items_query, RecommendationMode.sql,
+                find_recommended_items, has_similar_users),
+            RecommendationMode.cooccurrence: partial(
+                cls.rank_items_query, RecommendationMode.cooccurrence,
+                find_cooccurrence_items, has_cooccurring_users),
+            RecommendationMode.item: partial(
+                cls.rank_items_query, RecommendationMode.item,
+                find_neighbour_items, has_similar_users),
+            RecommendationMode.matrix: cls.rank_items_matrix,
+            RecommendationMode.lsh: cls.rank_items_lsh,
+            RecommendationMode.recent: cls.rank_items_recent,
+        }
+        return await rankers[RecommendationMode(mode)](user_id, session, k)
+
+    @classmethod
+    async def rank_items_query(
+        cls, mode: RecommendationMode, find_items: Callable,
+        has_similar: Callable, user_id: uuid.UUID, session: AsyncSession,
+        k: int = 1
+    ) -> list[tuple[uuid.UUID, float]]:
+        '''
+        Рекомендации режимов sql, cooccurrence и item.
+
+        Поиск схожих пользователей и подсчет популярности - один
+        запрос find_items, он замеряется как этап counting. Если
+        товаров нет, has_similar выясняет причину.
+        '''
+        with phase_timer(mode.value, 'counting'):
+            recommended_items = await find_items(user_id, session, k)
+        if recommended_items:
+            return recommended_items
+        with phase_timer(mode.value, 'similar_users'):
+            similar = await has_similar(user_id, session)
+        raise empty_result_error(similar)
+
+    @classmethod
+    async def rank_items_recent(
+        cls, user_id: uuid.UUID, session: AsyncSession, k: int = 1
+    ) -> list[tuple[uuid.UUID, float]]:
+        '''
+        Как режим matrix, но по покупкам за последние
+        RECENT_WINDOW_DAYS дней с затуханием по давности.
+        '''
+        mode = RecommendationMode.recent.value
+        # Пользователя без общих покупок видно по индексу, не загружая
+        # покупки окна.
+        with phase_timer(mode, 'similar_users'):
+            similar = await has_similar_users(user_id, session)
+        if not similar:
+            raise empty_result_error(similar)
+        with phase_timer(mode, 'load'):
+            now = dt.datetime.now()
+            interactions = await load_interactions(
+                session, recent_purchases_query(
+                    user_id, now - dt.timedelta(days=RECENT_WINDOW_DAYS)),
+                with_dates=True)
+            weights = decay_weights(interactions.dates, np.datetime64(now),
+                                    RECENT_HALF_LIFE_DAYS)
+        try:
+            items, scores, timings = await run_cpu_bound(
+                score_user, interactions.user_codes, interactions.item_codes,
+                interactions.shape, interactions.user_code(user_id), k,
+                weights, interactions.items.ranks())
+        except NotEnoughDataError as error:
+            raise HTTPException(status_code=400, detail=error.detail)
+        # Этапы считаются в процессе пула, их время приходит с результатом
+        for phase, seconds in timings.items():
+            RECOMMENDATION_PHASE_SECONDS.observe(seconds, mode=mode,
+                                                 phase=phase)
+        return [(interactions.item_uuid(item), round(float(score), 6))
+                for item, score in zip(items, scores)]
+
+    @classmethod
+    async def rank_items_matrix(cls, user_id: uuid.UUID,
+                                session: AsyncSession,
+                                k: int = 1) -> list[tuple[uuid.UUID, int]]:
+        '''
+        Популярность товаров среди всех пользователей с общими
+        покупками по матрице покупок в памяти процесса.
+
+        Этап load обращается к базе только при построении матрицы,
+        в пул передаются лишь строки схожих пользователей.
+        '''
+        mode = RecommendationMode.matrix.value
+        with phase_timer(mode, 'load'):
+            engine = await matrix_engine_cache.get(session)
+        try:
+            with phase_timer(mode, 'similar_users'):
+                user_items, similar = engine.similar_users(
+                    user_interner.code(user_id))
+                if similar.size == 0:
+                    raise NotEnoughDataError(NO_SIMILAR_USERS)
+                rows = engine.user_rows(similar)
+            items, scores, timings = await run_cpu_bound(
+                score_rows, rows, user_items, k, item_interner.ranks())
+        except NotEnoughDataError as error:
+            raise HTTPException(status_code=400, detail=error.detail)
+        for phase, seconds in timings.items():
+            RECOMMENDATION_PHASE_SECONDS.observe(seconds, mode=mode,
+                                                 phase=phase)
+        return [(item_interner.uuid_of(item), int(score))
+                for item, score in zip(items, scores)]
 
-        if recom_model is None:
-            raise HTTPException(status_code=404, detail='Нет рекомендаций.')
-        return RecommendationRead(item_id=recom_model.item_id)
+    @classmethod
+    async def rank_items_lsh(cls, user_id: uuid.UUID, session: AsyncSession,
+                             k: int = 1) -> list[tuple[uuid.UUID, float]]:
+        '''
+        Как режим matrix, но схожие пользователи - до LSH_SIMILAR_USERS
+        самых похожих из кандидатов индекса LSH.
+
+        Индекс хранится в памяти процесса, поэтому этап load
+        обращается к базе только при его построении; в пул, как
+        и в режиме matrix, передаются лишь строки схожих пользователей.
+        '''
+        mode = RecommendationMode.lsh.value
+        with phase_timer(mode, 'load'):
+            index = await lsh_index_cache.get(session)
+        try:
+            with phase_timer(mode, 'similar_users'):
+                code = index.interactions.user_code(user_id)
+                user_items = index.engine.user_items(code)
+                similar = index.lsh.similar(code, LSH_SIMILAR_USERS)
+                if similar.size == 0:
+                    raise NotEnoughDataError(NO_SIMILAR_USERS)
+                rows = index.engine.user_rows(similar)
+            items, scores, timings = await run_cpu_bound(
+                score_rows, rows, user_items, k,
+                index.interactions.items.ranks())
+        except NotEnoughDataError as error:
+            raise HTTPException(status_code=400, detail=error.detail)
+        for phase, seconds in timings.items():
+            RECOMMENDATION_PHASE_SECONDS.observe(seconds, mode=mode,
+                                                 phase=phase)
+        return [(index.interactions.item_uuid(item), int(score))
+                for item, score in zip(items, scores)]
 
     @classmethod
     async def add_recommendation(cls, user: RecommendationAdd,
                                  session: AsyncSession) -> int:
         '''Создание рекомендации.'''
         exist_user = await UserRepository.get_user(user.user_id, session)
+        mode = RecommendationMode(user.mode or RECOMMENDATION_MODE)
 
-        df = await get_purchases_dataframe(
-            session,
-            select(UserPurchase)
-        )
-        # Ищем покупки пользователя
-        usr_ps = df[
-            df['user_id'] == str(exist_user.id)
-        ]['item_id'].tolist()
-
-        # Ищем пользователей со схожими покупками
-        similar_users = df[
-            df['item_id'].isin(usr_ps) & (df['user_id'] != str(exist_user.id))
-        ]
-        if similar_users.empty:
-            raise HTTPException(
-                status_code=400,
-                detail=('Недостаточно данных для составления рекомендации: '
-                        'нет пользователей со схожими покупками.'))
-        similar_users = similar_users['user_id'].tolist()
-
-        # Ищем покупки пользователей со схожим вкусом
-        users_purchases = df[
-            df['user_id'].isin(similar_users) & ~df['item_id'].isin(usr_ps)]
-        if users_purchases.empty:
-            raise HTTPException(
-                status_code=400,
-                detail=('Недостаточно данных для составления рекомендации: '
-                        'другие пользователи не покупали товары, не купленные'
-                        ' данным пользователем.'))
-
-        # Подсчитываем популярность полученных товаров
-        items = users_purchases['item_id'].tolist()
-        item_popularity = Counter(items)
-
-        # Получаем список товаров, отсортированных по популярности
-        recommended_items = [item for item, _ in item_popularity.most_common()]
+        try:
+            recommended_items = [
+                (item_id, score, RecommendationSource.personal.value)
+                for item_id, score in await cls.rank_items(
+                    exist_user.id, mode, session, RECOMMENDATION_TOP_K)]
+        except HTTPException as error:
+            if error.status_code != 400:
+                raise
+            # Для новых пользователей - заранее рассчитанные популярные
+            # товары; если они ещё не рассчитаны, остается ошибка.
+            with phase_timer(mode.value, 'fallback'):
+                recommended_items = [
+                    (item_id, score,
+                     RecommendationSource.popular.value
+                     if category == GLOBAL_CATEGORY
+                     else RecommendationSource.category.value)
+                    for item_id, score, category in await find_popular_items(
+                        exist_user.id, session, RECOMMENDATION_TOP_K)]
+            if not recommended_items:
+                raise
 
         if recommended_items:
-            # Возвращаем самый популярный товар для рекомендации
-            try:
-                recom = await cls.get_recommendation(exist_user.id,
-                                                     session)
-                if recom.item_id != recommended_items[0]:
-                    recom.item_id = recommended_items[0]
-                    await session.commit()
-            except HTTPException:
-                new_recom = Recommendation(
-                    user_id=exist_user.id,
-                    item_id=uuid.UUID(recommended_items[0]))
-                session.add(new_recom)
-                await session.commit()
+            # Сохраняем весь список товаров, отсортированных по популярности
+            rows = [{'user_id': exist_user.id, 'item_id': item_id,
+                     'score': score, 'rank': rank, 'source': source}
+                    for rank, (item_id, score, source)
+                    in enumerate(recommended_items, start=1)]
+            with phase_timer(mode.value, 'persist'):
+                await cls.replace_recommendations([exist_user.id], rows,
+                                                  session)
+                await recommendation_cache.set(
+                    exist_user.id,
+                    [RecommendationRead(**row) for row in rows])
             return 'Рекомендация успешно сгенерирована.'
         else:
             return ('Нет товаров для рекомендации. ')
+
+    @classmethod
+    async def replace_recommendations(cls, user_ids: list[uuid.UUID],
+                                      rows: list[dict],
+                                      session: AsyncSession) -> None:
+        '''
+        Заменяет списки рекомендаций пользователей в одной транзакции.
+
+        Старые списки удаляются одним запросом с параметрами
+        для каждого пользователя, поэтому число пользователей
+        не упирается в предел параметров одного запроса.
+        '''
+        if user_ids:
+            table = Recommendation.__table__
+            await session.execute(
+                delete(table).where(table.c.user_id == bindparam('user')),
+                [{'user': user_id} for user_id in user_ids])
+        if rows:
+            await session.execute(insert(Recommendation), rows)
+        await session.commit()
+
+    @classmethod
+    async def add_recommendations_batch(
+        cls, session: AsyncSession,
+        user_ids: Optional[list[uuid.UUID]] = None
+    ) -> RecommendationBatchRead:
+        '''
+        Пакетная генерация рекомендаций для всех или выбранных
+        пользователей.
+
+        Покупки загружаются один раз, рекомендации считаются матрично
+        и заменяются одной транзакцией. Заменяются только списки
+        пользователей, для которых рекомендации рассчитаны: у остальных
+        остаются прежние списки, в том числе популярные товары.
+        '''
+        started = time.perf_counter()
+        interactions = await load_interactions(session)
+
+        if user_ids is None:
+            # Пользователи с покупками; UUID нужны только для ответа
+            codes = np.unique(interactions.user_codes).tolist()
+            users = interactions.users.uuids_of(codes)
+        else:
+            users = list(dict.fromkeys(user_ids))
+            codes = interactions.users.codes(users).tolist()
+        known = [code for code in codes if code >= 0]
+        top, top_scores = await run_cpu_bound(
+            score_users, interactions.user_codes, interactions.item_codes,
+            interactions.shape, np.asarray(known, dtype=np.int64),
+            RECOMMENDATION_TOP_K, interactions.items.ranks())
+        positions = {code: position for position, code in enumerate(known)}
+
+        rows = []
+        generated = []
+        for user_id, code in zip(users, codes):
+            if code < 0 or top[positions[code], 0] < 0:
+                continue
+            generated.append(user_id)
+            found = top[positions[code]] >= 0
+            for rank, (item_id, score) in enumerate(
+                zip(interactions.items.uuids_of(top[positions[code]][found]),
+                    top_scores[positions[code]][found]),
+                start=1
+            ):
+                rows.append({'user_id': user_id, 'item_id': item_id,
+                             'score': int(score), 'rank': rank,
+                             'source': RecommendationSource.personal.value})
+
+        await cls.replace_recommendations(generated, rows, session)
+        await recommendation_cache.delete(*generated)
+
+        seconds = time.perf_counter() - started
+        return RecommendationBatchRead(
+            users=len(users),
+            generated=len(generated),
+            skipped=len(users) - len(generated),
+            seconds=round(seconds, 3),
+            users_per_sec=round(len(users) / seconds, 1) if seconds else 0.0)
@@ -0,0 +1,261 @@
+import datetime as dt
+import os
+import re
+from typing import Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from sqlalchemy import DateTime, Integer, TextClause, bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+load_dotenv()
+# Сколько последних месяцев покупок хранится в рабочей таблице,
+# более старые покупки переносятся в архив.
+PURCHASE_HOT_MONTHS = int(os.getenv('PURCHASE_HOT_MONTHS', '24'))
+# На сколько месяцев вперед заранее создаются секции покупок.
+PURCHASE_MONTHS_AHEAD = int(os.getenv('PURCHASE_MONTHS_AHEAD', '3'))
+PURCHASE_TABLE = 'userpurchase'
+# Секция Postgres для покупок, для месяца которых нет своей секции.
+DEFAULT_PARTITION = f'{PURCHASE_TABLE}_default'
+ARCHIVE_PREFIX = f'{PURCHASE_TABLE}_archive_'
+PERIOD_PATTERN = re.compile(r'_y(\d{4})m(\d{2})$')
+# Ключ рекомендательной блокировки Postgres на изменение секций.
+PARTITION_LOCK_KEY = 7_305_512_901
+
+
+class PartitionInfo(BaseModel):
+    '''Секция покупок за месяц или архивная таблица.'''
+    name: str
+    period: Optional[dt.date] = None
+    archived: bool = False
+    rows: int
+
+
+def month_start(value: dt.datetime) -> dt.datetime:
+    return dt.datetime(value.year, value.month, 1)
+
+
+def add_months(month: dt.datetime, months: int) -> dt.datetime:
+    '''Начало месяца, отстоящего от month на months месяцев.'''
+    index = month.year * 12 + month.month - 1 + months
+    return dt.datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: dt.datetime) -> str:
+    return f'{PURCHASE_TABLE}_y{month.year}m{month.month:02d}'
+
+
+def archive_name(month: dt.datetime) -> str:
+    return f'{ARCHIVE_PREFIX}y{month.year}m{month.month:02d}'
+
+
+def parse_period(name: str) -> Optional[dt.date]:
+    '''Месяц секции или архивной таблицы по её имени.'''
+    match = PERIOD_PATTERN.search(name)
+    if match is None:
+        return None
+    return dt.date(int(match[1]), int(match[2]), 1)
+
+
+def hot_start(hot_months: int = PURCHASE_HOT_MONTHS,
+              now: Optional[dt.datetime] = None) -> dt.datetime:
+    '''Первый месяц, покупки которого остаются в рабочей таблице.'''
+    return add_months(month_start(now or dt.datetime.now()),
+                      1 - hot_months)
+
+
+def _period_query(sql: str, month: dt.datetime) -> TextClause:
+    '''Запрос с параметрами start и end - границами месяца month.'''
+    return text(sql).bindparams(
+        bindparam('start', month, type_=DateTime),
+        bindparam('end', add_months(month, 1), type_=DateTime))
+
+
+def _is_postgres(session: AsyncSession) -> bool:
+    return session.bind.dialect.name == 'postgresql'
+
+
+async def _lock_partitions(session: AsyncSession) -> None:
+    '''
+    Блокирует изменение секций другими процессами до конца транзакции.
+
+    Секции проверяет каждый процесс приложения при запуске. Без
+    блокировки два процесса видят одни и те же недостающие секции,
+    и второй падает при их создании.
+    '''
+    await session.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                          {'key': PARTITION_LOCK_KEY})
+
+
+async def list_partitions(session: AsyncSession) -> list[PartitionInfo]:
+    '''
+    Секции таблицы покупок и архивные таблицы.
+
+    На Postgres число строк - оценка планировщика. SQLite не
+    секционирует таблицы: месяцы рабочей таблицы показываются
+    как её секции, строки считаются точно.
+    '''
+    partitions = []
+    if _is_postgres(session):
+        result = await session.execute(text(
+            'SELECT c.relname, c.reltuples, i.inhrelid IS NULL '
+            'FROM pg_class c LEFT JOIN pg_inherits i ON i.inhrelid = c.oid '
+            "WHERE pg_table_is_visible(c.oid) AND c.relkind = 'r' AND ("
+            'i.inhparent = (SELECT oid FROM pg_class WHERE relname = :table '
+            'AND pg_table_is_visible(oid)) '
+            "OR c.relname LIKE :archive ESCAPE '!')"
+        ), {'table': PURCHASE_TABLE,
+            'archive': ARCHIVE_PREFIX.replace('_', '!_') + '%'})
+        for name, rows, archived in result.all():
+            partitions.append(PartitionInfo(
+                name=name, period=parse_period(name), archived=archived,
+                rows=max(int(rows), 0)))
+        return sorted(partitions, key=lambda info: (
+            info.archived, info.period or dt.date.max))
+
+    result = await session.execute(text(
+        "SELECT strftime('%Y-%m-01', purchase_date) AS period, count(*) "
+        f'FROM {PURCHASE_TABLE} GROUP BY period ORDER BY period'))
+    for period, rows in result.all():
+        partitions.append(PartitionInfo(
+            name=PURCHASE_TABLE, period=dt.date.fromisoformat(period),
+            rows=rows))
+    archives = await session.scalars(text(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        'AND name GLOB :archive ORDER BY name'
+    ), {'archive': f'{ARCHIVE_PREFIX}*'})
+    for name in archives.all():
+        rows = await session.scalar(text(f'SELECT count(*) FROM {name}'))
+        partitions.append(PartitionInfo(
+            name=name, period=parse_period(name), archived=True, rows=rows))
+    return partitions
+
+
+async def ensure_partitions(session: AsyncSession,
+                            first_month: Optional[dt.datetime] = None,
+                            months_ahead: int = PURCHASE_MONTHS_AHEAD,
+                            now: Optional[dt.datetime] = None) -> list[str]:
+    '''
+    Создает недостающие секции покупок по месяцам.
+
+    Секции создаются от first_month (по умолчанию - начало рабочего
+    периода) до months_ahead месяцев вперед, плюс секция
+    по умолчанию. Покупки нового месяца, уже попавшие в секцию
+    по умолчанию, переносятся в его секцию. Процессы, запущенные
+    одновременно, создают секции по очереди. На SQLite секций нет,
+    функция ничего не делает. Возвращает имена созданных секций.
+    '''
+    if not _is_postgres(session):
+        return []
+    month = month_start(first_month) if first_month else hot_start(now=now)
+    last = add_months(month_start(now or dt.datetime.now()), months_ahead)
+    await _lock_partitions(session)
+    existing = {info.name for info in await list_partitions(session)}
+    await session.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} '
+        f'PARTITION OF {PURCHASE_TABLE} DEFAULT'))
+
+    created = []
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing and archive_name(month) not in existing:
+            # Секция подключается только после переноса её строк
+            # из секции по умолчанию, иначе Postgres откажет.
+            await session.execute(text(
+                f'CREATE TABLE {name} '
+                f'(LIKE {PURCHASE_TABLE} INCLUDING DEFAULTS)'))
+            await session.execute(_period_query(
+                f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} '
+                'WHERE purchase_date >= :start AND purchase_date < :end '
+                f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                month))
+            await session.execute(text(
+                f'ALTER TABLE {PURCHASE_TABLE} ATTACH PARTITION {name} '
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{add_months(month, 1):%Y-%m-%d}')"))
+            created.append(name)
+        month = add_months(month, 1)
+    await session.commit()
+    return created
+
+
+async def _archive_rows(session: AsyncSession, source: str,
+                        month: dt.datetime) -> int:
+    '''Переносит покупки месяца month из source в архивную таблицу.'''
+    rows = await session.scalar(_period_query(
+        f'SELECT count(*) AS purchases FROM {source} '
+        'WHERE purchase_date >= :start AND purchase_date < :end',
+        month).columns(purchases=Integer))
+    if not rows:
+        return 0
+    target = archive_name(month)
+    if _is_postgres(session):
+        await session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {target} '
+            f'(LIKE {PURCHASE_TABLE} INCLUDING DEFAULTS)'))
+    else:
+        await session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {target} '
+            f'AS SELECT * FROM {PURCHASE_TABLE} WHERE 0'))
+    condition = 'WHERE purchase_date >= :start AND purchase_date < :end'
+    await session.execute(_period_query(
+        f'INSERT INTO {target} SELECT * FROM {source} {condition}', month))
+    await session.execute(_period_query(
+        f'DELETE FROM {source} {condition}', month))
+    return rows
+
+
+async def archive_purchases(session: AsyncSession,
+                            hot_months: int = PURCHASE_HOT_MONTHS,
+                            now: Optional[dt.datetime] = None) -> list[str]:
+    '''
+    Переносит покупки старше hot_months месяцев в архивные таблицы.
+
+    Для каждого месяца создается таблица userpurchase_archive_yYYYYmMM.
+    На Postgres секция месяца отсоединяется и переименовывается без
+    копирования строк; покупки из секции по умолчанию, а на SQLite -
+    из рабочей таблицы, копируются и удаляются. Таблицы совместных,
+    похожих и популярных товаров после этого нужно пересчитать.
+    Возвращает имена пополненных архивных таблиц.
+    '''
+    cutoff = hot_start(hot_months, now)
+    archived = set()
+    source = PURCHASE_TABLE
+    if _is_postgres(session):
+        await _lock_partitions(session)
+        partitions = await list_partitions(session)
+        names = {info.name for info in partitions}
+        for info in partitions:
+            if info.archived or info.period is None:
+                continue
+            if info.period >= cutoff.date():
+                continue
+            target = archive_name(month_start(info.period))
+            await session.execute(text(
+                f'ALTER TABLE {PURCHASE_TABLE} '
+                f'DETACH PARTITION {info.name}'))
+            if target in names:
+                await session.execute(text(
+                    f'INSERT INTO {target} SELECT * FROM {info.name}'))
+                await session.execute(text(f'DROP TABLE {info.name}'))
+            else:
+                await session.execute(text(
+                    f'ALTER TABLE {info.name} RENAME TO {target}'))
+            archived.add(target)
+        if DEFAULT_PARTITION not in names:
+            await session.commit()
+            return sorted(archived)
+        source = DEFAULT_PARTITION
+
+    oldest = await session.scalar(text(
+        f'SELECT min(purchase_date) AS oldest FROM {source} '
+        'WHERE purchase_date < :end'
+    ).bindparams(bindparam('end', cutoff, type_=DateTime)
+                 ).columns(oldest=DateTime))
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        if await _archive_rows(session, source, month):
+            archived.add(archive_name(month))
+        month = add_months(month, 1)
+    await session.commit()
+    return sorted(archived)
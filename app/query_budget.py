@@ -0,0 +1,69 @@
+import logging
+import os
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from starlette.requests import Request
+
+load_dotenv()
+# Что делать при превышении бюджета запросов к базе: warn - записать
+# предупреждение в лог, raise - выбросить исключение (для тестов),
+# off - не проверять.
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'warn')
+# Сколько запросов показывать в предупреждении.
+QUERY_BUDGET_LOG_STATEMENTS = 20
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    '''Обработчик выполнил больше запросов к базе, чем разрешено.'''
+
+
+def query_budget(limit: int) -> Callable:
+    '''
+    Объявляет, сколько запросов к базе может выполнить обработчик.
+
+    Декоратор ставится под декоратором маршрута. Если число запросов
+    зависит от размера данных, обработчик может заменить бюджет
+    для конкретного запроса через set_query_budget.
+    '''
+    def decorator(func: Callable) -> Callable:
+        func.query_budget = limit
+        return func
+    return decorator
+
+
+def set_query_budget(request: Request, limit: int) -> None:
+    '''Бюджет запросов для текущего запроса вместо объявленного.'''
+    request.state.query_budget = limit
+
+
+def get_query_budget(scope: dict) -> Optional[int]:
+    '''Бюджет запросов маршрута, обработавшего запрос.'''
+    state = scope.get('state') or {}
+    if 'query_budget' in state:
+        return state['query_budget']
+    return getattr(scope.get('endpoint'), 'query_budget', None)
+
+
+def check_query_budget(name: str, limit: Optional[int], queries: int,
+                       statements: list[str],
+                       can_raise: bool = True) -> bool:
+    '''
+    Проверяет число запросов к базе, возвращает False при превышении.
+
+    В зависимости от QUERY_BUDGET_MODE превышение записывается в лог
+    вместе с выполненными запросами или вызывает QueryBudgetExceeded.
+    С can_raise=False (ответ клиенту уже начат) превышение только
+    записывается в лог.
+    '''
+    if QUERY_BUDGET_MODE == 'off' or limit is None or queries <= limit:
+        return True
+    listed = '\n'.join(statements[:QUERY_BUDGET_LOG_STATEMENTS])
+    message = (f'{name}: {queries} запросов к базе при бюджете {limit}.\n'
+               f'{listed}')
+    if QUERY_BUDGET_MODE == 'raise' and can_raise:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+    return False
@@ -0,0 +1,450 @@
+import time
+import uuid
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from app.interning import UUID_DTYPE, IdInterner
+
+# Сколько пользователей обрабатывается за одно матричное умножение.
+BATCH_CHUNK_SIZE = 1_000
+# Сколько ненулевых элементов промежуточных матриц допускается
+# на одну порцию пакетного расчета, по верхней оценке.
+BATCH_MAX_NNZ = 5_000_000
+# Добавленные покупки хранятся в отдельной матрице, пока их не станет
+# больше DELTA_MERGE_MIN и доли DELTA_MERGE_RATIO основной матрицы.
+DELTA_MERGE_MIN = 10_000
+DELTA_MERGE_RATIO = 0.05
+SIMILARITY_METRICS = ('cosine', 'jaccard')
+NO_SIMILAR_USERS = ('Недостаточно данных для составления рекомендации: '
+                    'нет пользователей со схожими покупками.')
+NO_NEW_ITEMS = ('Недостаточно данных для составления рекомендации: '
+                'другие пользователи не покупали товары, не купленные'
+                ' данным пользователем.')
+
+
+class NotEnoughDataError(Exception):
+    '''Для пользователя недостаточно данных для рекомендации.'''
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class Interactions(NamedTuple):
+    '''
+    Покупки в виде целочисленных кодов пользователей и товаров.
+
+    Коды int32 выдают словари users и items, они же переводят коды
+    обратно в UUID. shape - размер словарей на момент загрузки:
+    словари могут пополниться позже, а коды покупок - нет.
+    dates - даты покупок, если они загружались.
+    '''
+    users: IdInterner
+    items: IdInterner
+    user_codes: np.ndarray
+    item_codes: np.ndarray
+    shape: tuple[int, int]
+    dates: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'Interactions':
+        '''Коды из DataFrame покупок со столбцами user_id, item_id.'''
+        users, items = IdInterner(), IdInterner()
+        user_codes = _intern_column(users, df['user_id'])
+        item_codes = _intern_column(items, df['item_id'])
+        return cls(users, items, user_codes, item_codes,
+                   (len(users), len(items)))
+
+    def user_code(self, user_id: uuid.UUID) -> Optional[int]:
+        '''Код пользователя или None, если его нет в покупках.'''
+        code = self.users.code(user_id)
+        return None if code is None or code >= self.shape[0] else code
+
+    def item_uuid(self, code: int) -> uuid.UUID:
+        return self.items.uuid_of(code)
+
+    def memory_bytes(self) -> int:
+        '''Память массивов кодов и словарей UUID.'''
+        arrays = self.user_codes.nbytes + self.item_codes.nbytes
+        return arrays + self.users.memory_bytes() + self.items.memory_bytes()
+
+
+def _intern_column(interner: IdInterner, column: pd.Series) -> np.ndarray:
+    '''Коды столбца UUID-строк; строки разбираются один раз.'''
+    values = pd.Categorical(column)
+    raw = np.frombuffer(
+        b''.join(uuid.UUID(str(value)).bytes
+                 for value in values.categories),
+        dtype=UUID_DTYPE)
+    return interner.intern(raw)[values.codes]
+
+
+class RecommendationEngine:
+    '''
+    Разреженная матрица покупок пользователь x товар.
+
+    Хранит матрицу в формате CSR (строки - пользователи) и её
+    CSC-копию, поэтому «кто покупал мои товары» и «что ещё они
+    покупали» считаются выборкой столбцов и одним умножением
+    разреженной матрицы на вектор.
+    '''
+
+    def __init__(self, user_codes: np.ndarray, item_codes: np.ndarray,
+                 shape: tuple[int, int],
+                 interactions: Optional[Interactions] = None,
+                 weights: Optional[np.ndarray] = None):
+        self.interactions = interactions
+        # Время этапов последнего расчета, секунды.
+        self.timings: dict[str, float] = {}
+        # Без весов каждая покупка считается за единицу.
+        data = (np.ones(len(user_codes), dtype=np.int32) if weights is None
+                else np.asarray(weights, dtype=np.float64))
+        # Повторные покупки одного товара суммируются при сборке матрицы.
+        self.csr = sparse.csr_matrix((data, (user_codes, item_codes)),
+                                     shape=shape)
+        self.csc = self.csr.tocsc()
+        self.binary = self.csr.copy()
+        self.binary.data[:] = 1
+        # Покупки, добавленные после сборки, и матрицы из них.
+        self._delta_users: list[np.ndarray] = []
+        self._delta_items: list[np.ndarray] = []
+        self.delta: Optional[sparse.csr_matrix] = None
+        self.delta_csc: Optional[sparse.csc_matrix] = None
+
+    @classmethod
+    def from_interactions(cls,
+                          interactions: Interactions
+                          ) -> 'RecommendationEngine':
+        return cls(interactions.user_codes, interactions.item_codes,
+                   interactions.shape, interactions)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'RecommendationEngine':
+        '''Строит движок из DataFrame покупок со столбцами user_id, item_id.'''
+        return cls.from_interactions(Interactions.from_dataframe(df))
+
+    def add_purchases(self, user_codes: np.ndarray,
+                      item_codes: np.ndarray) -> None:
+        '''
+        Добавляет покупки без пересборки основной матрицы.
+
+        Покупки копятся в отдельной небольшой матрице, расчеты
+        складывают её с основной; когда она вырастает, матрицы
+        сливаются. Новые коды расширяют матрицу.
+        '''
+        user_codes = np.asarray(user_codes, dtype=np.int64)
+        item_codes = np.asarray(item_codes, dtype=np.int64)
+        if user_codes.size == 0:
+            return
+        shape = (max(self.csr.shape[0], int(user_codes.max()) + 1),
+                 max(self.csr.shape[1], int(item_codes.max()) + 1))
+        if shape != self.csr.shape:
+            for matrix in (self.csr, self.csc, self.binary):
+                matrix.resize(shape)
+        self._delta_users.append(user_codes)
+        self._delta_items.append(item_codes)
+        users = np.concatenate(self._delta_users)
+        self.delta = sparse.csr_matrix(
+            (np.ones(users.size, dtype=self.csr.dtype),
+             (users, np.concatenate(self._delta_items))), shape=shape)
+        self.delta_csc = self.delta.tocsc()
+        if self.delta.nnz > max(DELTA_MERGE_MIN,
+                                DELTA_MERGE_RATIO * self.csr.nnz):
+            self.merge()
+
+    def merge(self) -> None:
+        '''Сливает добавленные покупки с основной матрицей.'''
+        if self.delta is None:
+            return
+        self.csr = (self.csr + self.delta).tocsr()
+        self.csc = self.csr.tocsc()
+        self.binary = self.csr.copy()
+        self.binary.data[:] = 1
+        self._delta_users, self._delta_items = [], []
+        self.delta = self.delta_csc = None
+
+    def user_items(self, code: Optional[int]) -> np.ndarray:
+        '''Товары пользователя с кодом code.'''
+        if code is None or code >= self.csr.shape[0]:
+            raise NotEnoughDataError(NO_SIMILAR_USERS)
+        items = self.csr[code].indices
+        if self.delta is not None:
+            items = np.union1d(items, self.delta[code].indices)
+        return items
+
+    def similar_users(self, code: Optional[int]
+                      ) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Товары пользователя и пользователи, купившие хотя бы один
+        из них, без самого пользователя.
+        '''
+        user_items = self.user_items(code)
+        similar = self.csc[:, user_items].indices
+        if self.delta_csc is not None:
+            similar = np.concatenate(
+                [similar, self.delta_csc[:, user_items].indices])
+        similar = np.unique(similar)
+        return user_items, similar[similar != code]
+
+    def user_rows(self, users: np.ndarray) -> sparse.csr_matrix:
+        '''Строки покупок пользователей users.'''
+        rows = self.csr[users]
+        if self.delta is not None:
+            rows = rows + self.delta[users]
+        return rows
+
+    def code_scores(self, code: Optional[int],
+                    similar: Optional[np.ndarray] = None) -> np.ndarray:
+        '''
+        Возвращает популярность товаров среди пользователей
+        со схожими покупками для пользователя с кодом code.
+
+        По умолчанию схожие - все, кто купил хотя бы один товар
+        пользователя; приближенный поиск передает их в similar.
+        '''
+        started = time.perf_counter()
+        if similar is None:
+            user_items, similar = self.similar_users(code)
+        else:
+            user_items = self.user_items(code)
+        if similar.size == 0:
+            raise NotEnoughDataError(NO_SIMILAR_USERS)
+
+        counting = time.perf_counter()
+        self.timings['similar_users'] = counting - started
+
+        indicator = np.zeros(self.csr.shape[0], dtype=np.int32)
+        indicator[similar] = 1
+        scores = self.csc.T.dot(indicator)
+        if self.delta_csc is not None:
+            scores = scores + self.delta_csc.T.dot(indicator)
+        scores[user_items] = 0
+        self.timings['counting'] = time.perf_counter() - counting
+        if not scores.any():
+            raise NotEnoughDataError(NO_NEW_ITEMS)
+        return scores
+
+    def top_codes(self, code: Optional[int], k: int = 1,
+                  similar: Optional[np.ndarray] = None,
+                  ranks: Optional[np.ndarray] = None
+                  ) -> tuple[np.ndarray, np.ndarray]:
+        '''Коды k самых популярных товаров и их популярность.'''
+        return top_scores(self.code_scores(code, similar), k, ranks)
+
+    def recommend(self, user_id: uuid.UUID,
+                  k: int = 1) -> list[tuple[uuid.UUID, int]]:
+        '''Возвращает k самых популярных товаров с их популярностью.'''
+        items, scores = self.top_codes(
+            self.interactions.user_code(user_id), k,
+            ranks=self.interactions.items.ranks())
+        return [(self.interactions.item_uuid(item), int(score))
+                for item, score in zip(items, scores)]
+
+    def chunk_bounds(self, user_codes: np.ndarray,
+                     chunk_size: int = BATCH_CHUNK_SIZE,
+                     max_nnz: int = BATCH_MAX_NNZ
+                     ) -> list[tuple[int, int]]:
+        '''
+        Границы порций пакетного расчета.
+
+        Для каждого пользователя оценивается сверху число ненулевых
+        элементов его строк в матрицах схожих пользователей и
+        популярности; в порцию входят подряд идущие пользователи,
+        пока сумма оценок не больше max_nnz, но не больше chunk_size
+        пользователей и хотя бы один.
+        '''
+        users, items = self.binary.shape
+        sizes = np.diff(self.binary.indptr).astype(np.int64)
+        buyers = np.diff(self.csc.indptr).astype(np.int64)
+        # Сумма покупателей товаров пользователя и сумма покупок
+        # этих покупателей
+        overlap = self.binary @ buyers
+        reach = self.binary @ (self.binary.T @ sizes)
+        costs = np.minimum(overlap, users) + np.minimum(reach, items)
+        costs = costs[user_codes]
+        cumulative = np.cumsum(costs)
+        bounds = []
+        start = 0
+        while start < user_codes.size:
+            used = cumulative[start - 1] if start else 0
+            end = int(np.searchsorted(cumulative, used + max_nnz,
+                                      side='right'))
+            end = min(max(end, start + 1), start + chunk_size,
+                      user_codes.size)
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def top_items(self, user_codes: np.ndarray, k: int = 1,
+                  chunk_size: int = BATCH_CHUNK_SIZE,
+                  ranks: Optional[np.ndarray] = None,
+                  max_nnz: int = BATCH_MAX_NNZ
+                  ) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Считает k лучших товаров сразу для группы пользователей.
+
+        Пользователи делятся на порции по оценке размера
+        промежуточных матриц (см. chunk_bounds), поэтому память
+        не растет с числом пользователей и популярностью товаров.
+        Возвращает матрицы товаров и их популярности размером
+        len(user_codes) x k; пустые позиции заполнены -1 и 0.
+        '''
+        self.merge()
+        user_codes = np.asarray(user_codes, dtype=np.int64)
+        top = np.full((user_codes.size, k), -1, dtype=np.int64)
+        top_scores = np.zeros((user_codes.size, k), dtype=np.int64)
+        for start, end in self.chunk_bounds(user_codes, chunk_size,
+                                            max_nnz):
+            codes = user_codes[start:end]
+            own = self.binary[codes]
+
+            # Пользователи с общими покупками, без самого пользователя
+            overlap = (own @ self.binary.T).tocoo()
+            keep = overlap.col != codes[overlap.row]
+            similar = sparse.csr_matrix(
+                (np.ones(keep.sum(), dtype=np.int32),
+                 (overlap.row[keep], overlap.col[keep])),
+                shape=overlap.shape)
+
+            scores = (similar @ self.csr).tocsr()
+            scores = (scores - scores.multiply(own)).tocoo()
+            positive = scores.data > 0
+            rows = scores.row[positive]
+            cols = scores.col[positive]
+            data = scores.data[positive]
+
+            # Сортируем по пользователю, затем по убыванию популярности
+            order = np.lexsort((cols if ranks is None else ranks[cols],
+                                -data, rows))
+            rows, cols, data = rows[order], cols[order], data[order]
+            first = np.searchsorted(rows, np.arange(codes.size))
+            rank = np.arange(rows.size) - first[rows]
+            best = rank < k
+            top[start + rows[best], rank[best]] = cols[best]
+            top_scores[start + rows[best], rank[best]] = data[best]
+        return top, top_scores
+
+
+def top_scores(scores: np.ndarray, k: int,
+               ranks: Optional[np.ndarray] = None
+               ) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Коды k товаров с наибольшей положительной популярностью.
+
+    При равной популярности товары идут по ranks (см.
+    IdInterner.ranks), как ORDER BY score DESC, item_id в режиме sql;
+    без ranks - по кодам.
+    '''
+    candidates = np.flatnonzero(scores)
+    order = np.lexsort((
+        candidates if ranks is None else ranks[candidates],
+        -scores[candidates]))[:k]
+    return candidates[order], scores[candidates[order]]
+
+
+def decay_weights(dates: np.ndarray, now: np.datetime64,
+                  half_life_days: float) -> np.ndarray:
+    '''
+    Вес покупки, который вдвое уменьшается каждые half_life_days дней.
+
+    Покупки без даты и из будущего получают вес 1.
+    '''
+    age_days = (now - dates) / np.timedelta64(1, 'D')
+    age_days = np.nan_to_num(np.clip(age_days, 0, None), nan=0.0)
+    return np.exp2(-age_days / half_life_days)
+
+
+def score_user(user_codes: np.ndarray, item_codes: np.ndarray,
+               shape: tuple[int, int], code: Optional[int],
+               k: int, weights: Optional[np.ndarray] = None,
+               ranks: Optional[np.ndarray] = None
+               ) -> tuple[np.ndarray, np.ndarray, dict]:
+    '''
+    Лучшие товары для одного пользователя и время этапов расчета.
+
+    Чистая функция над массивами кодов: её можно выполнить
+    в отдельном процессе, передав только числовые массивы.
+    С weights популярность - сумма весов покупок, а не их число.
+    '''
+    engine = RecommendationEngine(user_codes, item_codes, shape,
+                                  weights=weights)
+    items, scores = engine.top_codes(code, k, ranks=ranks)
+    return items, scores, engine.timings
+
+
+def score_rows(rows: sparse.csr_matrix, user_items: np.ndarray, k: int,
+               ranks: Optional[np.ndarray] = None
+               ) -> tuple[np.ndarray, np.ndarray, dict]:
+    '''
+    Лучшие товары по строкам покупок схожих пользователей.
+
+    В процесс пула передаются только эти строки и товары самого
+    пользователя, а не вся матрица покупок.
+    '''
+    started = time.perf_counter()
+    scores = np.asarray(rows.sum(axis=0)).ravel()
+    scores[user_items] = 0
+    if not scores.any():
+        raise NotEnoughDataError(NO_NEW_ITEMS)
+    items, top = top_scores(scores, k, ranks)
+    return items, top, {'counting': time.perf_counter() - started}
+
+
+def score_users(user_codes: np.ndarray, item_codes: np.ndarray,
+                shape: tuple[int, int], codes: np.ndarray, k: int,
+                ranks: Optional[np.ndarray] = None
+                ) -> tuple[np.ndarray, np.ndarray]:
+    '''Лучшие товары сразу для группы пользователей, см. score_user.'''
+    engine = RecommendationEngine(user_codes, item_codes, shape)
+    return engine.top_items(codes, k, ranks=ranks)
+
+
+def item_neighbours(user_codes: np.ndarray, item_codes: np.ndarray,
+                    shape: tuple[int, int], n: int,
+                    metric: str = 'cosine',
+                    chunk_size: int = BATCH_CHUNK_SIZE
+                    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    До n ближайших соседей каждого товара по множествам покупателей.
+
+    Сходство - косинусная мера или коэффициент Жаккара. Возвращает
+    коды товаров, коды соседей и сходство, отсортированные
+    по товару и убыванию сходства.
+    '''
+    if metric not in SIMILARITY_METRICS:
+        raise ValueError(f'Неизвестная мера сходства: {metric}.')
+    binary = sparse.csr_matrix(
+        (np.ones(len(user_codes), dtype=np.int32), (user_codes, item_codes)),
+        shape=shape)
+    binary.data[:] = 1
+    by_item = binary.T.tocsr()
+    buyers = np.diff(by_item.indptr)
+
+    items, neighbours, scores = [], [], []
+    for start in range(0, shape[1], chunk_size):
+        # Число общих покупателей для товаров порции и всех товаров
+        common = (by_item[start:start + chunk_size] @ binary).tocoo()
+        rows = common.row + start
+        keep = common.col != rows
+        rows, cols = rows[keep], common.col[keep]
+        shared = common.data[keep].astype(np.float64)
+        if metric == 'cosine':
+            score = shared / np.sqrt(buyers[rows] * buyers[cols])
+        else:
+            score = shared / (buyers[rows] + buyers[cols] - shared)
+
+        order = np.lexsort((cols, -score, rows))
+        rows, cols, score = rows[order], cols[order], score[order]
+        first = np.searchsorted(rows, rows)
+        best = np.arange(rows.size) - first < n
+        items.append(rows[best])
+        neighbours.append(cols[best])
+        scores.append(score[best])
+    if not items:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+    return (np.concatenate(items), np.concatenate(neighbours),
+            np.concatenate(scores))
@@ -1,12 +1,25 @@
+import json
+import math
 import uuid
+from enum import Enum
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request,
+                     Response, status)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import get_db
-from app.orm_query import (ItemRepository, PurchaseRepository,
+from app import metrics
+from app.cache import recommendation_cache
+from app.db import engine, get_db, pool_stats
+from app.jobs import recommendation_jobs
+from app.orm_query import (BULK_CHUNK_SIZE, ItemRepository, PurchaseRepository,
                            RecommendRepository, UserRepository)
-from app.schemas import ItemAdd, PurchaseAdd, RecommendationAdd, UserAdd
+from app.query_budget import query_budget, set_query_budget
+from app.schemas import (ItemAdd, PurchaseAdd, PurchaseBulkError,
+                         RecommendationAdd, RecommendationBatchAdd, UserAdd)
 
 user_router = APIRouter(
     prefix='/users',
@@ -34,8 +47,70 @@ recommendation_router = APIRouter(
     tags=['рекомендации']
 )
 
+admin_router = APIRouter(
+    prefix='/admin',
+    tags=['администрирование']
+)
+
+internal_router = APIRouter(
+    prefix='/internal',
+    tags=['служебное']
+)
+
+metrics_router = APIRouter(
+    tags=['служебное']
+)
+
+MAX_PAGE_SIZE = 1000
+# Запросы к базе на одну порцию пакетной загрузки покупок: пользователи,
+# товары, купленные ранее товары, совместные покупки и вставка.
+BULK_QUERIES_PER_CHUNK = 5
+
+
+class ListFormat(str, Enum):
+    '''Формат ответа для списков.'''
+    json = 'json'
+    ndjson = 'ndjson'
+
+
+def parse_cursor(after: Optional[str]) -> Optional[uuid.UUID]:
+    '''Проверяет курсор страницы, это id последней полученной записи.'''
+    if after is None:
+        return None
+    try:
+        return uuid.UUID(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Неверный формат id.')
+
+
+def page_response(rows: list[BaseModel], limit: Optional[int]) -> dict:
+    '''Страница списка с курсором следующей страницы.'''
+    next_cursor = rows[-1].id if len(rows) == limit else None
+    return {'data': rows, 'next': next_cursor}
+
+
+def ndjson_response(
+        stream: Callable[[AsyncSession], AsyncIterator[BaseModel]],
+        session: AsyncSession) -> StreamingResponse:
+    '''
+    Потоковый ответ: по одной записи JSON на строку.
+
+    Сессия из зависимости закрывается до отправки тела ответа,
+    поэтому записи читаются в отдельной сессии на том же движке.
+    Её открывает и закрывает сам генератор.
+    '''
+    bind = session.bind
+
+    async def lines():
+        async with AsyncSession(bind) as stream_session:
+            async for row in stream(stream_session):
+                yield row.model_dump_json() + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
 
 @user_router.post('', status_code=status.HTTP_201_CREATED)
+@query_budget(1)
 async def add_user(user: UserAdd, session: AsyncSession = Depends(get_db)):
     '''Создать нового пользователя.'''
     user_id = await UserRepository.add_user(user, session)
@@ -43,13 +118,31 @@ async def add_user(user: UserAdd, session: AsyncSession = Depends(get_db)):
 
 
 @user_router.get('')
-async def get_users(session: AsyncSession = Depends(get_db)):
-    '''Посмотреть всех пользователей.'''
-    users = await UserRepository.get_all(session)
-    return {'data': users}
+@query_budget(1)
+async def get_users(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    format: ListFormat = ListFormat.json,
+    session: AsyncSession = Depends(get_db)
+):
+    '''
+    Посмотреть всех пользователей.
+
+    Список отдается страницами по limit записей, следующая страница
+    запрашивается с after из поля next. Без limit список отдается
+    целиком. С format=ndjson записи отдаются потоком.
+    '''
+    after_uuid = parse_cursor(after)
+    if format == ListFormat.ndjson:
+        return ndjson_response(
+            partial(UserRepository.stream_all, limit=limit, after=after_uuid),
+            session)
+    users = await UserRepository.get_all(session, limit, after_uuid)
+    return page_response(users, limit)
 
 
 @item_router.post('', status_code=status.HTTP_201_CREATED)
+@query_budget(1)
 async def add_item(item: ItemAdd,
                    session: AsyncSession = Depends(get_db)):
     '''Создание нового товара.'''
@@ -60,13 +153,31 @@ async def add_item(item: ItemAdd,
 
 
 @item_router.get('')
-async def get_items(session: AsyncSession = Depends(get_db)):
-    '''Просмотреть все товары.'''
-    items = await ItemRepository.get_all(session)
-    return {'data': items}
+@query_budget(1)
+async def get_items(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    format: ListFormat = ListFormat.json,
+    session: AsyncSession = Depends(get_db)
+):
+    '''
+    Просмотреть все товары.
+
+    Список отдается страницами по limit записей, следующая страница
+    запрашивается с after из поля next. Без limit список отдается
+    целиком. С format=ndjson записи отдаются потоком.
+    '''
+    after_uuid = parse_cursor(after)
+    if format == ListFormat.ndjson:
+        return ndjson_response(
+            partial(ItemRepository.stream_all, limit=limit, after=after_uuid),
+            session)
+    items = await ItemRepository.get_all(session, limit, after_uuid)
+    return page_response(items, limit)
 
 
 @item_router.get('/{item_id}')
+@query_budget(1)
 async def get_item(item_id: str, session: AsyncSession = Depends(get_db)):
     '''Просмотреть товар по id.'''
     try:
@@ -78,6 +189,7 @@ async def get_item(item_id: str, session: AsyncSession = Depends(get_db)):
 
 
 @purchase_router.post('', status_code=status.HTTP_201_CREATED)
+@query_budget(4)
 async def add_purchase(purchase: PurchaseAdd,
                        session: AsyncSession = Depends(get_db)):
     '''Добавить покупку пользователя.'''
@@ -85,14 +197,108 @@ async def add_purchase(purchase: PurchaseAdd,
     return {'status': purchase_status}
 
 
+def parse_purchase(index: int, raw_row: Any
+                   ) -> Union[PurchaseAdd, PurchaseBulkError]:
+    '''Покупка из строки пакетной загрузки или ошибка этой строки.'''
+    try:
+        return PurchaseAdd.model_validate(raw_row)
+    except (ValueError, ValidationError) as error:
+        return PurchaseBulkError(index=index, detail=str(error))
+
+
+async def json_purchases(body: bytes
+                         ) -> AsyncIterator[Union[PurchaseAdd,
+                                                  PurchaseBulkError]]:
+    '''Покупки из JSON-массива.'''
+    try:
+        raw_rows = json.loads(body)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail='Некорректный JSON.')
+    if not isinstance(raw_rows, list):
+        raise HTTPException(status_code=400,
+                            detail='Ожидается массив покупок.')
+    for index, raw_row in enumerate(raw_rows):
+        yield parse_purchase(index, raw_row)
+
+
+async def body_lines(request: Request) -> AsyncIterator[bytes]:
+    '''
+    Строки тела запроса по мере его получения.
+
+    В памяти остается только недочитанная строка.
+    '''
+    tail = b''
+    async for data in request.stream():
+        *lines, tail = (tail + data).split(b'\n')
+        for line in lines:
+            yield line
+    yield tail
+
+
+async def ndjson_purchases(request: Request
+                           ) -> AsyncIterator[Union[PurchaseAdd,
+                                                    PurchaseBulkError]]:
+    '''Покупки из тела NDJSON, пустые строки пропускаются.'''
+    index = 0
+    async for line in body_lines(request):
+        if not line.strip():
+            continue
+        try:
+            yield parse_purchase(index, json.loads(line))
+        except json.JSONDecodeError as error:
+            yield PurchaseBulkError(index=index, detail=str(error))
+        index += 1
+
+
+@purchase_router.post('/bulk', status_code=status.HTTP_201_CREATED)
+@query_budget(BULK_QUERIES_PER_CHUNK)
+async def add_purchases_bulk(request: Request,
+                             session: AsyncSession = Depends(get_db)):
+    '''
+    Пакетно добавить покупки.
+
+    Тело - JSON-массив покупок или NDJSON (Content-Type
+    application/x-ndjson), по одной покупке на строку. NDJSON
+    читается потоком. Покупки добавляются порциями; покупки
+    с ошибками пропускаются и перечисляются в отчете с номером строки.
+    '''
+    if 'ndjson' in request.headers.get('content-type', ''):
+        purchases = ndjson_purchases(request)
+    else:
+        purchases = json_purchases(await request.body())
+    result = await PurchaseRepository.add_purchases_bulk(purchases, session)
+    chunks = math.ceil((result.accepted + result.rejected) / BULK_CHUNK_SIZE)
+    set_query_budget(request, BULK_QUERIES_PER_CHUNK * max(chunks, 1))
+    return {'status': 'Покупки обработаны.', 'data': result}
+
+
 @purchase_router.get('')
-async def get_purchases(session: AsyncSession = Depends(get_db)):
-    '''Просмотреть все покупки.'''
-    purchases = await PurchaseRepository.get_all(session)
-    return {'data': purchases}
+@query_budget(1)
+async def get_purchases(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    format: ListFormat = ListFormat.json,
+    session: AsyncSession = Depends(get_db)
+):
+    '''
+    Просмотреть все покупки.
+
+    Список отдается страницами по limit записей, следующая страница
+    запрашивается с after из поля next. Без limit список отдается
+    целиком. С format=ndjson записи отдаются потоком.
+    '''
+    after_uuid = parse_cursor(after)
+    if format == ListFormat.ndjson:
+        return ndjson_response(
+            partial(PurchaseRepository.stream_all, limit=limit,
+                    after=after_uuid),
+            session)
+    purchases = await PurchaseRepository.get_all(session, limit, after_uuid)
+    return page_response(purchases, limit)
 
 
 @purchase_router.get('')
+@query_budget(1)
 async def get_user_purchases(user_id: str,
                              session: AsyncSession = Depends(get_db)):
     '''Просмотреть все покупки определенного пользователя.'''
@@ -105,24 +311,104 @@ async def get_user_purchases(user_id: str,
     return {'data': user_purchases}
 
 
+# Пользователь, поиск схожих пользователей (до двух запросов),
+# популярные товары для новых пользователей, удаление и вставка.
 @gen_recommendation_router.post('', status_code=status.HTTP_201_CREATED)
+@query_budget(6)
 async def add_request_for_recommendation(
-    user: RecommendationAdd, session: AsyncSession = Depends(get_db)
+    user: RecommendationAdd, response: Response,
+    background: bool = False,
+    session: AsyncSession = Depends(get_db)
 ):
-    '''Создаем рекомендацию для пользователя.'''
+    '''
+    Создаем рекомендацию для пользователя.
+
+    С background=true рекомендация считается в фоне: ответ 202
+    содержит id задачи, статус которой можно запросить отдельно.
+    Повторный запрос, пока задача ждет в очереди, вернет ту же задачу.
+    '''
+    if background:
+        job = await recommendation_jobs.submit(user)
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers['Location'] = (
+            f'{gen_recommendation_router.prefix}/{job.id}')
+        return {'status': 'Задача поставлена в очередь.',
+                'job_id': job.id, 'data': job}
     recommendation = await RecommendRepository.add_recommendation(user,
                                                                   session)
     return {'status': f'{recommendation}'}
 
 
+@gen_recommendation_router.get('/{job_id}')
+@query_budget(0)
+async def get_recommendation_job(job_id: str):
+    '''Посмотреть состояние задачи генерации рекомендации.'''
+    try:
+        job_id_uuid = uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Неверный формат id.')
+    job = recommendation_jobs.get(job_id_uuid)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Задача не найдена.')
+    return {'data': job}
+
+
 @recommendation_router.get('')
+@query_budget(1)
 async def get_user_recommendation(user_id: str,
+                                  limit: int = Query(10, ge=1, le=100),
+                                  offset: int = Query(0, ge=0),
                                   session: AsyncSession = Depends(get_db)):
-    '''Просмотреть рекомендацию товара пользователю.'''
+    '''Просмотреть рекомендации товаров пользователю по порядку.'''
     try:
         user_id_uuid = uuid.UUID(user_id)
     except ValueError:
         raise HTTPException(status_code=400, detail='Неверный формат id.')
-    recommendation = await RecommendRepository.get_recommendation(
-        user_id_uuid, session)
-    return {'data': recommendation}
+    recommendations = await RecommendRepository.get_recommendation(
+        user_id_uuid, session, limit, offset)
+    return {'data': recommendations}
+
+
+@admin_router.post('/generate_recommendations',
+                   status_code=status.HTTP_201_CREATED)
+@query_budget(3)
+async def add_recommendations_batch(
+    batch: RecommendationBatchAdd, session: AsyncSession = Depends(get_db)
+):
+    '''Пакетно создаем рекомендации для всех или выбранных пользователей.'''
+    result = await RecommendRepository.add_recommendations_batch(
+        session, batch.user_ids)
+    return {'status': 'Рекомендации успешно сгенерированы.', 'data': result}
+
+
+@internal_router.get('/cache')
+@query_budget(0)
+async def get_cache_stats():
+    '''Статистика кэша рекомендаций.'''
+    return {'data': recommendation_cache.stats()}
+
+
+@internal_router.get('/jobs')
+@query_budget(0)
+async def get_job_stats():
+    '''Статистика очереди задач генерации рекомендаций.'''
+    return {'data': recommendation_jobs.stats()}
+
+
+@internal_router.get('/pool')
+@query_budget(0)
+async def get_pool_stats():
+    '''Статистика пула соединений с базой данных.'''
+    return {'data': pool_stats(engine)}
+
+
+@metrics_router.get('/metrics', response_class=PlainTextResponse)
+@query_budget(0)
+async def get_metrics():
+    '''Метрики в текстовом формате Prometheus.'''
+    stats = pool_stats(engine)
+    for state in ('checked_in', 'checked_out', 'overflow'):
+        if state in stats:
+            metrics.DB_POOL_CONNECTIONS.set(stats[state], state=state)
+    return PlainTextResponse(metrics.render(),
+                             media_type=metrics.CONTENT_TYPE)
@@ -1,6 +1,7 @@
 import datetime as dt
 import uuid
-from typing import List
+from enum import Enum
+from typing import Any, List, Optional
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -48,6 +49,19 @@ class PurchaseAdd(BaseModel):
     cart: List[ItemInPurchaseAdd]
 
 
+class PurchaseBulkError(BaseModel):
+    '''Ошибка в строке пакетной загрузки покупок.'''
+    index: int
+    detail: Any
+
+
+class PurchaseBulkRead(BaseModel):
+    '''Итоги пакетной загрузки покупок.'''
+    accepted: int
+    rejected: int
+    errors: List[PurchaseBulkError]
+
+
 class PurchaseRead(BaseRead):
     '''Схема для чтения покупки.'''
     user_id: uuid.UUID
@@ -57,11 +71,72 @@ class PurchaseRead(BaseRead):
     purchase_date: dt.datetime
 
 
+class RecommendationMode(str, Enum):
+    '''Способ расчета рекомендации.'''
+    matrix = 'matrix'
+    sql = 'sql'
+    cooccurrence = 'cooccurrence'
+    item = 'item'
+    lsh = 'lsh'
+    recent = 'recent'
+
+
+class RecommendationSource(str, Enum):
+    '''
+    Источник рекомендации: схожие пользователи, популярное
+    в любимой категории пользователя или популярное среди всех.
+    '''
+    personal = 'personal'
+    category = 'category'
+    popular = 'popular'
+
+
 class RecommendationAdd(BaseModel):
     '''Схема для создания рекомендации для пользователя.'''
     user_id: uuid.UUID
+    mode: Optional[RecommendationMode] = Field(
+        None, description='Способ расчета, по умолчанию из настроек')
 
 
 class RecommendationRead(BaseModel):
     '''Схема для чтения рекомендации.'''
     item_id: uuid.UUID
+    score: float
+    rank: int
+    source: RecommendationSource = RecommendationSource.personal
+    model_config = ConfigDict(from_attributes=True)
+
+
+class RecommendationBatchAdd(BaseModel):
+    '''Схема для пакетной генерации рекомендаций.'''
+    user_ids: Optional[List[uuid.UUID]] = Field(
+        None, description='Пользователи, по умолчанию все')
+
+
+class RecommendationBatchRead(BaseModel):
+    '''Итоги пакетной генерации рекомендаций.'''
+    users: int
+    generated: int
+    skipped: int
+    seconds: float
+    users_per_sec: float
+
+
+class JobStatus(str, Enum):
+    '''Состояние задачи генерации рекомендации.'''
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class RecommendationJobRead(BaseModel):
+    '''Схема для чтения задачи генерации рекомендации.'''
+    id: uuid.UUID
+    user_id: uuid.UUID
+    mode: Optional[RecommendationMode] = None
+    status: JobStatus = JobStatus.pending
+    detail: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: dt.datetime
+    finished_at: Optional[dt.datetime] = None
@@ -0,0 +1,150 @@
+import datetime as dt
+import time
+import uuid
+from typing import Callable, Optional
+
+import numpy as np
+from pydantic import BaseModel
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.importer import copy_rows, insert_rows
+from app.models import Item, User
+from app.orm_query import ITEM_NEIGHBOURS, ITEM_SIMILARITY, POPULARITY_TOP_N
+from app.utils import (rebuild_cooccurrence, rebuild_item_neighbours,
+                       rebuild_popularity)
+
+SYNTHETIC_CHUNK_SIZE = 50_000
+# Показатель степенного распределения популярности товаров
+# и активности пользователей: чем больше, тем сильнее «хвост».
+POWER_LAW_ALPHA = 1.1
+# Доля покупок из любимой категории пользователя.
+CATEGORY_AFFINITY = 0.7
+
+
+class SyntheticStats(BaseModel):
+    '''Итоги генерации синтетических данных.'''
+    users: int
+    items: int
+    purchases: int
+    categories: int
+    seed: int
+    seconds: float
+
+
+def power_law_weights(size: int, alpha: float,
+                      rng: np.random.Generator) -> np.ndarray:
+    '''
+    Вероятности, убывающие как 1 / rank ** alpha.
+
+    Ранги перемешаны, чтобы популярность не зависела от порядка id.
+    '''
+    weights = 1.0 / np.arange(1, size + 1) ** alpha
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def random_uuids(size: int, rng: np.random.Generator) -> list[uuid.UUID]:
+    '''UUID версии 4 из генератора, чтобы набор данных повторялся.'''
+    raw = rng.bytes(16 * size)
+    return [uuid.UUID(bytes=raw[start:start + 16], version=4)
+            for start in range(0, 16 * size, 16)]
+
+
+def sample_purchases(size: int, user_weights: np.ndarray,
+                     user_categories: np.ndarray,
+                     category_items: list[np.ndarray],
+                     category_weights: list[np.ndarray],
+                     item_weights: np.ndarray,
+                     rng: np.random.Generator,
+                     affinity: float = CATEGORY_AFFINITY
+                     ) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Коды пользователей и товаров для size покупок.
+
+    Часть покупок делается в любимой категории пользователя,
+    остальные - среди всех товаров по их популярности.
+    '''
+    users = rng.choice(user_weights.size, size=size, p=user_weights)
+    items = rng.choice(item_weights.size, size=size, p=item_weights)
+    favourite = rng.random(size) < affinity
+    categories = user_categories[users]
+    for category, (codes, weights) in enumerate(zip(category_items,
+                                                    category_weights)):
+        mask = favourite & (categories == category)
+        if codes.size and mask.any():
+            items[mask] = rng.choice(codes, size=mask.sum(), p=weights)
+    return users, items
+
+
+async def generate_dataset(
+    session: AsyncSession, users: int, items: int, purchases: int,
+    seed: int = 0, categories: int = 20, days: int = 365,
+    alpha: float = POWER_LAW_ALPHA,
+    chunk_size: int = SYNTHETIC_CHUNK_SIZE,
+    end: Optional[dt.datetime] = None,
+    progress: Callable[[int], None] = lambda done: None
+) -> SyntheticStats:
+    '''
+    Заполняет базу синтетическими пользователями, товарами и покупками.
+
+    Активность пользователей и популярность товаров распределены
+    по степенному закону, у каждого пользователя есть любимая
+    категория. При одинаковом seed получается тот же набор данных.
+    Покупки загружаются порциями, на Postgres - через COPY; затем
+    пересчитываются таблицы совместных покупок, похожих
+    и популярных товаров.
+    '''
+    rng = np.random.default_rng(seed)
+    end = end or dt.datetime.now()
+    started = time.perf_counter()
+    categories = min(categories, items)
+
+    user_ids = random_uuids(users, rng)
+    item_ids = random_uuids(items, rng)
+    item_categories = rng.integers(0, categories, size=items)
+    category_names = [f'category {number}' for number in range(categories)]
+    await session.execute(insert(User), [
+        {'id': user_id, 'username': f'user {number}'}
+        for number, user_id in enumerate(user_ids)])
+    await session.execute(insert(Item), [
+        {'id': item_id, 'name': f'item {number}',
+         'category': category_names[item_categories[number]]}
+        for number, item_id in enumerate(item_ids)])
+    await session.commit()
+
+    user_weights = power_law_weights(users, alpha, rng)
+    item_weights = power_law_weights(items, alpha, rng)
+    user_categories = rng.integers(0, categories, size=users)
+    category_items = [np.flatnonzero(item_categories == category)
+                      for category in range(categories)]
+    category_weights = [item_weights[codes] / item_weights[codes].sum()
+                        for codes in category_items]
+
+    load = copy_rows if session.bind.dialect.name == 'postgresql' \
+        else insert_rows
+    for start in range(0, purchases, chunk_size):
+        size = min(chunk_size, purchases - start)
+        user_codes, item_codes = sample_purchases(
+            size, user_weights, user_categories, category_items,
+            category_weights, item_weights, rng)
+        seconds_ago = rng.uniform(0, days * 86_400, size=size)
+        ids = random_uuids(size, rng)
+        await load([
+            {'id': ids[number],
+             'user_id': user_ids[user],
+             'item_id': item_ids[item],
+             'category': category_names[item_categories[item]],
+             'purchase_date': end - dt.timedelta(seconds=float(ago))}
+            for number, (user, item, ago)
+            in enumerate(zip(user_codes, item_codes, seconds_ago))],
+            session)
+        await session.commit()
+        progress(start + size)
+
+    await rebuild_cooccurrence(session)
+    await rebuild_item_neighbours(session, ITEM_NEIGHBOURS, ITEM_SIMILARITY)
+    await rebuild_popularity(session, POPULARITY_TOP_N)
+    return SyntheticStats(users=users, items=items, purchases=purchases,
+                          categories=categories, seed=seed,
+                          seconds=round(time.perf_counter() - started, 3))
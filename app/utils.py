@@ -1,10 +1,25 @@
+import datetime as dt
 import uuid
+from collections import Counter
+from typing import AsyncIterator, Optional, Type
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import and_, select
+from pydantic import BaseModel
+from sqlalchemy import Select, and_, delete, func, insert, literal, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models import UserPurchase
+from app.executor import run_cpu_bound
+from app.interning import UUID_DTYPE, item_interner, user_interner
+from app.models import (ItemCooccurrence, ItemNeighbour, ItemPopularity, User,
+                        UserPurchase)
+from app.recommender import Interactions, item_neighbours
+
+# Размер порции строк, читаемой из серверного курсора за один раз.
+PURCHASES_CHUNK_SIZE = 10_000
+# Категория, под которой хранятся популярные товары среди всех покупок.
+GLOBAL_CATEGORY = ''
 
 
 async def find_similar_users_purchases(user_item_ids: list[uuid.UUID],
@@ -33,16 +48,420 @@ async def find_similar_users(user_item_ids: list[uuid.UUID],
     return result.scalars().all()
 
 
-async def get_purchases_dataframe(session: AsyncSession,
-                                  query) -> pd.DataFrame:
+def keyset_page(query: Select, column, after: Optional[uuid.UUID] = None,
+                limit: Optional[int] = None) -> Select:
+    '''
+    Ограничиваем запрос страницей по ключу: строки после after
+    в порядке column, не больше limit штук.
+    '''
+    if after is not None:
+        query = query.where(column > after)
+    query = query.order_by(column)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+async def stream_rows(session: AsyncSession, query: Select,
+                      schema: Type[BaseModel],
+                      chunk_size: int = PURCHASES_CHUNK_SIZE
+                      ) -> AsyncIterator[BaseModel]:
+    '''
+    Читаем строки запроса порциями через серверный курсор
+    и отдаем их по одной в виде схемы.
+    '''
+    result = await session.stream(
+        query.execution_options(yield_per=chunk_size))
+    async for row in result:
+        yield schema.model_validate(row)
+
+
+def _decode_uuid_column(raw: np.ndarray) -> pd.Categorical:
+    '''
+    Превращаем массив 16-байтовых UUID в категориальный столбец.
+
+    Строки создаются только для уникальных значений,
+    а сами строки таблицы хранятся как целочисленные коды.
+    '''
+    uniques, codes = np.unique(raw, return_inverse=True)
+    categories = [str(uuid.UUID(bytes=value)) for value in uniques.tolist()]
+    return pd.Categorical.from_codes(codes.reshape(-1), categories)
+
+
+async def get_purchases_dataframe(
+    session: AsyncSession,
+    query: Optional[Select] = None,
+    chunk_size: int = PURCHASES_CHUNK_SIZE,
+    with_dates: bool = False
+) -> pd.DataFrame:
+    '''
+    Получаем DataFrame покупок со столбцами user_id и item_id.
+
+    Из базы выбираются только два столбца, строки читаются порциями
+    через серверный курсор и сразу складываются в массивы NumPy,
+    без создания ORM-объектов. С with_dates третий столбец запроса -
+    дата покупки, она попадает в столбец purchase_date.
+    '''
+    if query is None:
+        query = select(UserPurchase.user_id, UserPurchase.item_id)
+        if with_dates:
+            query = query.add_columns(UserPurchase.purchase_date)
+
+    user_chunks = []
+    item_chunks = []
+    date_chunks = []
+    result = await session.stream(
+        query.execution_options(yield_per=chunk_size))
+    async for partition in result.partitions():
+        user_chunks.append(np.frombuffer(
+            b''.join(row[0].bytes for row in partition), dtype=UUID_DTYPE))
+        item_chunks.append(np.frombuffer(
+            b''.join(row[1].bytes for row in partition), dtype=UUID_DTYPE))
+        if with_dates:
+            date_chunks.append(np.array([row[2] for row in partition],
+                                        dtype='datetime64[us]'))
+
+    if not user_chunks:
+        columns = {'user_id': pd.Series(dtype=str),
+                   'item_id': pd.Series(dtype=str)}
+        if with_dates:
+            columns['purchase_date'] = pd.Series(dtype='datetime64[us]')
+        return pd.DataFrame(columns)
+    columns = {
+        'user_id': _decode_uuid_column(np.concatenate(user_chunks)),
+        'item_id': _decode_uuid_column(np.concatenate(item_chunks)),
+    }
+    if with_dates:
+        columns['purchase_date'] = np.concatenate(date_chunks)
+    return pd.DataFrame(columns)
+
+
+async def load_interactions(
+    session: AsyncSession,
+    query: Optional[Select] = None,
+    chunk_size: int = PURCHASES_CHUNK_SIZE,
+    with_dates: bool = False
+) -> Interactions:
+    '''
+    Загружаем покупки сразу в виде кодов int32.
+
+    Запрос и чтение порциями - как в get_purchases_dataframe, но
+    UUID каждой порции переводятся в коды словарями процесса
+    user_interner и item_interner, строки и DataFrame не создаются.
+    С with_dates даты покупок попадают в dates.
+    '''
+    if query is None:
+        query = select(UserPurchase.user_id, UserPurchase.item_id)
+        if with_dates:
+            query = query.add_columns(UserPurchase.purchase_date)
+
+    user_chunks = [np.empty(0, dtype=np.int32)]
+    item_chunks = [np.empty(0, dtype=np.int32)]
+    date_chunks = [np.empty(0, dtype='datetime64[us]')]
+    result = await session.stream(
+        query.execution_options(yield_per=chunk_size))
+    async for partition in result.partitions():
+        user_chunks.append(user_interner.intern(np.frombuffer(
+            b''.join(row[0].bytes for row in partition), dtype=UUID_DTYPE)))
+        item_chunks.append(item_interner.intern(np.frombuffer(
+            b''.join(row[1].bytes for row in partition), dtype=UUID_DTYPE)))
+        if with_dates:
+            date_chunks.append(np.array([row[2] for row in partition],
+                                        dtype='datetime64[us]'))
+
+    return Interactions(
+        user_interner, item_interner, np.concatenate(user_chunks),
+        np.concatenate(item_chunks),
+        (len(user_interner), len(item_interner)),
+        np.concatenate(date_chunks) if with_dates else None)
+
+
+def recent_purchases_query(user_id: uuid.UUID,
+                           since: dt.datetime) -> Select:
+    '''
+    Покупки начиная с since и вся история пользователя user_id.
+
+    Окно читается по индексу дат покупок, история пользователя -
+    по индексу пользователя: чем уже окно, тем меньше строк.
+    '''
+    return select(
+        UserPurchase.user_id, UserPurchase.item_id,
+        UserPurchase.purchase_date
+    ).where(or_(UserPurchase.purchase_date >= since,
+                UserPurchase.user_id == user_id))
+
+
+def _user_items_cte(user_id: uuid.UUID):
+    '''CTE с товарами, которые покупал пользователь.'''
+    return select(UserPurchase.item_id).where(
+        UserPurchase.user_id == user_id).distinct().cte('user_items')
+
+
+async def has_similar_users(user_id: uuid.UUID,
+                            session: AsyncSession) -> bool:
+    '''Проверяем, есть ли пользователи с общими покупками.'''
+    user_items = _user_items_cte(user_id)
+    query = select(UserPurchase.user_id).join(
+        user_items, UserPurchase.item_id == user_items.c.item_id
+    ).where(UserPurchase.user_id != user_id).limit(1)
+    result = await session.execute(query)
+    return result.first() is not None
+
+
+async def find_recommended_items(user_id: uuid.UUID,
+                                 session: AsyncSession,
+                                 limit: int = 1) -> list[tuple[uuid.UUID,
+                                                               int]]:
+    '''
+    Считаем популярность товаров среди схожих пользователей
+    одним агрегирующим запросом к базе данных.
+
+    В Python возвращаются только limit самых популярных товаров.
+    '''
+    user_items = _user_items_cte(user_id)
+    similar_users = select(UserPurchase.user_id).join(
+        user_items, UserPurchase.item_id == user_items.c.item_id
+    ).where(UserPurchase.user_id != user_id).distinct().cte('similar_users')
+
+    score = func.count().label('score')
+    query = select(UserPurchase.item_id, score).join(
+        similar_users, UserPurchase.user_id == similar_users.c.user_id
+    ).where(
+        UserPurchase.item_id.not_in(select(user_items.c.item_id))
+    ).group_by(UserPurchase.item_id).order_by(
+        score.desc(), UserPurchase.item_id).limit(limit)
+    result = await session.execute(query)
+    return [(item_id, score) for item_id, score in result.all()]
+
+
+async def bump_cooccurrence(
+    carts: list[tuple[uuid.UUID, list[uuid.UUID]]],
+    session: AsyncSession
+) -> None:
+    '''
+    Увеличиваем счетчики совместных покупок для новых товаров
+    пользователей.
+
+    carts - пары (пользователь, товары покупки) в порядке покупок.
+    Вызывается до добавления покупок в сессию, в той же транзакции:
+    уже купленные товары всех пользователей читаются одним запросом,
+    а счетчики обновляются одним запросом.
+    Повторная покупка уже купленного товара счетчики не меняет.
+
+    Чтение блокирует строки пользователей (SELECT ... FOR UPDATE)
+    до конца транзакции: иначе две одновременные покупки одного
+    пользователя видят одни и те же товары новыми и увеличивают
+    счетчики дважды. SQLite блокировки строк не поддерживает,
+    но и не допускает двух пишущих транзакций сразу.
+    '''
+    user_ids = {user_id for user_id, _ in carts}
+    # Строки пользователей блокируются в порядке id, чтобы покупки
+    # нескольких пользователей не ждали друг друга по кругу.
+    result = await session.execute(
+        select(User.id, UserPurchase.item_id).outerjoin(
+            UserPurchase, UserPurchase.user_id == User.id
+        ).where(User.id.in_(user_ids)).order_by(User.id).with_for_update(
+            of=User))
+    owned: dict[uuid.UUID, set] = {user_id: set() for user_id in user_ids}
+    for user_id, item_id in result.all():
+        if item_id is not None:
+            owned[user_id].add(item_id)
+
+    counts = Counter()
+    for user_id, item_ids in carts:
+        existing = owned[user_id]
+        new_items = [item_id for item_id in dict.fromkeys(item_ids)
+                     if item_id not in existing]
+        for item_id in new_items:
+            for other_item_id in new_items:
+                counts[item_id, other_item_id] += 1
+            for other_item_id in existing:
+                counts[item_id, other_item_id] += 1
+                counts[other_item_id, item_id] += 1
+        existing.update(new_items)
+    if not counts:
+        return
+
+    # Счетчики обновляются в порядке ключа: покупки разных
+    # пользователей с общими товарами иначе блокируют одни и те же
+    # строки в разном порядке и могут ждать друг друга по кругу.
+    rows = [{'item_id': item_id, 'other_item_id': other_item_id,
+             'count': count}
+            for (item_id, other_item_id), count in sorted(counts.items())]
+    dialect = postgresql if session.bind.dialect.name == 'postgresql' \
+        else sqlite
+    query = dialect.insert(ItemCooccurrence).values(rows)
+    query = query.on_conflict_do_update(
+        index_elements=[ItemCooccurrence.item_id,
+                        ItemCooccurrence.other_item_id],
+        set_={'count': ItemCooccurrence.count + query.excluded.count})
+    await session.execute(query)
+
+
+async def rebuild_cooccurrence(session: AsyncSession) -> None:
+    '''Пересчитываем таблицу совместных покупок по всей истории.'''
+    owned = select(UserPurchase.user_id, UserPurchase.item_id).distinct(
+    ).subquery()
+    other = owned.alias()
+    pairs = select(
+        owned.c.item_id, other.c.item_id, func.count()
+    ).join(other, owned.c.user_id == other.c.user_id).group_by(
+        owned.c.item_id, other.c.item_id)
+
+    await session.execute(delete(ItemCooccurrence))
+    await session.execute(insert(ItemCooccurrence).from_select(
+        ['item_id', 'other_item_id', 'count'], pairs))
+    await session.commit()
+
+
+async def find_cooccurrence_items(user_id: uuid.UUID,
+                                  session: AsyncSession,
+                                  limit: int = 1) -> list[tuple[uuid.UUID,
+                                                                int]]:
     '''
-    Получаем DataFrame из базы данных
-    и делим его на столбцы user_id и item_id.
+    Суммируем совместные покупки по товарам пользователя.
+
+    Читаются только строки таблицы совместных покупок для товаров
+    пользователя, история покупок других пользователей не нужна.
     '''
+    user_items = select(UserPurchase.item_id).where(
+        UserPurchase.user_id == user_id)
+    score = func.sum(ItemCooccurrence.count).label('score')
+    query = select(ItemCooccurrence.other_item_id, score).where(
+        ItemCooccurrence.item_id.in_(user_items),
+        ItemCooccurrence.other_item_id.not_in(user_items)
+    ).group_by(ItemCooccurrence.other_item_id).order_by(
+        score.desc(), ItemCooccurrence.other_item_id).limit(limit)
+    result = await session.execute(query)
+    return [(item_id, score) for item_id, score in result.all()]
+
+
+async def has_cooccurring_users(user_id: uuid.UUID,
+                                session: AsyncSession) -> bool:
+    '''Проверяем, покупал ли кто-то еще товары пользователя.'''
+    user_items = select(UserPurchase.item_id).where(
+        UserPurchase.user_id == user_id)
+    query = select(ItemCooccurrence.item_id).where(
+        ItemCooccurrence.item_id.in_(user_items),
+        ItemCooccurrence.other_item_id == ItemCooccurrence.item_id,
+        ItemCooccurrence.count > 1).limit(1)
     result = await session.execute(query)
-    purchases_df = pd.DataFrame(result.fetchall(), columns=result.keys())
-    purchases_df['UserPurchase'] = purchases_df['UserPurchase'].astype(str)
-    purchases_df = purchases_df['UserPurchase'].str.split(' купил ',
-                                                          expand=True)
-    purchases_df.columns = ['user_id', 'item_id']
-    return purchases_df
+    return result.first() is not None
+
+
+async def rebuild_item_neighbours(session: AsyncSession, n: int,
+                                  metric: str = 'cosine',
+                                  chunk_size: int = PURCHASES_CHUNK_SIZE
+                                  ) -> int:
+    '''
+    Пересчитываем таблицу похожих товаров по всей истории покупок.
+
+    Для каждого товара сохраняется до n соседей. Возвращает число
+    сохраненных пар.
+    '''
+    interactions = await load_interactions(session)
+    items, neighbours, scores = await run_cpu_bound(
+        item_neighbours, interactions.user_codes, interactions.item_codes,
+        interactions.shape, n, metric)
+
+    await session.execute(delete(ItemNeighbour))
+    for start in range(0, items.size, chunk_size):
+        end = start + chunk_size
+        await session.execute(insert(ItemNeighbour), [
+            {'item_id': item, 'neighbour_id': neighbour,
+             'score': float(score)}
+            for item, neighbour, score in zip(
+                interactions.items.uuids_of(items[start:end]),
+                interactions.items.uuids_of(neighbours[start:end]),
+                scores[start:end])])
+    await session.commit()
+    return int(items.size)
+
+
+async def find_neighbour_items(user_id: uuid.UUID, session: AsyncSession,
+                               limit: int = 1) -> list[tuple[uuid.UUID,
+                                                             float]]:
+    '''
+    Суммируем сходство соседей товаров пользователя.
+
+    Читаются только списки соседей купленных товаров, поэтому время
+    не зависит от числа пользователей.
+    '''
+    user_items = select(UserPurchase.item_id).where(
+        UserPurchase.user_id == user_id)
+    score = func.sum(ItemNeighbour.score).label('score')
+    query = select(ItemNeighbour.neighbour_id, score).where(
+        ItemNeighbour.item_id.in_(user_items),
+        ItemNeighbour.neighbour_id.not_in(user_items)
+    ).group_by(ItemNeighbour.neighbour_id).order_by(
+        score.desc(), ItemNeighbour.neighbour_id).limit(limit)
+    result = await session.execute(query)
+    return [(item_id, score) for item_id, score in result.all()]
+
+
+async def rebuild_popularity(session: AsyncSession, n: int) -> None:
+    '''
+    Пересчитываем самые популярные товары по всей истории покупок.
+
+    Популярность - число разных покупателей товара. Сохраняется до n
+    товаров среди всех покупок и до n в каждой категории.
+    '''
+    buyers = func.count(UserPurchase.user_id.distinct())
+    by_category = select(
+        UserPurchase.category.label('category'),
+        UserPurchase.item_id.label('item_id'),
+        buyers.label('count'),
+        func.row_number().over(
+            partition_by=UserPurchase.category,
+            order_by=(buyers.desc(), UserPurchase.item_id)).label('rank')
+    ).group_by(UserPurchase.category, UserPurchase.item_id).subquery()
+    overall = select(
+        literal(GLOBAL_CATEGORY).label('category'),
+        UserPurchase.item_id.label('item_id'),
+        buyers.label('count'),
+        func.row_number().over(
+            order_by=(buyers.desc(), UserPurchase.item_id)).label('rank')
+    ).group_by(UserPurchase.item_id).subquery()
+
+    await session.execute(delete(ItemPopularity))
+    for ranked in (by_category, overall):
+        await session.execute(insert(ItemPopularity).from_select(
+            ['category', 'rank', 'item_id', 'count'],
+            select(ranked.c.category, ranked.c.rank, ranked.c.item_id,
+                   ranked.c.count).where(ranked.c.rank <= n)))
+    await session.commit()
+
+
+async def find_popular_items(user_id: uuid.UUID, session: AsyncSession,
+                             limit: int = 1
+                             ) -> list[tuple[uuid.UUID, float, str]]:
+    '''
+    Популярные товары, которые пользователь ещё не покупал.
+
+    Сначала идут товары любимой категории пользователя (в которой
+    больше всего его покупок), затем популярные среди всех. Читается
+    не больше 2 * limit строк заранее рассчитанной таблицы, поэтому
+    время не зависит от числа покупок. Возвращает товар, число его
+    покупателей и категорию списка (GLOBAL_CATEGORY для общего).
+    '''
+    user_items = select(UserPurchase.item_id).where(
+        UserPurchase.user_id == user_id)
+    favourite = select(UserPurchase.category).where(
+        UserPurchase.user_id == user_id
+    ).group_by(UserPurchase.category).order_by(
+        func.count().desc(), UserPurchase.category).limit(1).scalar_subquery()
+    query = select(
+        ItemPopularity.item_id, ItemPopularity.count, ItemPopularity.category
+    ).where(
+        or_(ItemPopularity.category == favourite,
+            ItemPopularity.category == GLOBAL_CATEGORY),
+        ItemPopularity.item_id.not_in(user_items)
+    ).order_by(ItemPopularity.category == GLOBAL_CATEGORY,
+               ItemPopularity.rank).limit(2 * limit)
+    result = await session.execute(query)
+
+    popular = {}
+    for item_id, count, category in result.all():
+        if item_id not in popular:
+            popular[item_id] = (item_id, float(count), category)
+    return list(popular.values())[:limit]
@@ -3,24 +3,42 @@ from typing import AsyncGenerator
 import pytest_asyncio
 from fastapi import FastAPI
 from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
                                     create_async_engine)
 
+from app import query_budget
+from app.cache import recommendation_cache
 from app.db import Model, get_db
+from app.engine_cache import matrix_engine_cache
+from app.executor import run_cpu_bound
+from app.interning import item_interner, user_interner
+from app.jobs import JobManager, recommendation_jobs
+from app.lsh import lsh_index_cache
+from app.metrics import MetricsMiddleware, instrument_engine
 from app.models import Item, User, UserPurchase
-from app.routers import (gen_recommendation_router, item_router,
+from app.routers import (admin_router, gen_recommendation_router,
+                         internal_router, item_router, metrics_router,
                          purchase_router, recommendation_router, user_router)
 
+# В тестах превышение бюджета запросов к базе - ошибка теста.
+query_budget.QUERY_BUDGET_MODE = 'raise'
+
 app = FastAPI()
 app.include_router(user_router)
 app.include_router(item_router)
 app.include_router(purchase_router)
 app.include_router(recommendation_router)
 app.include_router(gen_recommendation_router)
+app.include_router(admin_router)
+app.include_router(internal_router)
+app.include_router(metrics_router)
+app.add_middleware(MetricsMiddleware)
 
 engine_test = create_async_engine(
     'sqlite+aiosqlite:///test_db.db',
 )
+instrument_engine(engine_test)
 
 
 test_db_session = async_sessionmaker(engine_test, expire_on_commit=False)
@@ -50,9 +68,17 @@ CATEGORY2 = 'chips'
 async def test_db():
     '''
     Запускает тестовую базу данных и после каждого теста удаляет её.
+
+    Таблицы, оставшиеся от прерванного запуска, удаляются заранее.
     '''
     async with engine_test.begin() as conn:
+        await conn.run_sync(Model.metadata.drop_all)
         await conn.run_sync(Model.metadata.create_all)
+    await recommendation_cache.clear()
+    lsh_index_cache.clear()
+    matrix_engine_cache.clear()
+    user_interner.clear()
+    item_interner.clear()
     yield test_db_session()
     async with engine_test.begin() as conn:
         await conn.run_sync(Model.metadata.drop_all)
@@ -78,6 +104,34 @@ async def client():
         yield client
 
 
+@pytest_asyncio.fixture(scope='function')
+async def jobs(test_db) -> AsyncGenerator[JobManager, None]:
+    '''
+    Очередь задач генерации рекомендаций на тестовой базе.
+
+    Пул расчетов запускается заранее: первый расчет в новом пуле
+    процессов ждет их запуска, и это время не должно уходить
+    на ожидание задачи.
+    '''
+    await run_cpu_bound(abs, 0)
+    recommendation_jobs.start(test_db_session)
+    yield recommendation_jobs
+    await recommendation_jobs.stop()
+
+
+@pytest_asyncio.fixture(scope='function')
+async def queries() -> AsyncGenerator[list[str], None]:
+    '''Список SQL-запросов, выполненных тестовой базой во время теста.'''
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine_test.sync_engine, 'before_cursor_execute', capture)
+    yield statements
+    event.remove(engine_test.sync_engine, 'before_cursor_execute', capture)
+
+
 @pytest_asyncio.fixture(scope='function')
 async def item1(async_db: AsyncSession) -> Item:
     '''Фикстура товара 1.'''
@@ -1,10 +1,42 @@
+import datetime as dt
 from http import HTTPStatus
 
 import pytest
+import pytest_asyncio
 from httpx import AsyncClient
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models import Item, User, UserPurchase
+from app import lsh
+from app.interning import item_interner
+from app.models import (Item, ItemCooccurrence, Recommendation, User,
+                        UserPurchase)
+from app.orm_query import RecommendRepository
+from app.schemas import RecommendationMode, RecommendationSource
+from app.utils import (rebuild_cooccurrence, rebuild_item_neighbours,
+                       rebuild_popularity)
+
+EXACT_MODES = (RecommendationMode.matrix, RecommendationMode.sql)
+
+
+@pytest_asyncio.fixture(params=[mode.value for mode in RecommendationMode])
+async def mode(request, async_db: AsyncSession, monkeypatch) -> str:
+    '''
+    Способ расчета рекомендации.
+
+    Запрашивается последним, после фикстур покупок, поэтому может
+    пересчитать производные таблицы по уже созданным покупкам.
+    '''
+    if request.param == RecommendationMode.cooccurrence:
+        await rebuild_cooccurrence(async_db)
+    if request.param == RecommendationMode.item:
+        await rebuild_item_neighbours(async_db, n=10)
+    if request.param == RecommendationMode.lsh:
+        # Однострочные полосы: на маленьких данных все пары
+        # с общими покупками становятся кандидатами.
+        monkeypatch.setattr(lsh, 'LSH_BANDS', 64)
+        monkeypatch.setattr(lsh, 'LSH_ROWS', 1)
+    return request.param
 
 
 @pytest.mark.asyncio
@@ -14,16 +46,17 @@ async def test_get_right_recomendation(
     item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
     purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
     purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
-    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase,
+    mode: str
 ) -> None:
     '''Проверка на получение рекомендации пользователя.'''
-    data = {'user_id': str(user1.id)}
+    data = {'user_id': str(user1.id), 'mode': mode}
     response = await client.post('/generate_recommendations',
                                  json=data)
 
     response = await client.get(f'/recommendations?user_id={user1.id}')
     response_data = response.json()
-    data = response_data['data']['item_id']
+    data = response_data['data'][0]['item_id']
 
     assert (data == str(item3.id) or data == str(item5.id))
 
@@ -35,13 +68,14 @@ async def test_user_with_no_recs1(
     item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
     purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
     purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
-    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase,
+    mode: str
 ) -> None:
     '''
     Если у пользователя нет общих покупок с другими пользователями,
     то для него нет рекомендаций.
     '''
-    data = {'user_id': str(user3.id)}
+    data = {'user_id': str(user3.id), 'mode': mode}
     response = await client.post('/generate_recommendations',
                                  json=data)
     response_data = response.json()
@@ -66,13 +100,14 @@ async def test_user_with_no_recs2(
     item2: Item, item4: Item,
     purchase2_user1: UserPurchase,
     purchase1_user2: UserPurchase,
-    purchase1_user3: UserPurchase
+    purchase1_user3: UserPurchase,
+    mode: str
 ) -> None:
     '''
     Если у пользователей одинаковые покупки,
     то пользователю нечего порекомендовать.
     '''
-    data = {'user_id': str(user1.id)}
+    data = {'user_id': str(user1.id), 'mode': mode}
     response = await client.post('/generate_recommendations',
                                  json=data)
     response_data = response.json()
@@ -88,3 +123,250 @@ async def test_user_with_no_recs2(
 
     assert response.status_code == HTTPStatus.NOT_FOUND
     assert response_data['detail'] == ('Нет рекомендаций.')
+
+
+@pytest.mark.asyncio
+async def test_modes_return_same_ranking(
+    async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''
+    Точные способы расчета дают одинаковый список товаров, при равной
+    популярности - по возрастанию id товара.
+    '''
+    # Коды выдаются по порядку появления: больший id получает меньший код
+    item_interner.add(max(item3.id, item5.id))
+    rankings = [
+        await RecommendRepository.rank_items(user1.id, mode, async_db, k=10)
+        for mode in EXACT_MODES
+    ]
+
+    assert rankings[0] == [(item_id, 1)
+                           for item_id in sorted([item3.id, item5.id])]
+    assert all(ranking == rankings[0] for ranking in rankings)
+
+
+@pytest.mark.asyncio
+async def test_generate_recommendations_batch(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''Пакетная генерация создает рекомендации всем, кому возможно.'''
+    response = await client.post('/admin/generate_recommendations', json={})
+    response_data = response.json()['data']
+
+    assert response.status_code == HTTPStatus.CREATED
+    assert response_data['users'] == 3
+    assert response_data['generated'] == 2
+    assert response_data['skipped'] == 1
+
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+    data = response.json()['data'][0]['item_id']
+    assert data in (str(item3.id), str(item5.id))
+
+    response = await client.get(f'/recommendations?user_id={user2.id}')
+    assert response.json()['data'][0]['item_id'] == str(item1.id)
+
+    response = await client.get(f'/recommendations?user_id={user3.id}')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_generate_recommendations_batch_keeps_fallback(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''
+    Пакетная генерация не удаляет списки пропущенных пользователей,
+    а рассчитанные рекомендации помечает как личные.
+    '''
+    async_db.add(Recommendation(
+        user_id=user3.id, item_id=item2.id, score=1, rank=1,
+        source=RecommendationSource.popular.value))
+    await async_db.commit()
+
+    await client.post('/admin/generate_recommendations', json={})
+
+    response = await client.get(f'/recommendations?user_id={user3.id}')
+    assert response.json()['data'][0]['source'] == 'popular'
+    response = await client.get(f'/recommendations?user_id={user2.id}')
+    assert response.json()['data'][0]['source'] == 'personal'
+
+
+@pytest.mark.asyncio
+async def test_generate_recommendations_batch_for_users(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''Пакетная генерация только для переданных пользователей.'''
+    data = {'user_ids': [str(user2.id)]}
+    response = await client.post('/admin/generate_recommendations',
+                                 json=data)
+    response_data = response.json()['data']
+
+    assert response_data['users'] == 1
+    assert response_data['generated'] == 1
+
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_purchase_updates_cooccurrence(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User,
+    item1: Item, item2: Item, item3: Item
+) -> None:
+    '''
+    Покупка обновляет совместные покупки так же,
+    как полный пересчет по истории.
+    '''
+    carts = [(user1, [item1, item2]), (user2, [item2]),
+             (user2, [item3, item2]), (user1, [item1])]
+    for user, cart in carts:
+        data = {'user_id': str(user.id),
+                'cart': [{'id': str(item.id), 'category': item.category}
+                         for item in cart]}
+        await client.post('/purchases', json=data)
+
+    query = select(ItemCooccurrence.item_id, ItemCooccurrence.other_item_id,
+                   ItemCooccurrence.count)
+    incremental = set((await async_db.execute(query)).all())
+    await rebuild_cooccurrence(async_db)
+    rebuilt = set((await async_db.execute(query)).all())
+
+    assert incremental == rebuilt
+    assert (item1.id, item3.id, 1) not in incremental
+    assert (item2.id, item2.id, 2) in incremental
+    assert (item3.id, item2.id, 1) in incremental
+
+    data = {'user_id': str(user1.id), 'mode': 'cooccurrence'}
+    response = await client.post('/generate_recommendations', json=data)
+    assert response.status_code == HTTPStatus.CREATED
+
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+    assert response.json()['data'][0]['item_id'] == str(item3.id)
+
+
+@pytest.mark.asyncio
+async def test_get_ranked_recommendations(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''Сохраняется весь список рекомендаций, его можно листать.'''
+    await client.post('/generate_recommendations',
+                      json={'user_id': str(user1.id)})
+
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+    data = response.json()['data']
+
+    assert [row['rank'] for row in data] == [1, 2]
+    assert {row['item_id'] for row in data} == {str(item3.id),
+                                                str(item5.id)}
+    assert all(row['score'] == 1 for row in data)
+
+    response = await client.get(
+        f'/recommendations?user_id={user1.id}&limit=1&offset=1')
+
+    assert response.json()['data'] == data[1:]
+
+
+@pytest.mark.asyncio
+async def test_cold_start_user_gets_popular_items(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase,
+    mode: str
+) -> None:
+    '''
+    Пользователю без общих покупок рекомендуются популярные товары:
+    сначала из его любимой категории, затем среди всех.
+    '''
+    await rebuild_popularity(async_db, n=10)
+
+    data = {'user_id': str(user3.id), 'mode': mode}
+    response = await client.post('/generate_recommendations', json=data)
+    assert response.status_code == HTTPStatus.CREATED
+
+    response = await client.get(f'/recommendations?user_id={user3.id}')
+    data = response.json()['data']
+
+    assert [(row['item_id'], row['source']) for row in data[:2]] == [
+        (str(item5.id), 'category'), (str(item2.id), 'popular')]
+    assert {row['item_id'] for row in data[2:]} == {str(item1.id),
+                                                    str(item3.id)}
+    assert data[1]['score'] == 2
+
+
+@pytest.mark.asyncio
+async def test_user_without_purchases_gets_global_popular(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, item1: Item, item2: Item, item3: Item,
+    item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase
+) -> None:
+    '''Без покупок рекомендуются товары, популярные среди всех.'''
+    await rebuild_popularity(async_db, n=1)
+    user = User(username='newcomer')
+    async_db.add(user)
+    await async_db.commit()
+
+    await client.post('/generate_recommendations',
+                      json={'user_id': str(user.id)})
+    response = await client.get(f'/recommendations?user_id={user.id}')
+
+    assert response.json()['data'] == [{'item_id': str(item2.id),
+                                        'score': 2.0, 'rank': 1,
+                                        'source': 'popular'}]
+
+
+@pytest.mark.asyncio
+async def test_recent_mode_uses_window_and_decay(
+    async_db: AsyncSession, user1: User, user2: User, user3: User,
+    item1: Item, item3: Item, item4: Item, item5: Item
+) -> None:
+    '''
+    Режим recent не видит покупок старше окна, а свежие покупки
+    весят больше старых.
+    '''
+    now = dt.datetime.now()
+    purchases = [(user1, item1, 400), (user2, item1, 1), (user2, item3, 1),
+                 (user3, item1, 5), (user3, item4, 200), (user3, item5, 30)]
+    async_db.add_all([
+        UserPurchase(user_id=user.id, item_id=item.id,
+                     category=item.category,
+                     purchase_date=now - dt.timedelta(days=days))
+        for user, item, days in purchases])
+    await async_db.commit()
+
+    ranking = await RecommendRepository.rank_items(
+        user1.id, RecommendationMode.recent, async_db, k=10)
+
+    assert [item_id for item_id, _ in ranking] == [item3.id, item5.id]
+    assert ranking[0][1] == pytest.approx(2 ** (-1 / 30), rel=1e-3)
+    assert ranking[1][1] == pytest.approx(0.5, rel=1e-3)
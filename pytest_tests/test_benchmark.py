@@ -0,0 +1,92 @@
+import datetime as dt
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import executor
+from app.benchmark import compare_results, run_benchmark
+from app.models import Item, User, UserPurchase
+from app.schemas import RecommendationMode
+from app.synthetic import generate_dataset
+
+END = dt.datetime(2024, 1, 1)
+
+
+async def purchase_pairs(session: AsyncSession) -> list[tuple]:
+    '''Пары (пользователь, товар) всех покупок.'''
+    result = await session.execute(
+        select(UserPurchase.user_id, UserPurchase.item_id)
+        .order_by(UserPurchase.id))
+    return result.all()
+
+
+@pytest.mark.asyncio
+async def test_generate_dataset(async_db: AsyncSession) -> None:
+    '''Генератор создает заданный объем данных с верными категориями.'''
+    stats = await generate_dataset(async_db, users=50, items=30,
+                                   purchases=1_000, seed=1, categories=5,
+                                   chunk_size=300, end=END)
+
+    assert stats.purchases == 1_000
+    assert await async_db.scalar(select(func.count(User.id))) == 50
+    assert await async_db.scalar(select(func.count(Item.id))) == 30
+    wrong_category = await async_db.scalar(
+        select(func.count(UserPurchase.id))
+        .join(Item, Item.id == UserPurchase.item_id)
+        .where(Item.category != UserPurchase.category))
+    assert wrong_category == 0
+
+
+@pytest.mark.asyncio
+async def test_generate_dataset_is_seeded(async_db: AsyncSession) -> None:
+    '''С тем же seed получается тот же набор покупок.'''
+    await generate_dataset(async_db, users=20, items=10, purchases=200,
+                           seed=7, end=END)
+    first = await purchase_pairs(async_db)
+    for model in (UserPurchase, Item, User):
+        await async_db.execute(model.__table__.delete())
+
+    await generate_dataset(async_db, users=20, items=10, purchases=200,
+                           seed=7, end=END)
+
+    assert await purchase_pairs(async_db) == first
+
+
+def test_compare_results() -> None:
+    '''Регрессией считается рост метрики больше порога.'''
+    base = {'results': [{'scale': 'small', 'mode': 'sql',
+                         'latency_p50_ms': 10.0, 'latency_p95_ms': 20.0,
+                         'peak_memory_mb': 1.0, 'queries': 4,
+                         'rows_read': None}]}
+    new = {'results': [{'scale': 'small', 'mode': 'sql',
+                        'latency_p50_ms': 11.0, 'latency_p95_ms': 30.0,
+                        'peak_memory_mb': 0.5, 'queries': 4,
+                        'rows_read': None},
+                       {'scale': 'large', 'mode': 'sql',
+                        'latency_p50_ms': 100.0}]}
+
+    regressions = compare_results(base, new, threshold=0.2)
+
+    assert [(regression.metric, regression.change)
+            for regression in regressions] == [('latency_p95_ms', 0.5)]
+
+
+@pytest.mark.asyncio
+async def test_run_benchmark_scales(monkeypatch: pytest.MonkeyPatch) -> None:
+    '''
+    Каждая точка масштаба считается по своей базе: режим matrix
+    ошибается на тех же пользователях, что и sql.
+    '''
+    monkeypatch.setattr(executor, 'RECOMMENDATION_EXECUTOR',
+                        executor.RECOMMENDATION_EXECUTOR)
+    scales = ['60:30:600', '40:20:400']
+
+    report = await run_benchmark(
+        scales, [RecommendationMode.sql, RecommendationMode.matrix],
+        sample=5)
+
+    errors = {(result['scale'], result['mode']): result['errors']
+              for result in report['results']}
+    assert [errors[scale, 'matrix'] for scale in scales] == [
+        errors[scale, 'sql'] for scale in scales]
@@ -0,0 +1,70 @@
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import LRUCache
+from app.models import Item, User, UserPurchase
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_evicts_oldest() -> None:
+    '''Кэш вытесняет давно не использованные записи.'''
+    cache = LRUCache(maxsize=2, ttl=60)
+    await cache.set('a', 1)
+    await cache.set('b', 2)
+    await cache.get('a')
+    await cache.set('c', 3)
+
+    assert await cache.get('b') is None
+    assert await cache.get('a') == 1
+    assert await cache.get('c') == 3
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 1
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_expires_entries() -> None:
+    '''Записи с истекшим временем жизни не возвращаются.'''
+    cache = LRUCache(maxsize=2, ttl=0)
+    await cache.set('a', 1)
+
+    assert await cache.get('a') is None
+    assert cache.stats()['size'] == 0
+
+
+@pytest.mark.asyncio
+async def test_recommendation_is_cached(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''
+    Повторное чтение рекомендации берется из кэша,
+    а генерация обновляет запись в кэше.
+    '''
+    before = (await client.get('/internal/cache')).json()['data']
+    await client.post('/generate_recommendations',
+                      json={'user_id': str(user1.id)})
+    first = await client.get(f'/recommendations?user_id={user1.id}')
+    second = await client.get(f'/recommendations?user_id={user1.id}')
+    stats = (await client.get('/internal/cache')).json()['data']
+
+    assert first.json() == second.json()
+    assert stats['hits'] - before['hits'] == 2
+    assert stats['misses'] == before['misses']
+
+    recommended, other = item3, item5
+    if first.json()['data'][0]['item_id'] == str(item5.id):
+        recommended, other = item5, item3
+    data = {'user_id': str(user1.id),
+            'cart': [{'id': str(recommended.id),
+                      'category': recommended.category}]}
+    await client.post('/purchases', json=data)
+    await client.post('/generate_recommendations',
+                      json={'user_id': str(user1.id)})
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+
+    assert response.json()['data'][0]['item_id'] == str(other.id)
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import engine_cache
+from app.engine_cache import MatrixEngineCache
+from app.models import UserPurchase
+
+
+@pytest.mark.asyncio
+async def test_engine_is_built_once(
+    async_db: AsyncSession, purchase1_user1: UserPurchase,
+    purchase1_user2: UserPurchase, monkeypatch
+) -> None:
+    '''Одновременные запросы без готовой матрицы строят её один раз.'''
+    loads = []
+    load_interactions = engine_cache.load_interactions
+
+    async def counted_load(session: AsyncSession):
+        loads.append(session)
+        await asyncio.sleep(0.01)
+        return await load_interactions(session)
+
+    monkeypatch.setattr(engine_cache, 'load_interactions', counted_load)
+    cache = MatrixEngineCache(ttl=60)
+
+    engines = await asyncio.gather(*(cache.get(async_db) for _ in range(3)))
+
+    assert len(loads) == 1
+    assert engines[1] is engines[0] and engines[2] is engines[0]
+    assert await cache.get(async_db) is engines[0]
+    assert len(loads) == 1
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from app import executor
+from app.recommender import NO_SIMILAR_USERS, NotEnoughDataError, score_user
+
+
+@pytest.fixture(params=['process', 'thread', 'inline'])
+def executor_kind(request, monkeypatch):
+    monkeypatch.setattr(executor, 'RECOMMENDATION_EXECUTOR', request.param)
+    executor.shutdown_executor()
+    yield request.param
+    executor.shutdown_executor()
+
+
+@pytest.mark.asyncio
+async def test_run_cpu_bound_returns_result(executor_kind) -> None:
+    '''Результат расчета не зависит от того, где он выполнялся.'''
+    users = np.array([0, 1, 1])
+    items = np.array([0, 0, 1])
+
+    top, scores, timings = await executor.run_cpu_bound(
+        score_user, users, items, (2, 2), 0, 5)
+
+    assert top.tolist() == [1]
+    assert scores.tolist() == [1]
+    assert set(timings) == {'similar_users', 'counting'}
+
+
+@pytest.mark.asyncio
+async def test_run_cpu_bound_reraises_errors(executor_kind) -> None:
+    '''Ошибки расчета доходят до вызывающего кода.'''
+    with pytest.raises(NotEnoughDataError) as error:
+        await executor.run_cpu_bound(
+            score_user, np.array([0]), np.array([0]), (1, 1), 0, 5)
+
+    assert error.value.detail == NO_SIMILAR_USERS
+
+
+@pytest.mark.asyncio
+async def test_run_cpu_bound_timeout(monkeypatch) -> None:
+    '''Слишком долгий расчет завершается ошибкой 503.'''
+    monkeypatch.setattr(executor, 'RECOMMENDATION_EXECUTOR', 'thread')
+    executor.shutdown_executor()
+    try:
+        with pytest.raises(HTTPException) as error:
+            await executor.run_cpu_bound(time.sleep, 0.5, timeout=0.05)
+    finally:
+        executor.shutdown_executor()
+
+    assert error.value.status_code == 503
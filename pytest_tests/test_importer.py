@@ -0,0 +1,57 @@
+import uuid
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.importer import import_purchases, save_state
+from app.models import Item, User, UserPurchase
+
+
+async def count_purchases(session: AsyncSession) -> int:
+    '''Число покупок в базе.'''
+    result = await session.execute(select(func.count(UserPurchase.id)))
+    return result.scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_import_purchases_csv(async_db: AsyncSession, tmp_path,
+                                    user1: User, user2: User,
+                                    item1: Item, item4: Item) -> None:
+    '''
+    Импорт загружает верные строки, отбрасывает неверные
+    и строки без даты и при повторном запуске продолжает с места остановки.
+    '''
+    path = tmp_path / 'purchases.csv'
+    path.write_text('\n'.join([
+        'user,item,category,purchase_date',
+        f'{user1.id},{item1.id},{item1.category},2024-01-01 10:00:00',
+        f'{user2.id},{item4.id},{item4.category},2024-02-01T10:00:00Z',
+        f'{user2.id},{uuid.uuid4()},{item1.category},2024-03-01',
+        f'{user1.id},{item4.id},{item1.category},2024-04-01',
+        f'{user2.id},{item1.id},{item1.category},',
+        f'{user1.id},{item1.id},{item1.category},not-a-date',
+        f'{user2.id},{item1.id},{item1.category},2024-05-01',
+    ]))
+    state_path = str(tmp_path / 'state.json')
+
+    stats = await import_purchases(str(path), async_db, batch_size=2,
+                                   state_path=state_path)
+
+    assert stats.rows == 7
+    assert stats.imported == 3
+    assert stats.rejected == 4
+    assert await count_purchases(async_db) == 3
+
+    save_state(state_path, 3)
+    stats = await import_purchases(str(path), async_db, batch_size=2,
+                                   state_path=state_path)
+
+    assert stats.skipped == 3
+    assert stats.rows == 4
+    assert await count_purchases(async_db) == 3
+
+    save_state(state_path, 0)
+    await import_purchases(str(path), async_db, state_path=state_path)
+
+    assert await count_purchases(async_db) == 3
@@ -0,0 +1,25 @@
+import uuid
+
+import numpy as np
+
+from app.interning import UUID_DTYPE, IdInterner
+
+
+def test_interner_round_trip() -> None:
+    '''Коды плотные, не меняются и переводятся обратно в UUID.'''
+    ids = [uuid.uuid4() for _ in range(3)]
+    interner = IdInterner()
+    first = interner.intern(np.frombuffer(
+        b''.join(value.bytes for value in [ids[1], ids[0], ids[1]]),
+        dtype=UUID_DTYPE))
+    new_code = interner.add(ids[2])
+
+    assert first.dtype == np.int32
+    assert first[0] == first[2] != first[1]
+    assert sorted([*first[:2], new_code]) == [0, 1, 2]
+    assert interner.add(ids[1]) == first[0]
+    assert len(interner) == 3
+    assert interner.uuids_of(first) == [ids[1], ids[0], ids[1]]
+    assert interner.uuid_of(new_code) == ids[2]
+    assert list(interner.codes([ids[2], uuid.uuid4()])) == [new_code, -1]
+    assert interner.code(uuid.uuid4()) is None
@@ -0,0 +1,96 @@
+import asyncio
+import time
+import uuid
+from http import HTTPStatus
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.jobs import JobManager
+from app.models import Item, User, UserPurchase
+from app.schemas import JobStatus, RecommendationAdd
+
+# Сколько секунд ждать завершения задачи.
+JOB_TIMEOUT = 60
+
+
+async def wait_for_job(client: AsyncClient, job_id: str) -> dict:
+    '''Ждет завершения задачи и возвращает её состояние.'''
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        response = await client.get(f'/generate_recommendations/{job_id}')
+        job = response.json()['data']
+        if job['status'] in (JobStatus.done, JobStatus.failed):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError('Задача не завершилась.')
+
+
+@pytest.mark.asyncio
+async def test_background_generation(
+    client: AsyncClient, async_db: AsyncSession, jobs: JobManager,
+    user1: User, user2: User,
+    item1: Item, item2: Item, item3: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase
+) -> None:
+    '''Фоновая задача возвращает 202 и сохраняет рекомендацию.'''
+    response = await client.post('/generate_recommendations?background=true',
+                                 json={'user_id': str(user1.id)})
+    response_data = response.json()
+
+    assert response.status_code == HTTPStatus.ACCEPTED
+    assert response.headers['location'] == (
+        f'/generate_recommendations/{response_data["job_id"]}')
+
+    job = await wait_for_job(client, response_data['job_id'])
+
+    assert job['status'] == JobStatus.done
+    assert job['detail'] == 'Рекомендация успешно сгенерирована.'
+    response = await client.get(f'/recommendations?user_id={user1.id}')
+    assert response.json()['data'][0]['item_id'] == str(item3.id)
+
+
+@pytest.mark.asyncio
+async def test_background_generation_error(
+    client: AsyncClient, async_db: AsyncSession, jobs: JobManager,
+    user1: User, item1: Item, purchase1_user1: UserPurchase
+) -> None:
+    '''Ошибка расчета сохраняется в состоянии задачи.'''
+    response = await client.post('/generate_recommendations?background=true',
+                                 json={'user_id': str(user1.id)})
+
+    job = await wait_for_job(client, response.json()['job_id'])
+
+    assert job['status'] == JobStatus.failed
+    assert job['status_code'] == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_unknown_job(client: AsyncClient, jobs: JobManager) -> None:
+    '''Неизвестная задача - ошибка 404.'''
+    response = await client.get(f'/generate_recommendations/{uuid.uuid4()}')
+
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_pending_requests_coalesce() -> None:
+    '''Повторные запросы, пока задача ждет в очереди, дают одну задачу.'''
+    manager = JobManager()
+    # Без обработчиков задачи остаются в очереди.
+    manager.start(session_factory=None, workers=0)
+    user_id = uuid.uuid4()
+    try:
+        first = await manager.submit(RecommendationAdd(user_id=user_id))
+        second = await manager.submit(RecommendationAdd(user_id=user_id))
+        other = await manager.submit(
+            RecommendationAdd(user_id=user_id, mode='sql'))
+
+        assert first.id == second.id
+        assert other.id != first.id
+        assert manager.stats()['queued'] == 2
+        assert manager.coalesced == 1
+    finally:
+        await manager.stop()
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loadtest import LoadTest, histogram, parse_mix
+from app.models import Item, User, UserPurchase
+
+
+@pytest.mark.asyncio
+async def test_load_test_report(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, item1: Item, item2: Item, item3: Item,
+    purchase1_user1: UserPurchase, purchase1_user2: UserPurchase
+) -> None:
+    '''Отчет учитывает все запросы по маршрутам и без ошибок сервера.'''
+    load_test = LoadTest(
+        client, [user1.id, user2.id],
+        [(item.id, item.category) for item in (item1, item2, item3)],
+        parse_mix('purchase=1,generate=1,recommendations=1'))
+
+    report = await load_test.run(clients=3, requests=30)
+
+    assert report.requests == 30
+    assert report.errors == 0
+    assert sum(route.requests for route in report.routes) == 30
+    for route in report.routes:
+        assert sum(route.histogram.values()) == route.requests
+        assert sum(route.statuses.values()) == route.requests
+
+
+def test_histogram() -> None:
+    '''Задержки попадают в интервалы по верхней границе.'''
+    counts = histogram(np.array([0.5, 1.0, 1.5, 7_000.0]))
+
+    assert counts['<=1ms'] == 2
+    assert counts['<=2ms'] == 1
+    assert counts['>5000ms'] == 1
+
+
+def test_parse_mix_unknown_operation() -> None:
+    '''Неизвестная операция в доле нагрузки - ошибка.'''
+    with pytest.raises(ValueError):
+        parse_mix('delete=1')
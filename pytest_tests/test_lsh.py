@@ -0,0 +1,80 @@
+import asyncio
+
+import numpy as np
+import pytest
+from scipy import sparse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import lsh as lsh_module
+from app.benchmark import measure_lsh
+from app.lsh import MERSENNE_PRIME, LSHIndexCache, MinHashLSH, exact_similar
+from app.models import UserPurchase
+from app.recommender import RecommendationEngine
+
+
+def make_binary(baskets: list[list[int]], items: int) -> sparse.csr_matrix:
+    '''Матрица покупок 0/1 по спискам товаров пользователей.'''
+    rows = [user for user, basket in enumerate(baskets) for _ in basket]
+    cols = [item for basket in baskets for item in basket]
+    return sparse.csr_matrix((np.ones(len(cols), dtype=np.int32),
+                              (rows, cols)), shape=(len(baskets), items))
+
+
+def test_identical_users_are_candidates() -> None:
+    '''Одинаковые покупки дают одинаковые сигнатуры и общие корзины.'''
+    binary = make_binary([[0, 1, 2], [0, 1, 2], [5, 6, 7], []], items=8)
+    lsh = MinHashLSH(bands=8, rows=2).fit(binary)
+    signatures = lsh.signatures_for(binary)
+
+    assert (signatures[0] == signatures[1]).all()
+    assert (signatures[3] == MERSENNE_PRIME).all()
+    assert list(lsh.candidates(0)) == [1]
+    assert list(lsh.candidates(3)) == []
+
+
+def test_similar_ranks_by_jaccard() -> None:
+    '''Кандидаты упорядочены по сходству, без общих покупок - отброшены.'''
+    binary = make_binary([[0, 1, 2, 3], [0, 1, 2], [0, 9], [4, 5]],
+                         items=10)
+    lsh = MinHashLSH(bands=64, rows=1).fit(binary)
+
+    assert list(lsh.similar(0, m=5)) == [1, 2]
+    assert list(lsh.similar(0, m=1)) == [1]
+    assert list(exact_similar(binary, 0, m=5)) == [1, 2]
+
+
+def test_lsh_recall() -> None:
+    '''При многих полосах LSH находит почти всех точных соседей.'''
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, 20, size=500)
+    items = groups * 10 + rng.integers(0, 10, size=(5, 500))
+    engine = RecommendationEngine(np.tile(np.arange(500), 5),
+                                  items.ravel(), (500, 200))
+
+    metrics = measure_lsh(engine, np.arange(50), bands=32, rows=2, m=10)
+
+    assert metrics['recall'] > 0.9
+    assert metrics['candidates_mean'] < 500
+
+
+@pytest.mark.asyncio
+async def test_index_is_built_once(
+    async_db: AsyncSession, purchase1_user1: UserPurchase,
+    purchase1_user2: UserPurchase, monkeypatch
+) -> None:
+    '''Одновременные запросы без готового индекса строят его один раз.'''
+    loads = []
+    load_interactions = lsh_module.load_interactions
+
+    async def counted_load(session: AsyncSession):
+        loads.append(session)
+        await asyncio.sleep(0.01)
+        return await load_interactions(session)
+
+    monkeypatch.setattr(lsh_module, 'load_interactions', counted_load)
+    cache = LSHIndexCache(ttl=60)
+
+    indexes = await asyncio.gather(*(cache.get(async_db) for _ in range(3)))
+
+    assert len(loads) == 1
+    assert indexes[1] is indexes[0] and indexes[2] is indexes[0]
@@ -0,0 +1,73 @@
+import re
+from http import HTTPStatus
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.metrics import CONTENT_TYPE, REGISTRY, Histogram
+from app.models import Item, User, UserPurchase
+
+
+def sample(text: str, name: str, **labels) -> float:
+    '''Значение ряда метрики из ответа /metrics.'''
+    for line in text.splitlines():
+        series, _, value = line.rpartition(' ')
+        if not series.startswith(name + '{') and series != name:
+            continue
+        found = dict(re.findall(r'(\w+)="([^"]*)"', series))
+        if all(found.get(key) == str(expected) for key, expected
+               in labels.items()):
+            return float(value)
+    raise AssertionError(f'Нет ряда {name} {labels}.')
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, user2: User, item1: Item, item2: Item, item3: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase
+) -> None:
+    '''/metrics отдает время маршрутов, запросы к базе и этапы расчета.'''
+    response = await client.post('/generate_recommendations',
+                                 json={'user_id': str(user1.id),
+                                       'mode': 'matrix'})
+    assert response.status_code == HTTPStatus.CREATED
+    await client.get(f'/items/{item1.id}')
+
+    response = await client.get('/metrics')
+    text = response.text
+
+    assert response.headers['content-type'] == CONTENT_TYPE
+    assert sample(text, 'http_request_duration_seconds_count',
+                  method='POST', route='/generate_recommendations',
+                  status=201) >= 1
+    # Маршрут - шаблон пути, а не конкретный id
+    assert sample(text, 'http_request_duration_seconds_count',
+                  route='/items/{item_id}', status=200) >= 1
+    assert sample(text, 'http_request_db_queries_sum',
+                  route='/generate_recommendations') >= 4
+    for phase in ('load', 'similar_users', 'counting', 'persist'):
+        assert sample(text, 'recommendation_phase_seconds_count',
+                      mode='matrix', phase=phase) >= 1
+
+
+def test_histogram_render() -> None:
+    '''Интервалы гистограммы накопительные, как требует Prometheus.'''
+    histogram = Histogram('test_seconds', 'Тест.', ('route',),
+                          buckets=(0.1, 1.0))
+    REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, route='/a')
+
+    lines = histogram.render().splitlines()
+
+    assert lines[1] == '# TYPE test_seconds histogram'
+    assert lines[2:] == [
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 3',
+        'test_seconds_bucket{route="/a",le="+Inf"} 4',
+        'test_seconds_sum{route="/a"} 4.25',
+        'test_seconds_count{route="/a"} 4',
+    ]
@@ -1,3 +1,5 @@
+import json
+import uuid
 from http import HTTPStatus
 
 import pytest
@@ -142,7 +144,7 @@ async def test_start_generation(
 
     query = select(Recommendation).where(Recommendation.user_id == user1.id)
     result = await async_db.execute(query)
-    recommendation = result.scalars().one_or_none()
+    recommendation = result.scalars().first()
 
     assert response_data['status'] == (
         'Рекомендация успешно сгенерирована.')
@@ -167,3 +169,130 @@ async def test_get_recomendation(
     response = await client.get(f'/recommendations?user_id={user1.id}')
 
     assert response.status_code == HTTPStatus.OK
+
+
+@pytest.mark.asyncio
+async def test_get_users_by_pages(client: AsyncClient, async_db: AsyncSession,
+                                  user1: User, user2: User,
+                                  user3: User) -> None:
+    '''Пользователи отдаются страницами по курсору.'''
+    response = await client.get('/users?limit=2')
+    first_page = response.json()
+
+    assert len(first_page['data']) == 2
+    assert first_page['next'] == first_page['data'][-1]['id']
+
+    response = await client.get(f'/users?limit=2&after={first_page["next"]}')
+    second_page = response.json()
+
+    assert len(second_page['data']) == 1
+    assert second_page['next'] is None
+    ids = [user['id'] for user in first_page['data'] + second_page['data']]
+    assert sorted(ids) == sorted(str(user.id)
+                                 for user in (user1, user2, user3))
+
+
+@pytest.mark.asyncio
+async def test_get_purchases_ndjson(
+    client: AsyncClient, async_db: AsyncSession,
+    user1: User, item1: Item, item2: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase
+) -> None:
+    '''Покупки отдаются потоком NDJSON, по одной на строку.'''
+    response = await client.get('/purchases?format=ndjson')
+    rows = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert len(rows) == 2
+    assert {row['item_id'] for row in rows} == {str(item1.id),
+                                                str(item2.id)}
+    assert all(row['user_id'] == str(user1.id) for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_add_purchase_unknown_item(client: AsyncClient,
+                                         async_db: AsyncSession,
+                                         user1: User, item1: Item):
+    '''Покупка с несуществующим товаром не добавляется.'''
+    unknown = uuid.uuid4()
+    data = {'user_id': str(user1.id),
+            'cart': [{'id': str(item1.id), 'category': item1.category},
+                     {'id': str(unknown), 'category': item1.category}]}
+
+    response = await client.post('/purchases', json=data)
+
+    query = select(UserPurchase).where(UserPurchase.user_id == user1.id)
+    purchases = (await async_db.execute(query)).scalars().all()
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    assert response.json()['detail'] == f'Товар {unknown} не найден.'
+    assert purchases == []
+
+
+@pytest.mark.asyncio
+async def test_add_purchases_bulk(client: AsyncClient, async_db: AsyncSession,
+                                  user1: User, user2: User,
+                                  item1: Item, item4: Item):
+    '''Пакетная загрузка добавляет верные покупки и сообщает об ошибках.'''
+    rows = [
+        {'user_id': str(user1.id),
+         'cart': [{'id': str(item1.id), 'category': item1.category}]},
+        {'user_id': str(user2.id),
+         'cart': [{'id': str(item4.id), 'category': item1.category}]},
+        {'user_id': 'not-a-uuid', 'cart': []},
+        {'user_id': str(uuid.uuid4()),
+         'cart': [{'id': str(item1.id), 'category': item1.category}]},
+        {'user_id': str(user2.id),
+         'cart': [{'id': str(item1.id), 'category': item1.category},
+                  {'id': str(item4.id), 'category': item4.category}]},
+    ]
+
+    response = await client.post('/purchases/bulk', json=rows)
+    response_data = response.json()['data']
+
+    purchases = (await async_db.execute(select(UserPurchase))).scalars().all()
+    assert response.status_code == HTTPStatus.CREATED
+    assert response_data['accepted'] == 2
+    assert response_data['rejected'] == 3
+    assert [error['index'] for error in response_data['errors']] == [1, 2, 3]
+    assert len(purchases) == 3
+
+
+@pytest.mark.asyncio
+async def test_add_purchases_bulk_ndjson(client: AsyncClient,
+                                         async_db: AsyncSession,
+                                         user1: User, item1: Item):
+    '''Пакетная загрузка принимает NDJSON.'''
+    row = {'user_id': str(user1.id),
+           'cart': [{'id': str(item1.id), 'category': item1.category}]}
+    body = '\n'.join([json.dumps(row), '{broken', json.dumps(row)])
+
+    response = await client.post(
+        '/purchases/bulk', content=body,
+        headers={'Content-Type': 'application/x-ndjson'})
+    response_data = response.json()['data']
+
+    assert response_data['accepted'] == 2
+    assert [error['index'] for error in response_data['errors']] == [1]
+
+
+@pytest.mark.asyncio
+async def test_add_purchases_bulk_ndjson_stream(client: AsyncClient,
+                                                user1: User, item1: Item):
+    '''NDJSON читается потоком, строки могут делиться между порциями.'''
+    row = {'user_id': str(user1.id),
+           'cart': [{'id': str(item1.id), 'category': item1.category}]}
+    body = '\n'.join([json.dumps(row), '', '{broken', json.dumps(row)])
+    body = body.encode()
+
+    async def pieces():
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7]
+
+    response = await client.post(
+        '/purchases/bulk', content=pieces(),
+        headers={'Content-Type': 'application/x-ndjson'})
+    response_data = response.json()['data']
+
+    assert response_data['accepted'] == 2
+    assert [error['index'] for error in response_data['errors']] == [1]
@@ -0,0 +1,75 @@
+import datetime as dt
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Item, User, UserPurchase
+from app.partitions import (add_months, archive_name, archive_purchases,
+                            ensure_partitions, list_partitions, parse_period)
+from app.utils import get_purchases_dataframe
+
+NOW = dt.datetime(2024, 3, 15, 12, 0)
+
+
+@pytest_asyncio.fixture
+async def archive_cleanup(async_db: AsyncSession):
+    '''Архивные таблицы не входят в метаданные, удаляем их сами.'''
+    yield
+    for info in await list_partitions(async_db):
+        if info.archived:
+            await async_db.execute(text(f'DROP TABLE {info.name}'))
+    await async_db.commit()
+
+
+def test_month_arithmetic() -> None:
+    '''Месяцы считаются через границу года, имя хранит месяц.'''
+    month = dt.datetime(2024, 1, 1)
+
+    assert add_months(month, -1) == dt.datetime(2023, 12, 1)
+    assert add_months(month, 13) == dt.datetime(2025, 2, 1)
+    assert archive_name(month) == 'userpurchase_archive_y2024m01'
+    assert parse_period(archive_name(month)) == dt.date(2024, 1, 1)
+    assert parse_period('userpurchase_default') is None
+
+
+@pytest.mark.asyncio
+async def test_archive_purchases(
+    async_db: AsyncSession, archive_cleanup, user1: User, user2: User,
+    item1: Item, item2: Item
+) -> None:
+    '''
+    Покупки старше рабочего периода переносятся в архивные таблицы
+    по месяцам и больше не читаются загрузчиком покупок.
+    '''
+    dates = [dt.datetime(2022, 12, 31, 23, 59), dt.datetime(2023, 1, 10),
+             dt.datetime(2023, 3, 31), dt.datetime(2023, 4, 1),
+             dt.datetime(2024, 3, 1)]
+    async_db.add_all([
+        UserPurchase(user_id=user, item_id=item, category=item1.category,
+                     purchase_date=date)
+        for date, (user, item) in zip(dates, [
+            (user1.id, item1.id), (user2.id, item1.id),
+            (user1.id, item2.id), (user2.id, item2.id),
+            (user1.id, item1.id)])])
+    await async_db.commit()
+
+    assert await ensure_partitions(async_db, now=NOW) == []
+    archived = await archive_purchases(async_db, hot_months=12, now=NOW)
+
+    assert archived == ['userpurchase_archive_y2022m12',
+                        'userpurchase_archive_y2023m01',
+                        'userpurchase_archive_y2023m03']
+    hot = await async_db.scalar(select(func.count(UserPurchase.id)))
+    assert hot == 2
+    assert len(await get_purchases_dataframe(async_db)) == 2
+
+    partitions = await list_partitions(async_db)
+    assert [(info.period, info.rows) for info in partitions
+            if not info.archived] == [(dt.date(2023, 4, 1), 1),
+                                      (dt.date(2024, 3, 1), 1)]
+    assert [(info.name, info.rows) for info in partitions
+            if info.archived] == [(name, 1) for name in archived]
+
+    assert await archive_purchases(async_db, hot_months=12, now=NOW) == []
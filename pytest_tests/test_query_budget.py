@@ -0,0 +1,76 @@
+import logging
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .conftest import app
+from app import query_budget, routers
+from app.metrics import track_queries
+from app.models import User
+from app.query_budget import QueryBudgetExceeded
+
+
+@pytest.mark.asyncio
+async def test_budget_exceeded_fails_test(
+    client: AsyncClient, async_db: AsyncSession, user1: User, monkeypatch
+) -> None:
+    '''В тестах превышение бюджета маршрута - исключение.'''
+    monkeypatch.setattr(routers.get_users, 'query_budget', 0)
+
+    with pytest.raises(QueryBudgetExceeded, match='GET /users'):
+        await client.get('/users')
+
+
+@pytest.mark.asyncio
+async def test_budget_checked_before_response(
+    async_db: AsyncSession, user1: User, monkeypatch
+) -> None:
+    '''При превышении бюджета в режиме raise клиент не получает 200.'''
+    monkeypatch.setattr(routers.get_users, 'query_budget', 0)
+
+    async with AsyncClient(
+            transport=ASGITransport(app=app, raise_app_exceptions=False),
+            base_url='http://test') as client:
+        response = await client.get('/users')
+
+    assert response.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_budget_exceeded_logs_statements(
+    client: AsyncClient, async_db: AsyncSession, user1: User,
+    monkeypatch, caplog
+) -> None:
+    '''В режиме warn превышение записывается в лог вместе с запросами.'''
+    monkeypatch.setattr(routers.get_users, 'query_budget', 0)
+    monkeypatch.setattr(query_budget, 'QUERY_BUDGET_MODE', 'warn')
+
+    with caplog.at_level(logging.WARNING, logger='app.query_budget'):
+        response = await client.get('/users')
+
+    assert response.status_code == 200
+    assert 'GET /users: 1 запросов к базе при бюджете 0' in caplog.text
+    assert 'FROM user' in caplog.text
+
+
+def test_every_route_has_budget() -> None:
+    '''У каждого обработчика объявлен бюджет запросов к базе.'''
+    for router in (routers.user_router, routers.item_router,
+                   routers.purchase_router, routers.recommendation_router,
+                   routers.gen_recommendation_router, routers.admin_router,
+                   routers.internal_router, routers.metrics_router):
+        for route in router.routes:
+            assert hasattr(route.endpoint, 'query_budget'), route.path
+
+
+@pytest.mark.asyncio
+async def test_track_queries(async_db: AsyncSession, user1: User) -> None:
+    '''Запросы вне HTTP-запроса считаются внутри блока track_queries.'''
+    with track_queries() as stats:
+        await async_db.execute(select(User))
+        await async_db.execute(select(User.id))
+
+    assert stats.queries == 2
+    assert len(stats.statements) == 2
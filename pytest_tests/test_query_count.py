@@ -0,0 +1,73 @@
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import recommendation_cache
+from app.models import Item, User, UserPurchase
+
+
+async def count_queries(queries: list[str], request) -> int:
+    '''Число SQL-запросов, выполненных за один вызов эндпоинта.'''
+    queries.clear()
+    await request
+    return len(queries)
+
+
+@pytest.mark.asyncio
+async def test_list_endpoints_query_count(
+    client: AsyncClient, async_db: AsyncSession, queries: list[str],
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''Эндпоинты не подгружают связанные объекты лишними запросами.'''
+    assert await count_queries(queries, client.get('/users')) == 1
+    assert await count_queries(queries, client.get('/items')) == 1
+    assert await count_queries(
+        queries, client.get(f'/items/{item1.id}')) == 1
+    assert await count_queries(queries, client.get('/purchases')) == 1
+
+
+@pytest.mark.asyncio
+async def test_recommendation_endpoints_query_count(
+    client: AsyncClient, async_db: AsyncSession, queries: list[str],
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''
+    Генерация: пользователь, покупки для матрицы (только при первом
+    расчете), удаление и вставка рекомендаций.
+    Чтение: один запрос без кэша и ни одного из кэша.
+    '''
+    assert await count_queries(queries, client.post(
+        '/generate_recommendations', json={'user_id': str(user1.id)})) == 4
+    assert await count_queries(queries, client.post(
+        '/generate_recommendations', json={'user_id': str(user1.id)})) == 3
+
+    await recommendation_cache.clear()
+    assert await count_queries(
+        queries, client.get(f'/recommendations?user_id={user1.id}')) == 1
+    assert await count_queries(
+        queries, client.get(f'/recommendations?user_id={user1.id}')) == 0
+
+
+@pytest.mark.asyncio
+async def test_add_purchase_query_count(
+    client: AsyncClient, async_db: AsyncSession, queries: list[str],
+    user1: User, item1: Item, item2: Item, item3: Item
+) -> None:
+    '''
+    Число запросов покупки не зависит от размера корзины:
+    проверка товаров, купленные товары, совместные покупки, вставка.
+    '''
+    data = {'user_id': str(user1.id),
+            'cart': [{'id': str(item.id), 'category': item.category}
+                     for item in (item1, item2, item3)]}
+
+    assert await count_queries(queries, client.post('/purchases',
+                                                    json=data)) == 4
@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .conftest import engine_test
+from app.cache import recommendation_cache
+from app.models import Item, Model, User, UserPurchase
+from app.orm_query import PurchaseRepository, RecommendRepository
+from app.schemas import PurchaseAdd, RecommendationAdd, RecommendationMode
+from app.utils import (bump_cooccurrence, rebuild_cooccurrence,
+                       rebuild_item_neighbours)
+
+TABLES = set(Model.metadata.tables)
+
+
+async def explain_hot_queries(session: AsyncSession, calls) -> list[tuple]:
+    '''
+    Выполняет вызовы, перехватывает их SELECT-запросы
+    и возвращает планы выполнения SQLite для каждого из них.
+    '''
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    event.listen(engine_test.sync_engine, 'before_cursor_execute', capture)
+    try:
+        for call in calls:
+            await call()
+    finally:
+        event.remove(engine_test.sync_engine, 'before_cursor_execute',
+                     capture)
+
+    connection = await session.connection()
+    plans = []
+    for statement, parameters in statements:
+        result = await connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {statement}', parameters)
+        plans.append((statement, [row[3] for row in result]))
+    return plans
+
+
+def full_scans(plan: list[str]) -> list[str]:
+    '''Шаги плана, которые читают таблицу целиком.'''
+    return [step for step in plan
+            if step.startswith('SCAN ') and step.split()[1] in TABLES]
+
+
+@pytest.mark.asyncio
+async def test_hot_queries_use_indexes(
+    async_db: AsyncSession,
+    user1: User, user2: User, user3: User,
+    item1: Item, item2: Item, item3: Item, item4: Item, item5: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase, purchase2_user2: UserPurchase,
+    purchase3_user2: UserPurchase, purchase1_user3: UserPurchase
+) -> None:
+    '''Запросы на горячих путях не читают таблицы целиком.'''
+    await rebuild_cooccurrence(async_db)
+    await rebuild_item_neighbours(async_db, n=10)
+    await RecommendRepository.add_recommendation(
+        RecommendationAdd(user_id=user1.id, mode=RecommendationMode.sql),
+        async_db)
+    purchase = PurchaseAdd(user_id=user3.id,
+                           cart=[{'id': item1.id, 'category': item1.category}])
+
+    plans = await explain_hot_queries(async_db, [
+        lambda: PurchaseRepository.get_user_purchases(user1.id, async_db),
+        recommendation_cache.clear,
+        lambda: RecommendRepository.get_recommendation(user1.id, async_db),
+        lambda: RecommendRepository.rank_items(
+            user1.id, RecommendationMode.sql, async_db, 10),
+        lambda: RecommendRepository.rank_items(
+            user1.id, RecommendationMode.cooccurrence, async_db, 10),
+        lambda: RecommendRepository.rank_items(
+            user1.id, RecommendationMode.item, async_db, 10),
+        lambda: RecommendRepository.rank_items(
+            user1.id, RecommendationMode.recent, async_db, 10),
+        lambda: bump_cooccurrence([(user3.id, [item1.id])], async_db),
+        lambda: PurchaseRepository.add_purchase(purchase, async_db),
+    ])
+
+    assert plans
+    for statement, plan in plans:
+        assert not full_scans(plan), (statement, plan)
@@ -0,0 +1,146 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.recommender import (NO_NEW_ITEMS, NO_SIMILAR_USERS,
+                             NotEnoughDataError, RecommendationEngine,
+                             decay_weights, item_neighbours, score_rows,
+                             score_user)
+
+USERS = [uuid.uuid4() for _ in range(4)]
+ITEMS = [uuid.uuid4() for _ in range(5)]
+
+
+def make_engine(pairs: list[tuple[int, int]]) -> RecommendationEngine:
+    '''Строит движок по парам (номер пользователя, номер товара).'''
+    df = pd.DataFrame({
+        'user_id': [str(USERS[user]) for user, _ in pairs],
+        'item_id': [str(ITEMS[item]) for _, item in pairs],
+    })
+    return RecommendationEngine.from_dataframe(df)
+
+
+def test_recommend_ranks_by_popularity() -> None:
+    '''Товары ранжируются по числу покупок схожими пользователями.'''
+    engine = make_engine([(0, 0), (1, 0), (1, 1), (1, 2),
+                          (2, 0), (2, 2), (3, 3)])
+
+    assert engine.recommend(USERS[0], k=5) == [(ITEMS[2], 2),
+                                               (ITEMS[1], 1)]
+
+
+def test_recommend_no_similar_users() -> None:
+    '''Нет пользователей с общими покупками.'''
+    engine = make_engine([(0, 0), (1, 1)])
+
+    with pytest.raises(NotEnoughDataError) as error:
+        engine.recommend(USERS[0])
+    assert error.value.detail == NO_SIMILAR_USERS
+
+
+def test_recommend_no_new_items() -> None:
+    '''Схожие пользователи не покупали ничего нового.'''
+    engine = make_engine([(0, 0), (0, 1), (1, 0)])
+
+    with pytest.raises(NotEnoughDataError) as error:
+        engine.recommend(USERS[0])
+    assert error.value.detail == NO_NEW_ITEMS
+
+
+def test_decay_weights() -> None:
+    '''Вес вдвое меньше за каждый период полураспада.'''
+    now = np.datetime64('2024-03-31T00:00:00')
+    dates = np.array(['2024-03-31', '2024-03-01', '2024-01-31',
+                      '2024-04-10', 'NaT'], dtype='datetime64[us]')
+
+    assert decay_weights(dates, now, 30) == pytest.approx(
+        [1, 0.5, 0.25, 1, 1])
+
+
+def test_score_user_with_weights() -> None:
+    '''С весами популярность - сумма весов, а не число покупок.'''
+    users = np.array([0, 1, 1, 2, 2, 3])
+    items = np.array([0, 0, 1, 0, 2, 2])
+    weights = np.array([1, 1, 0.9, 1, 0.2, 0.2])
+
+    codes, scores, _ = score_user(users, items, (4, 3), 0, 2, weights)
+
+    assert codes.tolist() == [1, 2]
+    assert scores == pytest.approx([0.9, 0.2])
+
+
+@pytest.mark.parametrize('metric, expected', [
+    ('cosine', [(0, 1, 0.5 ** 0.5), (1, 0, 0.5 ** 0.5), (1, 2, 0.5 ** 0.5),
+                (2, 1, 0.5 ** 0.5)]),
+    ('jaccard', [(0, 1, 0.5), (1, 0, 0.5), (1, 2, 0.5), (2, 1, 0.5)]),
+])
+def test_item_neighbours(metric: str, expected: list) -> None:
+    '''Соседи товара - товары с общими покупателями, без него самого.'''
+    users = np.array([0, 0, 1, 1, 2])
+    items = np.array([0, 1, 1, 2, 3])
+
+    rows, cols, scores = item_neighbours(users, items, (3, 4), n=5,
+                                         metric=metric, chunk_size=2)
+
+    assert list(zip(rows.tolist(), cols.tolist())) == [
+        (item, neighbour) for item, neighbour, _ in expected]
+    assert scores == pytest.approx([score for _, _, score in expected])
+
+
+def test_item_neighbours_limit() -> None:
+    '''Сохраняются только n самых похожих соседей.'''
+    users = np.array([0, 0, 0, 1, 1])
+    items = np.array([0, 1, 2, 0, 1])
+
+    rows, cols, _ = item_neighbours(users, items, (2, 3), n=1)
+
+    pairs = list(zip(rows.tolist(), cols.tolist()))
+
+    assert pairs == [(0, 1), (1, 0), (2, 0)]
+
+
+def test_add_purchases_matches_rebuild() -> None:
+    '''Дописанные покупки учитываются так же, как при сборке заново.'''
+    users = np.array([0, 1, 1, 2, 2, 3, 4, 0, 4])
+    items = np.array([0, 0, 1, 1, 2, 3, 0, 2, 3])
+    engine = RecommendationEngine(users[:6], items[:6], (4, 4))
+    engine.add_purchases(users[6:8], items[6:8])
+    engine.add_purchases(users[8:], items[8:])
+    rebuilt = RecommendationEngine(users, items, (5, 4))
+
+    for code in range(5):
+        items_added, scores_added = engine.top_codes(code, k=4)
+        user_items, similar = engine.similar_users(code)
+        items_rows, scores_rows, _ = score_rows(
+            engine.user_rows(similar), user_items, k=4)
+
+        assert items_added.tolist() == rebuilt.top_codes(code, 4)[0].tolist()
+        assert scores_added.tolist() == rebuilt.top_codes(code, 4)[1].tolist()
+        assert items_rows.tolist() == items_added.tolist()
+        assert scores_rows.tolist() == scores_added.tolist()
+
+    engine.merge()
+    assert engine.delta is None
+    assert (engine.csr != rebuilt.csr).nnz == 0
+
+
+def test_top_items_chunks_by_nnz() -> None:
+    '''Порции по оценке размера матриц не меняют результат.'''
+    rng = np.random.default_rng(0)
+    users = rng.integers(0, 50, size=400)
+    items = rng.integers(0, 30, size=400)
+    engine = RecommendationEngine(users, items, (50, 30))
+    codes = np.arange(50)
+
+    bounds = engine.chunk_bounds(codes, max_nnz=100)
+    top, scores = engine.top_items(codes, k=5, max_nnz=100)
+    expected_top, expected_scores = engine.top_items(codes, k=5,
+                                                     chunk_size=50)
+
+    assert len(bounds) > 1
+    assert bounds[0][0] == 0 and bounds[-1][1] == 50
+    assert all(end > start for start, end in bounds)
+    assert (top == expected_top).all()
+    assert (scores == expected_scores).all()
@@ -0,0 +1,86 @@
+import uuid
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.interning import user_interner
+from app.models import Item, User, UserPurchase
+from app.utils import get_purchases_dataframe, load_interactions
+
+
+@pytest.mark.asyncio
+async def test_get_purchases_dataframe(
+    async_db: AsyncSession, user1: User, user2: User,
+    item1: Item, item2: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase
+) -> None:
+    '''Загрузчик покупок возвращает столбцы user_id и item_id.'''
+    df = await get_purchases_dataframe(async_db, chunk_size=2)
+
+    assert list(df.columns) == ['user_id', 'item_id']
+    assert len(df) == 3
+    assert sorted(zip(df['user_id'], df['item_id'])) == sorted([
+        (str(user1.id), str(item1.id)),
+        (str(user1.id), str(item2.id)),
+        (str(user2.id), str(item2.id)),
+    ])
+
+
+@pytest.mark.asyncio
+async def test_get_purchases_dataframe_empty(async_db: AsyncSession) -> None:
+    '''Для пустой таблицы покупок возвращается пустой DataFrame.'''
+    df = await get_purchases_dataframe(async_db)
+
+    assert list(df.columns) == ['user_id', 'item_id']
+    assert df.empty
+
+
+@pytest.mark.asyncio
+async def test_get_purchases_dataframe_with_dates(
+    async_db: AsyncSession, user1: User, item1: Item,
+    purchase1_user1: UserPurchase
+) -> None:
+    '''С with_dates загружается и дата покупки.'''
+    df = await get_purchases_dataframe(async_db, with_dates=True)
+    empty = await get_purchases_dataframe(
+        async_db, select(UserPurchase.user_id, UserPurchase.item_id,
+                         UserPurchase.purchase_date).where(False),
+        with_dates=True)
+
+    assert list(df.columns) == ['user_id', 'item_id', 'purchase_date']
+    assert df['purchase_date'][0] == purchase1_user1.purchase_date
+    assert list(empty.columns) == list(df.columns)
+
+
+@pytest.mark.asyncio
+async def test_load_interactions(
+    async_db: AsyncSession, user1: User, user2: User,
+    item1: Item, item2: Item,
+    purchase1_user1: UserPurchase, purchase2_user1: UserPurchase,
+    purchase1_user2: UserPurchase
+) -> None:
+    '''Покупки загружаются кодами int32, коды не меняются между загрузками.'''
+    user3 = uuid.uuid4()
+    user3_code = user_interner.add(user3)
+    interactions = await load_interactions(async_db, chunk_size=2)
+    again = await load_interactions(async_db, with_dates=True)
+
+    assert interactions.user_codes.dtype == np.int32
+    assert interactions.item_codes.dtype == np.int32
+    assert interactions.dates is None
+    assert len(again.dates) == 3
+    assert interactions.user_code(user3) == user3_code
+    assert sorted(
+        (interactions.users.uuid_of(user), interactions.item_uuid(item))
+        for user, item in zip(interactions.user_codes,
+                              interactions.item_codes)
+    ) == sorted([(user1.id, item1.id), (user1.id, item2.id),
+                 (user2.id, item2.id)])
+    # Порядок строк не задан, сравниваются пары кодов
+    pairs = sorted(zip(interactions.user_codes.tolist(),
+                       interactions.item_codes.tolist()))
+    assert sorted(zip(again.user_codes.tolist(),
+                      again.item_codes.tolist())) == pairs